@@ -0,0 +1,2208 @@
+"""
+Offline Benchmark Harness for the ETL Pipeline
+----------------------------------------------
+
+This script measures the ETL pipeline in etl.py without touching clinicaltrials.gov.
+It generates synthetic studies shaped like the API v2 responses and serves them from a
+local stand-in API server, so throughput and correctness can be checked offline.
+
+Usage:
+    python benchmark.py download --studies 5000 --overlap 0.3 --latency 0.02
+    python benchmark.py resume --studies 5000 --error-rate 0.1 --throttle-rate 0.05 --fail-at 0.8
+    python benchmark.py incremental --studies 5000 --change-rate 0.05
+    python benchmark.py workers --studies 5000 --workers 2 4
+    python benchmark.py normalizers --studies 2000
+    python benchmark.py projection --studies 2000
+    python benchmark.py normalized --studies 2000
+    python benchmark.py parquet --studies 2000
+    python benchmark.py search --studies 2000 --queries 300
+    python benchmark.py eligibility --studies 10000 --queries 200
+    python benchmark.py changes --studies 1000 --months 6 --windows 1 2 3 10
+    python benchmark.py incremental-changes --studies 2000 --months 6
+    python benchmark.py history-query --studies 2000 --months 6 --queries 50
+    python benchmark.py stage-cache --studies 500
+    python benchmark.py sqlite --studies 2000 --runs 4
+    python benchmark.py aggregates --studies 2000 --runs 4
+    python benchmark.py generate --studies 10000 --months 12 --change-rate 0.05
+    python benchmark.py backfill --studies 10000 --months 12 --workers 1 2 4
+    python benchmark.py delta --studies 2000
+    python benchmark.py stages --sizes 1000 10000 100000 --threshold 0.25
+"""
+import argparse
+import base64
+import contextlib
+import hashlib
+import html
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unicodedata
+from collections.abc import Sequence
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import etl
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+STATUSES = ['RECRUITING', 'COMPLETED', 'UNKNOWN', 'NOT_YET_RECRUITING', 'TERMINATED',
+            'ACTIVE_NOT_RECRUITING', 'WITHDRAWN', 'ENROLLING_BY_INVITATION']
+PHASES = ['NA', 'PHASE1', 'PHASE2', 'PHASE3', 'PHASE4', 'EARLY_PHASE1']
+SPONSOR_CLASSES = ['OTHER', 'INDUSTRY', 'OTHER_GOV', 'FED', 'NIH', 'NETWORK', 'INDIV']
+INTERVENTION_TYPES = ['DRUG', 'DEVICE', 'BEHAVIORAL', 'PROCEDURE', 'OTHER', 'DIETARY_SUPPLEMENT']
+COUNTRIES = ['United States', 'Germany', 'France', 'China', 'Spain', 'Italy', 'Japan',
+             'Canada', 'United Kingdom', 'Netherlands', 'Côte d\'Ivoire', 'Türkiye']
+WORDS = ['heart', 'failure', 'preserved', 'ejection', 'fraction', 'exercise', 'capacity',
+         'diastolic', 'function', 'SGLT2', 'inhibitor', 'KCCQ', 'score', '6-minute', 'walk',
+         'distance', 'patients', 'placebo', 'randomized', 'trial', 'outcome', 'hospitalization']
+
+
+def make_text(rng, n_words):
+    """
+    Build a pseudo-random sentence from the benchmark vocabulary.
+
+    Args:
+        rng (random.Random): Random generator
+        n_words (int): Number of words in the sentence
+
+    Returns:
+        str: Generated text
+    """
+    return ' '.join(rng.choice(WORDS) for _ in range(n_words)).capitalize()
+
+
+def make_study(index, rng, locations=6, text_words=60):
+    """
+    Build one synthetic study record in the clinicaltrials.gov API v2 format.
+
+    Args:
+        index (int): Sequence number used to derive the NCTId
+        rng (random.Random): Random generator
+        locations (int): Average number of sites per study
+        text_words (int): Number of words in the brief summary
+
+    Returns:
+        dict: Study record with every module read by etl.data_preparation
+    """
+    nct_id = f"NCT{index:08d}"
+    n_locations = rng.randint(0, 2 * locations)
+    n_interventions = rng.randint(0, 3)
+    year = rng.randint(2005, 2026)
+    study = {
+        'protocolSection': {
+            'identificationModule': {
+                'nctId': nct_id,
+                'orgStudyIdInfo': {'id': f"ORG-{index}"},
+                'secondaryIdInfos': [{'id': f"SEC-{index}-{k}"} for k in range(rng.randint(0, 2))],
+                'briefTitle': make_text(rng, 12) + ' &amp; HFpEF',
+                'acronym': f"ACR{index % 997}" if rng.random() < 0.4 else '',
+            },
+            'statusModule': {
+                'overallStatus': rng.choice(STATUSES),
+                'startDateStruct': {'date': f"{year}-{rng.randint(1, 12):02d}"},
+                'primaryCompletionDateStruct': {'date': f"{year + 2}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"},
+                'completionDateStruct': {'date': f"{year + 3}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"},
+                'studyFirstPostDateStruct': {'date': f"{year}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"},
+                'resultsFirstPostDateStruct': {'date': f"{year + 4}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"} if rng.random() < 0.2 else {},
+                'lastUpdatePostDateStruct': {'date': f"{min(year + 1, 2026)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"},
+            },
+            'sponsorCollaboratorsModule': {
+                'leadSponsor': {'name': f"Sponsor {index % 211}", 'class': rng.choice(SPONSOR_CLASSES)},
+                'collaborators': [{'name': f"Collaborator {rng.randint(0, 300)}", 'class': rng.choice(SPONSOR_CLASSES)}
+                                  for _ in range(rng.randint(0, 2))],
+            },
+            'descriptionModule': {'briefSummary': make_text(rng, text_words)},
+            'conditionsModule': {'conditions': ['Heart Failure With Preserved Ejection Fraction', 'HFpEF'][:rng.randint(1, 2)]},
+            'designModule': {
+                'studyType': rng.choice(['INTERVENTIONAL', 'OBSERVATIONAL']),
+                'phases': sorted(rng.sample(PHASES, rng.randint(1, 2))),
+                'designInfo': {'primaryPurpose': rng.choice(['TREATMENT', 'DIAGNOSTIC', 'BASIC_SCIENCE', 'OTHER'])},
+                'enrollmentInfo': {'count': rng.randint(10, 5000)},
+            },
+            'armsInterventionsModule': {
+                'interventions': [{
+                    'type': rng.choice(INTERVENTION_TYPES),
+                    'name': make_text(rng, 3),
+                    'description': make_text(rng, 20),
+                    'armGroupLabels': [f"Arm {k}" for k in range(rng.randint(1, 2))],
+                    'otherNames': [make_text(rng, 1)] if rng.random() < 0.3 else [],
+                } for _ in range(n_interventions)],
+            },
+            'outcomesModule': {
+                'primaryOutcomes': [{'measure': make_text(rng, 8)} for _ in range(rng.randint(1, 2))],
+                'secondaryOutcomes': [{'measure': make_text(rng, 8)} for _ in range(rng.randint(0, 4))],
+            },
+            'eligibilityModule': {
+                'sex': rng.choice(['ALL', 'ALL', 'ALL', 'FEMALE', 'MALE']),
+                'minimumAge': f"{rng.choice([18, 40, 50, 65])} Years",
+                'maximumAge': rng.choice(['', '80 Years', '85 Years', '90 Years']),
+                'stdAges': ['ADULT', 'OLDER_ADULT'],
+            },
+            'contactsLocationsModule': {
+                'locations': [{
+                    'facility': f"University Hospital {rng.randint(0, 500)}",
+                    'city': f"City {rng.randint(0, 200)}",
+                    'state': f"State {rng.randint(0, 50)}",
+                    'country': rng.choice(COUNTRIES),
+                    'zip': f"{rng.randint(0, 99999):05d}",
+                    'status': rng.choice(['RECRUITING', 'COMPLETED', '']),
+                } for _ in range(n_locations)],
+            },
+        },
+        'hasResults': rng.random() < 0.2,
+    }
+    add_unread_sections(study, index)
+    return study
+
+
+def add_unread_sections(study, index):
+    """
+    Add sections that real full records carry but etl.data_preparation never reads:
+    site contacts and coordinates, references, and the derived section.
+
+    They are derived from the study itself, without drawing from the random generator,
+    so the transformed rows do not depend on them.
+
+    Args:
+        study (dict): Study record from make_study, modified in place
+        index (int): Sequence number of the study
+    """
+    protocol = study['protocolSection']
+    for k, location in enumerate(protocol['contactsLocationsModule']['locations']):
+        location['geoPoint'] = {'lat': 40.0 + (index + k) % 50 / 10, 'lon': -75.0 + (index * k) % 90 / 10}
+        location['contacts'] = [{'name': f"Site Investigator {index}-{k}", 'role': 'PRINCIPAL_INVESTIGATOR',
+                                 'phone': '555-0100', 'email': f"site{k}@example.org"}]
+    protocol['referencesModule'] = {'references': [
+        {'pmid': str(30000000 + index * 7 + k), 'type': 'BACKGROUND',
+         'citation': f"{protocol['identificationModule']['briefTitle']}. J Card Fail. 20{10 + k}."}
+        for k in range(3)]}
+    protocol['armsInterventionsModule']['armGroups'] = [
+        {'label': label, 'type': 'EXPERIMENTAL', 'description': protocol['descriptionModule']['briefSummary'][:200]}
+        for label in sorted({label for i in protocol['armsInterventionsModule']['interventions']
+                             for label in i['armGroupLabels']})]
+    study['derivedSection'] = {
+        'miscInfoModule': {'versionHolder': '2025-06-01'},
+        'conditionBrowseModule': {
+            'meshes': [{'id': 'D006333', 'term': 'Heart Failure'}],
+            'ancestors': [{'id': 'D006331', 'term': 'Heart Diseases'},
+                          {'id': 'D002318', 'term': 'Cardiovascular Diseases'}],
+        },
+    }
+
+
+def make_corpus(n_studies, seed=0, **kwargs):
+    """
+    Build a list of synthetic studies with unique, sequential NCTIds.
+
+    Args:
+        n_studies (int): Number of studies to generate
+        seed (int): Seed of the random generator
+        **kwargs: Extra arguments forwarded to make_study
+
+    Returns:
+        list: Synthetic study records
+    """
+    rng = random.Random(seed)
+    return [make_study(i, rng, **kwargs) for i in range(n_studies)]
+
+
+class SyntheticCorpus(Sequence):
+    """
+    Read-only corpus of synthetic studies generated on access.
+
+    Study i is rebuilt from its own seed each time it is read, so corpora of a million
+    studies can be served or written out without holding them in memory.
+    """
+
+    def __init__(self, n_studies, seed=0, **kwargs):
+        self.n_studies = n_studies
+        self.seed = seed
+        self.kwargs = kwargs
+
+    def __len__(self):
+        return self.n_studies
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.n_studies))]
+        if index < 0:
+            index += self.n_studies
+        if not 0 <= index < self.n_studies:
+            raise IndexError(index)
+        return make_study(index, random.Random(f"{self.seed}:{index}"), **self.kwargs)
+
+
+class StandInAPI:
+    """
+    Local stand-in for the clinicaltrials.gov /api/v2/studies endpoint.
+
+    Each condition term is mapped to its own list of studies. Pages are capped at
+    max_page_size and chained with an opaque nextPageToken, like the real API.
+
+    Faults can be injected: a share of requests is answered with a 503 or a dropped
+    connection (error_rate) or a 429 with Retry-After (throttle_rate), and once
+    outage_after requests have been served every request fails until outage_after is
+    reset to None.
+
+    With page_cache_dir, the body of each distinct request is built once and stored
+    there, and later identical requests are answered from the file, so the time spent
+    generating, projecting and serializing synthetic studies stays out of a timed download.
+    """
+
+    def __init__(self, corpus_by_term, max_page_size=1000, latency=0.0, error_rate=0.0, throttle_rate=0.0,
+                 outage_after=None, seed=0, page_cache_dir=None):
+        self.corpus_by_term = corpus_by_term
+        self.page_cache_dir = page_cache_dir
+        self.max_page_size = max_page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.outage_after = outage_after
+        self.requests_served = 0
+        self.bytes_served = 0
+        self.faults_injected = 0
+        self.request_times = []
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/api/v2/studies"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def page(self, params):
+        """Build the JSON response for one request from its query parameters."""
+        studies = self.corpus_by_term.get(params.get('query.cond', ''), [])
+        if 'filter.ids' in params:
+            ids = set(params['filter.ids'].split(','))
+            studies = [study for study in studies if etl.get_nct_id(study) in ids]
+        if 'filter.advanced' in params:
+            # Only the AREA[LastUpdatePostDate]RANGE[<date>,MAX] filter used by etl.py is supported
+            since = re.search(r'RANGE\[([^,\]]+),', params['filter.advanced']).group(1)
+            studies = [study for study in studies
+                       if etl.standardize_date(etl.get_last_update_date(study)) >= since]
+        page_size = min(int(params.get('pageSize', 10)), self.max_page_size)
+        token = params.get('pageToken')
+        offset = int(base64.urlsafe_b64decode(token).decode()) if token else 0
+        page = studies[offset:offset + page_size]
+        # Only the studies of the requested page are projected
+        if params.get('fields') == 'NCTId':
+            page = [{'protocolSection': {'identificationModule': {'nctId': etl.get_nct_id(study)}}}
+                    for study in page]
+        elif 'fields' in params:
+            fields = params['fields'].split(',')
+            page = [project_study(study, fields) for study in page]
+        body = {'studies': page}
+        if offset + page_size < len(studies):
+            body['nextPageToken'] = base64.urlsafe_b64encode(str(offset + page_size).encode()).decode()
+        return body
+
+    def payload(self, params):
+        """Serialized response body for one request, from the page cache when there is one."""
+        if self.page_cache_dir is None:
+            return json.dumps(self.page(params)).encode('utf-8')
+        key = hashlib.sha256(json.dumps(sorted(params.items())).encode('utf-8')).hexdigest()
+        cache_file = os.path.join(self.page_cache_dir, f"{key}.json")
+        if os.path.isfile(cache_file):
+            with open(cache_file, 'rb') as f:
+                return f.read()
+        payload = json.dumps(self.page(params)).encode('utf-8')
+        os.makedirs(self.page_cache_dir, exist_ok=True)
+        # Requests are served by several threads; the file only appears once complete
+        with tempfile.NamedTemporaryFile(dir=self.page_cache_dir, delete=False) as f:
+            f.write(payload)
+        os.replace(f.name, cache_file)
+        return payload
+
+    def fault(self):
+        """Pick the fault injected into the next request: None, 'error', 'drop' or 'throttle'."""
+        with self._lock:
+            self.request_times.append(time.monotonic())
+            if self.outage_after is not None and self.requests_served >= self.outage_after:
+                fault = 'error'
+            else:
+                draw = self._rng.random()
+                if draw < self.error_rate:
+                    fault = self._rng.choice(['error', 'drop'])
+                elif draw < self.error_rate + self.throttle_rate:
+                    fault = 'throttle'
+                else:
+                    fault = None
+            if fault:
+                self.faults_injected += 1
+            return fault
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+                if api.latency:
+                    time.sleep(api.latency)
+                fault = api.fault()
+                if fault == 'drop':
+                    self.close_connection = True
+                    return
+                if fault:
+                    self.send_response(503 if fault == 'error' else 429)
+                    if fault == 'throttle':
+                        self.send_header('Retry-After', '0')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                payload = api.payload(params)
+                with api._lock:
+                    api.requests_served += 1
+                    api.bytes_served += len(payload)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def split_corpus(corpus, terms, overlap, seed=0):
+    """
+    Assign studies to query terms, with a share of them matching every term.
+
+    Args:
+        corpus (list): Study records
+        terms (list): Condition terms served by the stand-in API
+        overlap (float): Fraction of studies returned by all the terms
+        seed (int): Seed of the random generator
+
+    Returns:
+        dict: Studies served for each term
+    """
+    rng = random.Random(seed)
+    corpus_by_term = {term: [] for term in terms}
+    for study in corpus:
+        if rng.random() < overlap:
+            for term in terms:
+                corpus_by_term[term].append(study)
+        else:
+            corpus_by_term[rng.choice(terms)].append(study)
+    return corpus_by_term
+
+
+def bench_download(args):
+    """Download a synthetic corpus from the stand-in API and check the merged result."""
+    corpus = make_corpus(args.studies, seed=args.seed)
+    corpus_by_term = split_corpus(corpus, etl.QUERY_TERMS, args.overlap, seed=args.seed)
+    expected_ids = [etl.get_nct_id(study) for study in corpus]
+
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            StandInAPI(corpus_by_term, max_page_size=args.max_page_size, latency=args.latency) as api:
+        output_file = os.path.join(tmp_dir, 'studies.ndjson')
+        start = time.perf_counter()
+        etl.download_studies(args.page_size, base_url=api.url, output_file=output_file, rate_limit=None)
+        elapsed = time.perf_counter() - start
+
+        downloaded_ids = [etl.get_nct_id(study) for study in etl.iter_studies(output_file)]
+
+    missing = set(expected_ids) - set(downloaded_ids)
+    duplicated = len(downloaded_ids) - len(set(downloaded_ids))
+    print(f"download: {len(downloaded_ids)} studies in {elapsed:.2f}s "
+          f"({len(downloaded_ids) / elapsed:.0f} studies/s, {api.requests_served} requests, "
+          f"{api.bytes_served / 1e6:.1f} MB)")
+    print(f"download: {len(missing)} missing, {duplicated} duplicated")
+    return not missing and not duplicated
+
+
+def bench_resume(args):
+    """Interrupt a download with an outage, resume it and check the result and the pacing."""
+    corpus = make_corpus(args.studies, seed=args.seed)
+    corpus_by_term = split_corpus(corpus, etl.QUERY_TERMS, args.overlap, seed=args.seed)
+    expected_ids = [etl.get_nct_id(study) for study in corpus]
+    # Retries of the stand-in's faults need no real backoff
+    etl.RETRY_BACKOFF, etl.RETRY_MAX_WAIT = 0.01, 0.1
+
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            StandInAPI(corpus_by_term, error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                       seed=args.seed) as api:
+        reference_file = os.path.join(tmp_dir, 'reference', 'studies.ndjson')
+        etl.download_studies(args.page_size, base_url=api.url, output_file=reference_file, rate_limit=None)
+        full_requests = api.requests_served
+
+        output_file = os.path.join(tmp_dir, 'studies.ndjson')
+        checkpoint_dir = os.path.join(tmp_dir, 'download_checkpoints')
+        api.outage_after = api.requests_served + int(full_requests * args.fail_at)
+        try:
+            etl.download_studies(args.page_size, base_url=api.url, output_file=output_file,
+                                 checkpoint_dir=checkpoint_dir, rate_limit=None)
+            interrupted = False
+        except etl.requests.RequestException:
+            interrupted = True
+        checkpointed_pages = sum(name.endswith('.meta.json') for _, _, names in os.walk(checkpoint_dir) for name in names)
+
+        api.outage_after = None
+        requests_before = api.requests_served
+        times_before = len(api.request_times)
+        start = time.perf_counter()
+        etl.download_studies(args.page_size, base_url=api.url, output_file=output_file,
+                             checkpoint_dir=checkpoint_dir, rate_limit=args.rate_limit)
+        elapsed = time.perf_counter() - start
+        resumed_requests = api.requests_served - requests_before
+        request_times = api.request_times[times_before:]
+        identical = list(etl.iter_studies(output_file)) == list(etl.iter_studies(reference_file))
+        downloaded_ids = [etl.get_nct_id(study) for study in etl.iter_studies(output_file)]
+        cleared = not os.path.exists(checkpoint_dir)
+
+    # A token bucket lets at most burst + 1 + rate * window requests through in a window, so
+    # the requests beyond that must be spaced by the rate limit; with no more requests than
+    # the burst the limiter never waits, so the pacing is not measured and the check fails
+    paced_requests = len(request_times) - etl.API_RATE_BURST - 1
+    paced = paced_requests > 0 and request_times[-1] > request_times[0]
+    paced_rate = paced_requests / (request_times[-1] - request_times[0]) if paced else None
+    print(f"resume: outage {'interrupted' if interrupted else 'DID NOT INTERRUPT'} the download after "
+          f"{checkpointed_pages} checkpointed pages; {api.faults_injected} faults injected in total")
+    if paced:
+        pacing = f"at {paced_rate:.2f} requests/s beyond the burst (limit {args.rate_limit})"
+    else:
+        pacing = (f"PACING NOT MEASURED: no more requests than the burst of {etl.API_RATE_BURST}; "
+                  f"raise --studies or lower --fail-at")
+    print(f"resume: {resumed_requests} requests to finish against {full_requests} for a full download, "
+          f"{elapsed:.2f}s {pacing}")
+    print(f"resume: studies.ndjson {'matches' if identical else 'DIFFERS FROM'} an uninterrupted download, "
+          f"{len(set(expected_ids) - set(downloaded_ids))} missing, checkpoints {'cleared' if cleared else 'LEFT BEHIND'}")
+    return (interrupted and identical and cleared and resumed_requests < full_requests
+            and paced and paced_rate <= args.rate_limit * 1.05)
+
+
+def update_studies(corpus, change_rate, seed=0):
+    """
+    Simulate one month of registry updates on a synthetic corpus.
+
+    Args:
+        corpus (list): Study records, modified in place
+        change_rate (float): Fraction of studies updated
+        seed (int): Seed of the random generator
+
+    Returns:
+        int: Number of updated studies
+    """
+    rng = random.Random(seed)
+    updated = 0
+    for study in corpus:
+        if rng.random() < change_rate:
+            status = study['protocolSection']['statusModule']
+            status['overallStatus'] = rng.choice(STATUSES)
+            status['lastUpdatePostDateStruct'] = {'date': '2027-01-15'}
+            updated += 1
+    return updated
+
+
+def bench_incremental(args):
+    """Compare a full run with an incremental run after a simulated month of updates."""
+    corpus = make_corpus(args.studies, seed=args.seed)
+    corpus_by_term = split_corpus(corpus, etl.QUERY_TERMS, args.overlap, seed=args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp_dir, StandInAPI(corpus_by_term) as api:
+        cache_dir = os.path.join(tmp_dir, 'raw_cache')
+        json_file = os.path.join(tmp_dir, 'studies.ndjson')
+        csv_file = os.path.join(tmp_dir, 'studies.csv')
+        transform_cache_file = os.path.join(cache_dir, etl.TRANSFORM_CACHE_FILE)
+        seeded_cache_file = os.path.join(tmp_dir, etl.TRANSFORM_CACHE_FILE)
+
+        # First run seeds the raw and transform caches; every timed incremental transform
+        # starts from that transform cache
+        etl.download_studies(etl.MAX_PAGE_SIZE, base_url=api.url, output_file=json_file,
+                             incremental=True, cache_dir=cache_dir, rate_limit=None)
+        etl.data_preparation(json_file, csv_file, cache_dir)
+        shutil.copyfile(transform_cache_file, seeded_cache_file)
+        updated = update_studies(corpus, args.change_rate, seed=args.seed + 1)
+
+        results = {}
+        for mode in ('full', 'incremental'):
+            run_dir = os.path.join(tmp_dir, mode)
+            os.makedirs(run_dir)
+            bytes_before = api.bytes_served
+            start = time.perf_counter()
+            if mode == 'full':
+                etl.download_studies(etl.MAX_PAGE_SIZE, base_url=api.url,
+                                     output_file=os.path.join(run_dir, 'studies.ndjson'), rate_limit=None)
+            else:
+                etl.download_studies(etl.MAX_PAGE_SIZE, base_url=api.url,
+                                     output_file=os.path.join(run_dir, 'studies.ndjson'),
+                                     incremental=True, cache_dir=cache_dir, rate_limit=None)
+            download_time = time.perf_counter() - start
+            # Best of several runs, as a single transform is within the timing noise of a shared machine
+            transform_time = float('inf')
+            for _ in range(args.repeats):
+                if mode == 'incremental':
+                    shutil.copyfile(seeded_cache_file, transform_cache_file)
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()) as output:
+                    etl.data_preparation(os.path.join(run_dir, 'studies.ndjson'), os.path.join(run_dir, 'studies.csv'),
+                                         cache_dir if mode == 'incremental' else None)
+                transform_time = min(transform_time, time.perf_counter() - start)
+            print(output.getvalue(), end='')
+            results[mode] = (api.bytes_served - bytes_before, download_time, transform_time)
+
+        full_studies = list(etl.iter_studies(os.path.join(tmp_dir, 'full', 'studies.ndjson')))
+        incremental_studies = list(etl.iter_studies(os.path.join(tmp_dir, 'incremental', 'studies.ndjson')))
+        # The transformed files only differ by the Timestamp of the run
+        full_rows, incremental_rows = (etl.read_study_csv(os.path.join(tmp_dir, mode, 'studies.csv')).drop(columns='Timestamp')
+                                       for mode in ('full', 'incremental'))
+        identical_rows = full_rows.equals(incremental_rows)
+        for table in etl.CHILD_TABLE_COLUMNS:
+            full_table, incremental_table = (os.path.join(tmp_dir, mode, f"{table}.csv") for mode in ('full', 'incremental'))
+            if os.path.isfile(full_table) or os.path.isfile(incremental_table):
+                with open(full_table, 'rb') as full, open(incremental_table, 'rb') as incremental:
+                    identical_rows &= full.read() == incremental.read()
+        shutil.rmtree(cache_dir)
+
+    print(f"incremental: {updated} of {len(corpus)} studies updated")
+    for mode, (n_bytes, download_time, transform_time) in results.items():
+        print(f"{mode}: {n_bytes / 1e6:.2f} MB from the API, download {download_time:.2f}s, "
+              f"transform {transform_time:.2f}s (best of {args.repeats})")
+    identical = full_studies == incremental_studies
+    print(f"incremental: studies.ndjson {'matches' if identical else 'DIFFERS FROM'} the full download")
+    print(f"incremental: transformed rows {'match' if identical_rows else 'DIFFER FROM'} the full transform")
+    return identical and identical_rows
+
+
+def read_without_timestamp(csv_file):
+    """Content of a studies CSV with the Timestamp of its run, the same in every row, removed."""
+    timestamp = etl.read_study_csv(csv_file, usecols=['Timestamp'], nrows=1)['Timestamp']
+    with open(csv_file, 'rb') as f:
+        content = f.read()
+    return content.replace(timestamp.iloc[0].encode('utf-8'), b'') if len(timestamp) else content
+
+
+def differing_outputs(reference_dir, output_dir):
+    """
+    Compare every file written to reference_dir with the same file in output_dir.
+
+    Studies CSV files are compared without their Timestamp, every other file byte for byte.
+
+    Returns:
+        list: Relative paths of the files that are missing from output_dir or differ
+    """
+    differing = []
+    for root, _, names in os.walk(reference_dir):
+        for name in names:
+            path = os.path.relpath(os.path.join(root, name), reference_dir)
+            other = os.path.join(output_dir, path)
+            if not os.path.isfile(other):
+                differing.append(path)
+            elif name == 'studies.csv':
+                if read_without_timestamp(os.path.join(reference_dir, path)) != read_without_timestamp(other):
+                    differing.append(path)
+            else:
+                with open(os.path.join(reference_dir, path), 'rb') as f, open(other, 'rb') as g:
+                    if f.read() != g.read():
+                        differing.append(path)
+    return sorted(differing)
+
+
+def bench_workers(args):
+    """
+    Compare the output files of the sharded transform with those of the serial transform,
+    without and with a transform cache, after checking that etl.TRANSFORM_FIELDS covers
+    every field the transform reads.
+    """
+    studies = list(SyntheticCorpus(args.studies, seed=args.seed))
+    missing = check_transform_projection(studies)
+    for path in missing:
+        print(f"workers: the transform reads {path}, which etl.TRANSFORM_FIELDS does not download")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        json_file = os.path.join(tmp_dir, 'studies.ndjson')
+        etl.write_studies(iter(studies), json_file)
+
+        times = {}
+        identical = not missing
+        for workers in sorted({1, *args.workers}):
+            # Without a cache, then filling a transform cache and reading every study back from it
+            cache_dir = os.path.join(tmp_dir, f"transform_cache_{workers}")
+            for run, transform_cache_dir in (('no cache', None), ('cold cache', cache_dir), ('warm cache', cache_dir)):
+                output_dir = os.path.join(tmp_dir, f"workers_{workers}", run.replace(' ', '_'))
+                os.makedirs(output_dir)
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    etl.data_preparation(json_file, os.path.join(output_dir, 'studies.csv'), transform_cache_dir,
+                                         workers=workers, normalized_dir=os.path.join(output_dir, 'normalized'),
+                                         parquet_dir=os.path.join(output_dir, 'parquet'))
+                times[workers, run] = time.perf_counter() - start
+                differing = differing_outputs(os.path.join(tmp_dir, 'workers_1', 'no_cache'), output_dir)
+                identical &= not differing
+                print(f"workers: {workers} workers, {run} {times[workers, run]:.2f}s, "
+                      f"speedup {times[1, run] / times[workers, run]:.2f}x, "
+                      + (f"{', '.join(differing)} DIFFER FROM the serial output" if differing
+                         else "output files match the serial transform"))
+    print(f"workers: {os.cpu_count()} CPUs available")
+    return identical
+
+
+def reference_clean_unicode_text(text):
+    """clean_unicode_text as it was before the fast path and memoization."""
+    if not isinstance(text, str):
+        return ''
+    try:
+        text = html.unescape(text)
+        text = text.encode('utf-8', errors='ignore').decode('utf-8')
+        text = unicodedata.normalize('NFKC', text)
+        return text.strip()
+    except Exception:
+        return text
+
+
+def reference_standardize_date(date_str):
+    """standardize_date as it was before the hand-written parser and memoization."""
+    if isinstance(date_str, str):
+        try:
+            if len(date_str.split('-')) == 2:
+                date_str += '-01'
+            return pd.to_datetime(date_str, errors='coerce').strftime('%Y-%m-%d')
+        except Exception:
+            return ''
+    return ''
+
+
+def reference_format_title_case(text):
+    """format_title_case as it was before memoization."""
+    if not text:
+        return ""
+    return text.replace('_', ' ').title()
+
+
+EDGE_DATES = ['', '2020', '2020-02', '2020-02-29', '2021-02-29', '2020-13', '2020-13-01', '2020-1-5',
+              ' 2020-01-01', 'March 2020', '1600-01-01', '9999-12', '0000-01', None, 12]
+EDGE_TEXTS = ['', '  padded  ', 'Caf\u00e9', 'Cafe\u0301', '\uff28\uff26\uff50\uff25\uff26', 'A &amp; B',
+              '&lt;b&gt;', 'Line\n\nbreak', '\ud800lone surrogate', None, 42]
+
+
+def collect_normalizer_inputs(corpus):
+    """Gather the strings each normalizer receives while transforming a corpus."""
+    dates, texts, enums = list(EDGE_DATES), list(EDGE_TEXTS), ['', 'NOT_YET_RECRUITING', None]
+    for study in corpus:
+        protocol = study['protocolSection']
+        dates.extend(value['date'] for key, value in protocol['statusModule'].items()
+                     if key.endswith('DateStruct') and value)
+        texts.append(protocol['identificationModule']['briefTitle'])
+        texts.append(protocol['descriptionModule']['briefSummary'])
+        for location in protocol['contactsLocationsModule']['locations']:
+            texts.extend([location['facility'], location['city'], location['state'], location['country']])
+            enums.append(location['status'])
+        enums.extend([protocol['statusModule']['overallStatus'], protocol['eligibilityModule']['sex']])
+        enums.extend(protocol['designModule']['phases'])
+    return {'standardize_date': dates, 'clean_unicode_text': texts, 'format_title_case': enums}
+
+
+def bench_normalizers(args):
+    """Time the field normalizers against their previous implementations and compare outputs."""
+    inputs = collect_normalizer_inputs(make_corpus(args.studies, seed=args.seed))
+    functions = {
+        'standardize_date': (reference_standardize_date, etl.standardize_date),
+        'clean_unicode_text': (reference_clean_unicode_text, etl.clean_unicode_text),
+        'format_title_case': (reference_format_title_case, etl.format_title_case),
+    }
+    identical = True
+    for name, (reference, current) in functions.items():
+        values = inputs[name]
+        start = time.perf_counter()
+        expected = [reference(value) for value in values]
+        reference_time = time.perf_counter() - start
+        start = time.perf_counter()
+        actual = [current(value) for value in values]
+        current_time = time.perf_counter() - start
+        mismatches = [(value, e, a) for value, e, a in zip(values, expected, actual) if e != a]
+        identical = identical and not mismatches
+        print(f"{name}: {len(values)} calls, {reference_time * 1e3:.1f} ms -> {current_time * 1e3:.1f} ms "
+              f"({reference_time / current_time:.1f}x), {len(mismatches)} mismatches")
+        for value, e, a in mismatches[:5]:
+            print(f"    {value!r}: expected {e!r}, got {a!r}")
+    return identical
+
+
+def read_child_csv(csv_file):
+    """Read a child table CSV with every column as a string, blanks included."""
+    return pd.read_csv(csv_file, encoding='utf-8-sig', dtype=str, keep_default_na=False)
+
+
+def bench_normalized(args):
+    """Check that the normalized child tables decode to the values of the plain CSV files."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        normalized_dir = os.path.join(tmp_dir, 'normalized')
+        prepare_synthetic(tmp_dir, args.studies, seed=args.seed, normalized_dir=normalized_dir)
+
+        identical = True
+        for table in etl.CHILD_TABLE_COLUMNS:
+            expected = read_child_csv(os.path.join(tmp_dir, f"{table}.csv"))
+            decoded = etl.read_normalized_table(table, normalized_dir)
+            matches = decoded.astype(object).equals(expected.astype(object))
+            identical &= matches
+            print(f"normalized: {table} {'matches' if matches else 'DIFFERS FROM'} the plain CSV, {len(decoded)} rows, "
+                  f"{decoded.memory_usage(deep=True).sum() / 1e6:.1f} MB decoded against "
+                  f"{expected.memory_usage(deep=True).sum() / 1e6:.1f} MB as strings")
+        locations = read_child_csv(os.path.join(tmp_dir, 'locations.csv'))
+        print(f"normalized: locations cover {locations['zip'].str.startswith('0').sum()} zips with a leading zero "
+              f"and {(locations['status'] == '').sum()} blank statuses")
+    return identical
+
+
+def bench_parquet(args):
+    """Check that the Parquet child tables hold the same values as the CSV child tables."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        parquet_dir = os.path.join(tmp_dir, 'parquet')
+        prepare_synthetic(tmp_dir, args.studies, seed=args.seed, parquet_dir=parquet_dir)
+
+        identical = True
+        for table in etl.CHILD_TABLE_COLUMNS:
+            csv_file = os.path.join(tmp_dir, f"{table}.csv")
+            parquet_file = os.path.join(parquet_dir, f"{table}.parquet")
+            if not os.path.isfile(csv_file) or not os.path.isfile(parquet_file):
+                matches = os.path.isfile(csv_file) == os.path.isfile(parquet_file)
+                print(f"parquet: {table} {'written by neither' if matches else 'WRITTEN BY ONLY ONE'} of the writers")
+                identical &= matches
+                continue
+            start = time.perf_counter()
+            expected = read_child_csv(csv_file)
+            csv_time = time.perf_counter() - start
+            start = time.perf_counter()
+            table_rows = pq.read_table(parquet_file)
+            parquet_time = time.perf_counter() - start
+            string_schema = all(pa.types.is_string(field.type) for field in table_rows.schema)
+            matches = string_schema and table_rows.to_pandas().astype(object).equals(expected.astype(object))
+            identical &= matches
+            print(f"parquet: {table} {'matches' if matches else 'DIFFERS FROM'} the CSV, {len(expected)} rows, "
+                  f"read in {parquet_time * 1e3:.0f} ms against {csv_time * 1e3:.0f} ms, "
+                  f"{os.path.getsize(parquet_file) / 1e6:.2f} MB against {os.path.getsize(csv_file) / 1e6:.2f} MB")
+    return identical
+
+
+def snapshot_timestamp(month):
+    """
+    Timestamp of the synthetic monthly run number month, formatted like data_preparation.
+
+    Args:
+        month (int): Months since the first synthetic run
+
+    Returns:
+        str: ISO timestamp with microseconds
+    """
+    run = pd.Timestamp('2025-01-01 07:00:00') + pd.DateOffset(months=month) + pd.Timedelta(microseconds=month + 1)
+    return run.isoformat()
+
+
+def evolve_studies_csv(source_csv, target_csv, month, change_rate, seed=0, chunksize=50000):
+    """
+    Write the studies CSV of the next monthly run by changing a share of the studies.
+
+    The updated studies get a new status, enrollment, completion date or summary, and
+    a LastUpdatePostDate in that month. Every row gets the Timestamp of the run.
+
+    Args:
+        source_csv (str): Studies CSV of the previous run
+        target_csv (str): Studies CSV to write
+        month (int): Months since the first synthetic run
+        change_rate (float): Fraction of studies updated
+        seed (int): Seed of the random generator
+        chunksize (int): Rows read at a time
+
+    Returns:
+        int: Number of updated studies
+    """
+    rng = np.random.default_rng([seed, month])
+    statuses = [etl.format_title_case(status) for status in STATUSES]
+    update_date = (pd.Timestamp('2025-01-01') + pd.DateOffset(months=month)).strftime('%Y-%m-%d')
+    updated = 0
+    for i, chunk in enumerate(etl.read_study_csv(source_csv, chunksize=chunksize)):
+        changed = rng.random(len(chunk)) < change_rate
+        field = rng.integers(0, 4, len(chunk))
+        chunk.loc[changed & (field == 0), 'OverallStatus'] = rng.choice(statuses, len(chunk))[changed & (field == 0)]
+        chunk.loc[changed & (field == 1), 'EnrollmentCount'] = rng.integers(10, 5000, len(chunk))[changed & (field == 1)]
+        chunk.loc[changed & (field == 2), 'CompletionDate'] = update_date
+        chunk.loc[changed & (field == 3), 'BriefSummary'] = chunk.loc[changed & (field == 3), 'BriefSummary'] + ' Amended.'
+        chunk.loc[changed, 'LastUpdatePostDate'] = update_date
+        chunk['Timestamp'] = snapshot_timestamp(month)
+        chunk.to_csv(target_csv, mode='w' if i == 0 else 'a', header=i == 0, index=False,
+                     encoding='utf-8-sig' if i == 0 else 'utf-8')
+        updated += int(changed.sum())
+    return updated
+
+
+def prepare_synthetic(tmp_dir, n_studies, seed=0, locations=6, **options):
+    """
+    Write a synthetic raw corpus to tmp_dir and transform it with etl.data_preparation.
+
+    Args:
+        tmp_dir (str): Directory receiving studies.ndjson, studies.csv and the child tables
+        n_studies (int): Number of studies
+        seed (int): Seed of the corpus
+        locations (int): Average sites per study
+        **options: Further keyword arguments of etl.data_preparation, e.g. normalized_dir
+
+    Returns:
+        tuple: Paths of the raw studies file and of the studies CSV
+    """
+    json_file = os.path.join(tmp_dir, 'studies.ndjson')
+    csv_file = os.path.join(tmp_dir, 'studies.csv')
+    etl.write_studies(iter(SyntheticCorpus(n_studies, seed=seed, locations=locations)), json_file)
+    with contextlib.redirect_stdout(io.StringIO()):
+        etl.data_preparation(json_file, csv_file, **options)
+    return json_file, csv_file
+
+
+def make_history(studies_csv, history_dir, months, change_rate, seed=0):
+    """
+    Build a multi-month study history from the studies CSV of a first run.
+
+    Snapshot 0 is studies_csv itself; each later snapshot updates a share of the studies
+    of the previous one (see evolve_studies_csv). Snapshots are appended with
+    etl.append_to_history, so the history has the production layout.
+
+    Args:
+        studies_csv (str): Studies CSV written by etl.data_preparation
+        history_dir (str): History dataset directory to create
+        months (int): Number of snapshots in the history
+        change_rate (float): Fraction of studies updated each month
+        seed (int): Seed of the random generator
+
+    Returns:
+        str: Studies CSV of the last snapshot
+    """
+    work_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(history_dir)))
+    previous_csv = studies_csv
+    for month in range(months):
+        month_csv = os.path.join(work_dir, f"studies_{month}.csv")
+        evolve_studies_csv(previous_csv, month_csv, month, change_rate if month else 0.0, seed)
+        with contextlib.redirect_stdout(io.StringIO()):
+            etl.append_to_history(month_csv, history_dir)
+        if previous_csv != studies_csv:
+            os.remove(previous_csv)
+        previous_csv = month_csv
+    last_csv = os.path.join(os.path.dirname(os.path.abspath(history_dir)), 'studies_last.csv')
+    shutil.move(previous_csv, last_csv)
+    shutil.rmtree(work_dir)
+    return last_csv
+
+
+def make_churn_history(studies_csv, history_dir, months, change_rate, seed=0):
+    """
+    Build a multi-month study history in which, besides the values changed by
+    evolve_studies_csv, studies are added and removed and fields are blanked or filled in.
+
+    A share of the studies of studies_csv is held back from the first snapshot and added
+    over the later ones; each later snapshot also drops some studies for good, blanks the
+    Acronym or EnrollmentCount of others and fills in the blank Acronym of a few more.
+
+    Args:
+        studies_csv (str): Studies CSV written by etl.data_preparation
+        history_dir (str): History dataset directory to create
+        months (int): Number of snapshots in the history
+        change_rate (float): Fraction of studies updated, and of studies removed, each month
+        seed (int): Seed of the random generator
+
+    Returns:
+        list: Studies CSV of each snapshot, kept next to history_dir
+    """
+    work_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(history_dir)))
+    rng = np.random.default_rng([seed, months])
+    base = etl.read_study_csv(studies_csv)
+    held_back = rng.random(len(base)) < change_rate * 2
+    added = base[held_back]
+    added_per_month = [added.iloc[positions] for positions in np.array_split(np.arange(len(added)), max(months - 1, 1))]
+    previous_csv = os.path.join(work_dir, 'studies_base.csv')
+    base[~held_back].to_csv(previous_csv, index=False, encoding='utf-8-sig')
+
+    month_csvs = []
+    for month in range(months):
+        month_csv = os.path.join(work_dir, f"studies_{month}.csv")
+        evolve_studies_csv(previous_csv, month_csv, month, change_rate if month else 0.0, seed)
+        if month:
+            df = etl.read_study_csv(month_csv)
+            draw = rng.random(len(df))
+            df.loc[draw < change_rate / 2, 'Acronym'] = np.nan
+            df.loc[(draw >= change_rate / 2) & (draw < change_rate), 'EnrollmentCount'] = np.nan
+            df.loc[df['Acronym'].isna() & (rng.random(len(df)) < change_rate), 'Acronym'] = f"NEW{month}"
+            added = added_per_month[month - 1].assign(Timestamp=snapshot_timestamp(month))
+            df = pd.concat([df[rng.random(len(df)) >= change_rate / 2], added], ignore_index=True)
+            df.to_csv(month_csv, index=False, encoding='utf-8-sig')
+        with contextlib.redirect_stdout(io.StringIO()):
+            etl.append_to_history(month_csv, history_dir)
+        month_csvs.append(month_csv)
+        previous_csv = month_csv
+    return month_csvs
+
+
+def reference_generate_changes_last_n(history_path, changes_csv, n):
+    """
+    generate_changes_last_n as it was before the columnar diff: one iloc comparison per
+    row, column and consecutive pair of versions.
+
+    The history is read with etl.read_history, which replaced the read of the legacy CSV
+    file, and new and removed studies are listed in NCTId order rather than in set order.
+    """
+    df = etl.read_history(history_path)
+
+    # Ensure the Timestamp column is in datetime format
+    df['Timestamp'] = pd.to_datetime(df['Timestamp'], errors='coerce')
+
+    # Normalize relevant date columns
+    date_columns = ['StartDate', 'PrimaryCompletionDate', 'CompletionDate',
+                    'StudyFirstPostDate', 'ResultsFirstPostDate', 'LastUpdatePostDate']
+    for col in date_columns:
+        if (col in df.columns):
+            try:
+                df[col] = pd.to_datetime(df[col], format='%Y-%m-%d', errors='coerce')
+            except ValueError:
+                df[col] = pd.to_datetime(df[col], errors='coerce')
+
+    # Drop rows with null values in the Timestamp column
+    df.dropna(subset=['Timestamp'], inplace=True)
+
+    # Sort by NCTId and Timestamp
+    df.sort_values(by=['NCTId', 'Timestamp'], inplace=True)
+
+    changes = []
+
+    # Initialize changes list with required columns
+    changes_template = {
+        'NCTId': None,
+        'final_date': None,
+        'start_date': None,
+        'field_changed': None,
+        'final_value': None,
+        'start_value': None
+    }
+
+    # Identify latest NCTIds in the dataset
+    latest_data = df[df['Timestamp'] == df['Timestamp'].max()]
+    latest_nct_ids = set(latest_data['NCTId'])
+
+    # Identify NCTIds in the previous dataset
+    previous_data = df[df['Timestamp'] < df['Timestamp'].max()]
+    previous_nct_ids = set(previous_data['NCTId'])
+
+    # Identify new studies added (NCTIds that are in the latest data but not in the previous)
+    new_nct_ids = latest_nct_ids - previous_nct_ids
+    for nct_id in sorted(new_nct_ids):
+        change_entry = changes_template.copy()
+        change_entry.update({
+            'NCTId': nct_id,
+            'final_date': df[df['NCTId'] == nct_id]['Timestamp'].max(),
+            'field_changed': 'New Study Added'
+        })
+        changes.append(change_entry)
+
+    # Identify studies removed (NCTIds that are in the previous data but not in the latest)
+    removed_nct_ids = previous_nct_ids - latest_nct_ids
+    for nct_id in sorted(removed_nct_ids):
+        change_entry = changes_template.copy()
+        change_entry.update({
+            'NCTId': nct_id,
+            'start_date': df[df['NCTId'] == nct_id]['Timestamp'].max(),
+            'field_changed': 'Study Removed'
+        })
+        changes.append(change_entry)
+
+    # Group by NCTId and analyze the last N Timestamps
+    for nct_id, group in df.groupby('NCTId'):
+        if len(group) > 1:
+            # Take only the last N records per NCTId
+            group = group.tail(n).reset_index(drop=True)
+
+            # Compare each row with the next
+            for i in range(1, len(group)):
+                current_row = group.iloc[i]
+                previous_row = group.iloc[i - 1]
+
+                for column in group.columns:
+                    if column not in ['NCTId', 'Timestamp']:
+                        current_value = current_row[column]
+                        previous_value = previous_row[column]
+
+                        # Handle numeric values
+                        if pd.api.types.is_numeric_dtype(group[column]):
+                            if pd.notnull(current_value) and pd.notnull(previous_value) and current_value != previous_value:
+                                change_entry = changes_template.copy()
+                                change_entry.update({
+                                    'NCTId': nct_id,
+                                    'final_date': current_row['Timestamp'],
+                                    'start_date': previous_row['Timestamp'],
+                                    'field_changed': column,
+                                    'final_value': current_value,
+                                    'start_value': previous_value
+                                })
+                                changes.append(change_entry)
+                        # Handle date values
+                        elif pd.api.types.is_datetime64_any_dtype(group[column]):
+                            if pd.notnull(current_value) and pd.notnull(previous_value) and current_value != previous_value:
+                                change_entry = changes_template.copy()
+                                change_entry.update({
+                                    'NCTId': nct_id,
+                                    'final_date': current_row['Timestamp'],
+                                    'start_date': previous_row['Timestamp'],
+                                    'field_changed': column,
+                                    'final_value': current_value.strftime('%Y-%m-%d') if pd.notnull(current_value) else None,
+                                    'start_value': previous_value.strftime('%Y-%m-%d') if pd.notnull(previous_value) else None
+                                })
+                                changes.append(change_entry)
+                        # Handle text or other types
+                        else:
+                            # Ignore double carriage return differences
+                            if pd.notnull(current_value) and pd.notnull(previous_value):
+                                current_value_str = str(current_value).replace('\n\n', '\n')
+                                previous_value_str = str(previous_value).replace('\n\n', '\n')
+                                if current_value_str != previous_value_str:
+                                    change_entry = changes_template.copy()
+                                    change_entry.update({
+                                        'NCTId': nct_id,
+                                        'final_date': current_row['Timestamp'],
+                                        'start_date': previous_row['Timestamp'],
+                                        'field_changed': column,
+                                        'final_value': current_value_str,
+                                        'start_value': previous_value_str
+                                    })
+                                    changes.append(change_entry)
+
+    # Create DataFrame with changes, handling empty changes list
+    if not changes:
+        changes = [changes_template]  # Add a dummy row to prevent empty DataFrame issues
+
+    changes_df = pd.DataFrame(changes)
+
+    # Modify the 'field_changed' column to be more readable
+    def make_human_readable(text):
+        if pd.isna(text):
+            return "No changes detected"
+        return re.sub(r'(?<!^)(?=[A-Z])', ' ', text)
+
+    changes_df['field_changed'] = changes_df['field_changed'].apply(make_human_readable)
+
+    # Save changes to CSV
+    changes_df.to_csv(changes_csv, index=False)
+
+
+def bench_changes(args):
+    """Compare generate_changes_last_n with the per-row loop it replaced on a churning history."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        history_dir = os.path.join(tmp_dir, 'history')
+        _, csv_file = prepare_synthetic(tmp_dir, args.studies, seed=args.seed)
+        make_churn_history(csv_file, history_dir, args.months, args.change_rate, seed=args.seed)
+
+        identical = True
+        for n in args.windows:
+            reference_csv = os.path.join(tmp_dir, f"changes_reference_{n}.csv")
+            changes_csv = os.path.join(tmp_dir, f"changes_{n}.csv")
+            start = time.perf_counter()
+            reference_generate_changes_last_n(history_dir, reference_csv, n)
+            reference_time = time.perf_counter() - start
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                etl.generate_changes_last_n(history_dir, changes_csv, n)
+            current_time = time.perf_counter() - start
+            with open(reference_csv, 'rb') as reference, open(changes_csv, 'rb') as current:
+                matches = reference.read() == current.read()
+            identical &= matches
+            added, removed = (etl.make_human_readable(label) for label in ('New Study Added', 'Study Removed'))
+            kinds = read_child_csv(changes_csv)['field_changed'].value_counts()
+            print(f"changes: last {n} versions, {reference_time:.2f}s -> {current_time:.2f}s, "
+                  f"{kinds.get(added, 0)} added, {kinds.get(removed, 0)} removed, "
+                  f"{kinds.drop([added, removed], errors='ignore').sum()} field changes, "
+                  f"changes.csv {'matches' if matches else 'DIFFERS FROM'} the per-row loop")
+    return identical
+
+
+def bench_incremental_changes(args):
+    """
+    Apply the snapshots of a churning history one at a time with generate_changes_incremental
+    and compare the appended report with a full diff of the history up to each snapshot.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        history_dir = os.path.join(tmp_dir, 'history')
+        _, csv_file = prepare_synthetic(tmp_dir, args.studies, seed=args.seed)
+        month_csvs = make_churn_history(csv_file, history_dir, args.months, args.change_rate, seed=args.seed)
+
+        # The state starts from a backfill of the first snapshot
+        state_file = os.path.join(tmp_dir, 'latest_state.parquet')
+        changes_csv = os.path.join(tmp_dir, 'changes_incremental.csv')
+        first_history_dir = os.path.join(tmp_dir, 'history_first')
+        incremental_time = 0.0
+        with contextlib.redirect_stdout(io.StringIO()):
+            etl.append_to_history(month_csvs[0], first_history_dir)
+            etl.rebuild_change_state(first_history_dir, state_file)
+            for month_csv in month_csvs[1:]:
+                start = time.perf_counter()
+                etl.generate_changes_incremental(month_csv, state_file, changes_csv)
+                incremental_time += time.perf_counter() - start
+            with open(changes_csv, 'rb') as f:
+                before_rerun = f.read()
+            etl.generate_changes_incremental(month_csvs[-1], state_file, changes_csv)
+        with open(changes_csv, 'rb') as f:
+            idempotent = f.read() == before_rerun
+
+        # Full diff of the history up to each snapshot, restricted to the changes of that snapshot
+        full_time = 0.0
+        expected = []
+        for month in range(1, args.months):
+            start = time.perf_counter()
+            timestamp, previous_timestamp = (pd.Timestamp(snapshot_timestamp(m)) for m in (month, month - 1))
+            df = etl.prepare_history_frame(etl.read_history(history_dir, until=timestamp))
+            changes_df = pd.concat([etl.detect_added_removed(df), etl.diff_consecutive_versions(df)], ignore_index=True)
+            removed = changes_df['field_changed'] == 'Study Removed'
+            expected.append(changes_df[(removed & (changes_df['start_date'] == previous_timestamp))
+                                       | (~removed & (changes_df['final_date'] == timestamp))])
+            full_time += time.perf_counter() - start
+        expected_csv = os.path.join(tmp_dir, 'changes_full.csv')
+        etl.format_changes(pd.concat(expected, ignore_index=True)).to_csv(expected_csv, index=False)
+        with open(changes_csv, 'rb') as incremental, open(expected_csv, 'rb') as full:
+            identical = incremental.read() == full.read()
+        entries = len(read_child_csv(expected_csv))
+
+    print(f"incremental-changes: {args.months - 1} snapshots applied in {incremental_time:.2f}s, "
+          f"full diffs {full_time:.2f}s, {entries} changes")
+    print(f"incremental-changes: changes.csv {'matches' if identical else 'DIFFERS FROM'} the full diff, "
+          f"rerun of the last snapshot {'appended nothing' if idempotent else 'APPENDED CHANGES'}")
+    return identical and idempotent
+
+
+def normalize_missing(df):
+    """Frame with every column as objects and every missing value as None, for comparisons."""
+    df = df.reset_index(drop=True).astype(object)
+    return df.where(df.notna(), None)
+
+
+def bench_history_query(args):
+    """
+    Compare HistoryIndex.as_of and history_of with pandas filters over a plain scan of every
+    snapshot of a churning history, for random dates and NCTIds.
+    """
+    import history_query
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        history_dir = os.path.join(tmp_dir, 'history')
+        _, csv_file = prepare_synthetic(tmp_dir, args.studies, seed=args.seed)
+        make_churn_history(csv_file, history_dir, args.months, args.change_rate, seed=args.seed)
+
+        index = history_query.HistoryIndex(history_dir)
+        snapshots = etl.load_history_snapshots(history_dir)
+        versions = etl.load_history_versions(history_dir)
+        scan = etl.read_history(history_dir)
+        scan_keys = scan['Timestamp'].map({timestamp: key for key, timestamp in snapshots.items()})
+        stored_columns = [column for column in etl.HISTORY_SCHEMA.names if column != 'Timestamp']
+
+        # Dates before, between, on and after the snapshots
+        first, last = (pd.Timestamp(timestamp) for timestamp in (min(snapshots.values()), max(snapshots.values())))
+        dates = [first - pd.Timedelta(days=1), first, last, last + pd.Timedelta(days=30)]
+        dates += [first + (last - first) * rng.random() for _ in range(args.queries)]
+        mismatches = 0
+        for date in dates:
+            selected = [timestamp for timestamp in snapshots.values() if pd.Timestamp(timestamp) <= date]
+            expected = scan[scan['Timestamp'] == max(selected)] if selected else scan.iloc[0:0]
+            expected = expected.sort_values(by='NCTId')
+            if not normalize_missing(index.as_of(date)).equals(normalize_missing(expected)):
+                mismatches += 1
+                print(f"history-query: as_of({date}) differs from the snapshot scan")
+
+        # Half of the studies queried have several versions, plus one NCTId that is not in the history
+        version_counts = versions['NCTId'].value_counts().sort_index()
+        changed_ids = list(version_counts.index[version_counts > 1])
+        changed_ids = rng.sample(changed_ids, min(args.queries // 2, len(changed_ids)))
+        other_ids = rng.sample(sorted(set(version_counts.index) - set(changed_ids)), args.queries - len(changed_ids))
+        nct_ids = changed_ids + other_ids + ['NCT99999999']
+        for nct_id in nct_ids:
+            study_versions = versions[versions['NCTId'] == nct_id].sort_values(by='ValidFrom')
+            study_rows = scan[scan['NCTId'] == nct_id]
+            expected = []
+            covered = 0
+            for valid_from, valid_to in zip(study_versions['ValidFrom'], study_versions['ValidTo']):
+                # Every snapshot in [ValidFrom, ValidTo) holds this version of the study
+                keys = scan_keys[study_rows.index]
+                open_ended = not isinstance(valid_to, str)
+                valid_rows = study_rows[(keys >= valid_from) & (keys < (etl.HISTORY_OPEN_KEY if open_ended else valid_to))]
+                covered += len(valid_rows)
+                if valid_rows.empty or len(valid_rows[stored_columns].astype(str).drop_duplicates()) != 1:
+                    expected = None
+                    break
+                expected.append({**valid_rows.iloc[0].to_dict(), 'ValidFrom': snapshots[valid_from],
+                                 'ValidTo': None if open_ended else snapshots[valid_to]})
+            columns = etl.HISTORY_SCHEMA.names + ['ValidFrom', 'ValidTo']
+            if expected is None or covered != len(study_rows) or not normalize_missing(
+                    index.history_of(nct_id)).equals(normalize_missing(pd.DataFrame(expected, columns=columns))):
+                mismatches += 1
+                print(f"history-query: history_of({nct_id}) differs from the snapshot scan")
+
+    queries = len(dates) + len(nct_ids)
+    print(f"history-query: {queries - mismatches}/{queries} queries match the snapshot scan")
+    return not mismatches
+
+
+def run_pipeline(data_dir, metrics_file, stages):
+    """
+    Run etl.py as the command line does on a data directory.
+
+    Returns:
+        dict: Status of each stage of the run, from its metrics record
+    """
+    subprocess.run([sys.executable, os.path.abspath(etl.__file__), '--data-dir', data_dir,
+                    '--metrics-file', metrics_file, '--stages', *stages],
+                   check=True, stdout=subprocess.DEVNULL)
+    with open(metrics_file, 'r', encoding='utf-8') as f:
+        last_run = json.loads(f.readlines()[-1])
+    return {stage: record['status'] for stage, record in last_run['stages'].items()}
+
+
+def hash_outputs(data_dir):
+    """Content hash of every file and directory of a data directory, except the stage cache."""
+    return {name: etl.hash_path(os.path.join(data_dir, name))
+            for name in sorted(os.listdir(data_dir)) if name != etl.STAGE_CACHE_FILE}
+
+
+def bench_stage_cache(args):
+    """
+    Run the stages twice and check that the second run skips all of them and leaves the
+    outputs unchanged, then that an edited input only reruns the stages that read it.
+    """
+    stages = [stage for stage in etl.PIPELINE_STAGES if stage != 'download']
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = os.path.join(tmp_dir, 'data')
+        metrics_file = os.path.join(tmp_dir, 'metrics.jsonl')
+        membership_csv = os.path.join(data_dir, etl.COHORT_MEMBERSHIP_FILE)
+        os.makedirs(data_dir)
+        etl.write_studies(iter(SyntheticCorpus(args.studies, seed=args.seed)), os.path.join(data_dir, 'studies.ndjson'))
+        nct_ids = [f"NCT{index:08d}" for index in range(args.studies)]
+        with contextlib.redirect_stdout(io.StringIO()):
+            etl.write_cohort_membership(membership_csv, {'HFpEF': ['HFpEF']}, ['HFpEF'], [nct_ids], nct_ids)
+
+        runs = []
+        statuses = run_pipeline(data_dir, metrics_file, stages)
+        runs.append(('first run', statuses, {stage: 'ok' for stage in stages}))
+        outputs = hash_outputs(data_dir)
+
+        statuses = run_pipeline(data_dir, metrics_file, stages)
+        runs.append(('second run', statuses, {stage: 'skipped' for stage in stages}))
+        unchanged = hash_outputs(data_dir) == outputs
+
+        # A new modification time alone does not invalidate a stage, only new content does
+        os.utime(membership_csv)
+        statuses = run_pipeline(data_dir, metrics_file, stages)
+        runs.append(('membership touched', statuses, {stage: 'skipped' for stage in stages}))
+
+        with open(membership_csv, 'a', encoding='utf-8') as f:
+            f.write(f"{nct_ids[0]},Heart Failure\n")
+        statuses = run_pipeline(data_dir, metrics_file, stages)
+        runs.append(('membership edited', statuses,
+                     {stage: 'ok' if stage in ('index', 'load') else 'skipped' for stage in stages}))
+
+    passed = unchanged
+    for label, statuses, expected in runs:
+        matches = statuses == expected
+        passed &= matches
+        print(f"stage-cache: {label}: {', '.join(f'{stage} {status}' for stage, status in statuses.items())}"
+              + ('' if matches else f" (EXPECTED {', '.join(f'{stage} {status}' for stage, status in expected.items())})"))
+    print(f"stage-cache: outputs {'unchanged' if unchanged else 'CHANGED'} by the second run")
+    return passed
+
+
+def sqlite_contents(db_file):
+    """Rows of every table of an SQLite database, sorted, keyed by table name."""
+    conn = sqlite3.connect(db_file)
+    try:
+        tables = [name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")]
+        return {table: sorted(conn.execute(f"SELECT * FROM {table}"), key=repr) for table in tables}
+    finally:
+        conn.close()
+
+
+def churn_corpus(corpus, change_rate, rng, next_index, seed=0):
+    """
+    Simulate one run of registry updates on top of update_studies: some studies also lose
+    a site, some are removed from the registry and new ones are added.
+
+    Args:
+        corpus (list): Study records, updated in place
+        change_rate (float): Fraction of studies updated; half as many are removed and added
+        rng (random.Random): Random generator
+        next_index (int): Sequence number of the first added study
+        seed (int): Seed of update_studies
+
+    Returns:
+        tuple: (studies of the run, sequence number of the next added study)
+    """
+    update_studies(corpus, change_rate, seed=seed)
+    for study in corpus:
+        sites = study['protocolSection']['contactsLocationsModule']['locations']
+        if sites and rng.random() < change_rate:
+            sites.pop()
+    corpus = [study for study in corpus if rng.random() >= change_rate / 2]
+    added = int(len(corpus) * change_rate / 2)
+    corpus += [make_study(index, rng) for index in range(next_index, next_index + added)]
+    return corpus, next_index + added
+
+
+def prepare_run(run_dir, corpus, rng):
+    """
+    Write the raw file of a simulated run and transform it, with a random cohort membership.
+
+    Returns:
+        str: Main CSV file of the run; child tables and cohort membership are next to it
+    """
+    os.makedirs(run_dir)
+    json_file = os.path.join(run_dir, 'studies.ndjson')
+    csv_file = os.path.join(run_dir, 'studies.csv')
+    nct_ids = [etl.get_nct_id(study) for study in corpus]
+    with contextlib.redirect_stdout(io.StringIO()):
+        etl.write_studies(corpus, json_file)
+        etl.data_preparation(json_file, csv_file)
+        etl.write_cohort_membership(os.path.join(run_dir, etl.COHORT_MEMBERSHIP_FILE), {'HFpEF': ['HFpEF']},
+                                    ['HFpEF'], [rng.sample(nct_ids, len(nct_ids) // 2)], nct_ids)
+    return csv_file
+
+
+def bench_sqlite(args):
+    """
+    Load the SQLite store incrementally over several simulated runs and compare it after
+    each run with a store built fresh by a full load of the same files.
+    """
+    rng = random.Random(args.seed)
+    corpus = make_corpus(args.studies, seed=args.seed)
+    next_index = args.studies
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        incremental_db = os.path.join(tmp_dir, 'incremental.db')
+        identical = True
+        for run in range(args.runs):
+            if run:
+                corpus, next_index = churn_corpus(corpus, args.change_rate, rng, next_index, seed=args.seed + run)
+            run_dir = os.path.join(tmp_dir, f"run_{run}")
+            csv_file = prepare_run(run_dir, corpus, rng)
+            changes_csv = os.path.join(run_dir, 'changes.csv')
+            full_db = os.path.join(run_dir, 'full.db')
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                etl.load_sqlite(csv_file, changes_csv, incremental_db)
+                incremental_time = time.perf_counter() - start
+                start = time.perf_counter()
+                etl.load_sqlite(csv_file, changes_csv, full_db)
+                full_time = time.perf_counter() - start
+
+            incremental, full = sqlite_contents(incremental_db), sqlite_contents(full_db)
+            differing = sorted(table for table in full.keys() | incremental.keys()
+                               if incremental.get(table) != full.get(table))
+            identical &= not differing
+            print(f"sqlite: run {run}, {len(corpus)} studies, incremental load {incremental_time:.2f}s, "
+                  f"full load {full_time:.2f}s, "
+                  + (f"tables {', '.join(differing)} DIFFER FROM" if differing else "every table matches")
+                  + " the full load")
+    return identical
+
+
+def bench_aggregates(args):
+    """
+    Update the dashboard rollups incrementally over several simulated runs and compare them
+    after each run with rollups recomputed from scratch from the same files.
+    """
+    rng = random.Random(args.seed)
+    corpus = make_corpus(args.studies, seed=args.seed)
+    next_index = args.studies
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        incremental_dir = os.path.join(tmp_dir, 'aggregates')
+        identical = True
+        for run in range(args.runs):
+            if run:
+                corpus, next_index = churn_corpus(corpus, args.change_rate, rng, next_index, seed=args.seed + run)
+            run_dir = os.path.join(tmp_dir, f"run_{run}")
+            csv_file = prepare_run(run_dir, corpus, rng)
+            full_dir = os.path.join(run_dir, 'aggregates')
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                etl.materialize_aggregates(csv_file, incremental_dir)
+                incremental_time = time.perf_counter() - start
+                start = time.perf_counter()
+                etl.materialize_aggregates(csv_file, full_dir)
+                full_time = time.perf_counter() - start
+
+            differing = [name for name in differing_outputs(full_dir, incremental_dir)
+                         if name != etl.AGGREGATE_STATE_FILE]
+            identical &= not differing
+            print(f"aggregates: run {run}, {len(corpus)} studies, incremental update {incremental_time:.2f}s, "
+                  f"recompute {full_time:.2f}s, "
+                  + (f"{', '.join(differing)} DIFFER FROM" if differing else "every rollup matches")
+                  + " the recompute")
+    return identical
+
+
+def bench_generate(args):
+    """Write a synthetic raw corpus and a multi-month history to a directory."""
+    os.makedirs(args.output_dir, exist_ok=True)
+    json_file = os.path.join(args.output_dir, 'studies.ndjson')
+    csv_file = os.path.join(args.output_dir, 'studies.csv')
+    history_dir = os.path.join(args.output_dir, 'history')
+    corpus = SyntheticCorpus(args.studies, seed=args.seed, locations=args.locations, text_words=args.text_words)
+
+    start = time.perf_counter()
+    etl.write_studies(iter(corpus), json_file)
+    etl.data_preparation(json_file, csv_file, workers=args.workers)
+    if args.months:
+        shutil.rmtree(history_dir, ignore_errors=True)
+        make_history(csv_file, history_dir, args.months, args.change_rate, seed=args.seed)
+    print(f"generate: {args.studies} studies and {args.months} monthly snapshots written to "
+          f"{args.output_dir} in {time.perf_counter() - start:.1f}s")
+    return True
+
+
+def project_study(study, fields):
+    """
+    Keep only the given field paths of a study record, like the API v2 fields parameter.
+
+    Paths go through lists element by element, so
+    'protocolSection.contactsLocationsModule.locations.city' keeps the city of every site.
+
+    Args:
+        study (dict): Study record
+        fields (list): Dotted field paths
+
+    Returns:
+        dict: Projected record
+    """
+    def copy_path(target, source, keys):
+        key, rest = keys[0], keys[1:]
+        if key not in source:
+            return
+        value = source[key]
+        if not rest:
+            target[key] = value
+        elif isinstance(value, dict):
+            copy_path(target.setdefault(key, {}), value, rest)
+        elif isinstance(value, list):
+            items = target.setdefault(key, [{} for _ in value])
+            for target_item, item in zip(items, value):
+                if isinstance(item, dict):
+                    copy_path(target_item, item, rest)
+
+    projected = {}
+    for path in fields:
+        copy_path(projected, study, path.split('.'))
+    return projected
+
+
+class RecordingDict(dict):
+    """
+    Dictionary that records the dotted path of every key read through it, including keys
+    that are missing, and wraps the values it returns so nested reads are recorded too.
+    """
+
+    def __init__(self, data, path, accessed):
+        super().__init__(data)
+        self.path = path
+        self.accessed = accessed
+
+    def _wrap(self, key, value):
+        path = f"{self.path}.{key}" if self.path else key
+        self.accessed.add(path)
+        if isinstance(value, dict):
+            return RecordingDict(value, path, self.accessed)
+        if isinstance(value, list):
+            return [RecordingDict(item, path, self.accessed) if isinstance(item, dict) else item for item in value]
+        return value
+
+    def get(self, key, default=None):
+        return self._wrap(key, super().get(key, default))
+
+    def __getitem__(self, key):
+        return self._wrap(key, super().__getitem__(key))
+
+
+def fields_read_by_transform(studies):
+    """
+    Collect the field paths that etl.transform_study and the download helpers read.
+
+    Args:
+        studies (list): Study records to transform
+
+    Returns:
+        set: Leaf field paths, i.e. read paths that no other read path extends
+    """
+    accessed = set()
+    for study in studies:
+        for reader in (etl.transform_study, etl.get_nct_id, etl.get_last_update_date):
+            reader(RecordingDict(study, '', accessed))
+    return {path for path in accessed if not any(other.startswith(path + '.') for other in accessed)}
+
+
+def check_transform_projection(studies):
+    """
+    Check that the download projection covers every field the transform reads.
+
+    This is the guard against adding a field to etl.transform_study without adding it to
+    etl.TRANSFORM_FIELDS: such a field would silently come back empty from the API.
+
+    Args:
+        studies (list): Study records exercising the transform
+
+    Returns:
+        list: Field paths read by the transform but missing from etl.TRANSFORM_FIELDS
+    """
+    fields = etl.TRANSFORM_FIELDS
+    return sorted(path for path in fields_read_by_transform(studies)
+                  if not any(path == field or path.startswith(field + '.') for field in fields))
+
+
+def bench_projection(args):
+    """Check the download projection against the transform and measure what it saves."""
+    corpus = make_corpus(args.studies, seed=args.seed)
+    missing = check_transform_projection(corpus)
+    for path in missing:
+        print(f"projection: the transform reads {path}, which etl.TRANSFORM_FIELDS does not download")
+
+    projected = [project_study(study, etl.TRANSFORM_FIELDS) for study in corpus]
+    identical = all(etl.transform_study(full) == etl.transform_study(study) for full, study in zip(corpus, projected))
+    print(f"projection: transformed rows {'match' if identical else 'DIFFER FROM'} those of full records")
+
+    for name, records in (('full', corpus), ('projected', projected)):
+        payload = json.dumps({'studies': records})
+        start = time.perf_counter()
+        json.loads(payload)
+        print(f"{name}: {len(payload) / 1e6:.2f} MB, JSON parse {(time.perf_counter() - start) * 1e3:.0f} ms")
+    return not missing and identical
+
+
+def pandas_find_studies(studies, locations, membership, age_months=None, sex=None, status=None, country=None,
+                        cohort=None):
+    """
+    Reference for eligibility_search: the same query as a pandas filter and merge over the
+    CSV tables.
+
+    Args:
+        studies (pd.DataFrame): Main CSV table
+        locations (pd.DataFrame): Locations CSV table
+        membership (pd.DataFrame): Cohort membership CSV table
+        age_months, sex, status, country, cohort: Filters, as in EligibilityIndex.find
+
+    Returns:
+        list: Sorted NCTIds of the matching studies
+    """
+    matches = studies
+    if age_months is not None:
+        maximum_age = matches['MaximumAgeMonths'].where(matches['MaximumAge'].fillna('').str.strip() != '', np.inf)
+        matches = matches[(matches['MinimumAgeMonths'].fillna(0) <= age_months) & (maximum_age >= age_months)]
+    if sex is not None:
+        matches = matches[matches['Sex'].isin([sex, 'All'])]
+    if status is not None:
+        matches = matches[matches['OverallStatus'] == status]
+    if country is not None:
+        matches = matches.merge(locations.loc[locations['country'] == country, ['NCTId']].drop_duplicates(), on='NCTId')
+    if cohort is not None:
+        matches = matches.merge(membership.loc[membership['Cohort'] == cohort, ['NCTId']].drop_duplicates(), on='NCTId')
+    return sorted(matches['NCTId'].unique())
+
+
+class SubstringScan:
+    """
+    Reference for study_search: matches phrases with a regular expression over the
+    case-folded text of each indexed column of the studies CSV, study by study.
+    """
+
+    def __init__(self, csv_file):
+        studies = etl.read_study_csv(csv_file, usecols=['NCTId'] + etl.TEXT_INDEX_COLUMNS).fillna('')
+        self.texts = {nct_id: [value.casefold() for value in values] for nct_id, *values
+                      in studies[['NCTId'] + etl.TEXT_INDEX_COLUMNS].itertuples(index=False)}
+        self.nct_ids = set(self.texts)
+
+    def phrase(self, text):
+        """Studies with the words of text next to each other, in order, within one column."""
+        words = re.findall(r'\w+', text.casefold())
+        if not words:
+            return set()
+        pattern = re.compile(r'(?<!\w)' + r'\W+'.join(map(re.escape, words)) + r'(?!\w)')
+        return {nct_id for nct_id, values in self.texts.items() if any(pattern.search(value) for value in values)}
+
+
+def random_search_query(rng, scan, depth=2):
+    """
+    Build a random boolean query from the benchmark vocabulary and its expected result.
+
+    Args:
+        rng (random.Random): Random generator
+        scan (SubstringScan): Reference matcher
+        depth (int): Maximum nesting of the operators
+
+    Returns:
+        tuple: (query string, set of the NCTIds it must match)
+    """
+    if depth == 0 or rng.random() < 0.25:
+        words = rng.choices(WORDS + ['pediatric'], k=rng.choice([1, 2, 2, 3]))
+        text = ' '.join(words)
+        return (text if len(words) == 1 else f'"{text}"'), scan.phrase(text)
+    kind = rng.choice(['AND', 'implicit AND', 'OR', 'NOT', 'precedence'])
+    if kind == 'NOT':
+        query, expected = random_search_query(rng, scan, depth - 1)
+        return f"{rng.choice(['NOT ', '-'])}({query})", scan.nct_ids - expected
+    (left, left_ids), (right, right_ids) = (random_search_query(rng, scan, depth - 1) for _ in range(2))
+    if kind == 'precedence':
+        # AND binds tighter than OR
+        third, third_ids = random_search_query(rng, scan, 0)
+        return f"({left} OR {right} AND {third})", left_ids | (right_ids & third_ids)
+    if kind == 'OR':
+        return f"({left} OR {right})", left_ids | right_ids
+    return f"({left}{' AND ' if kind == 'AND' else ' '}{right})", left_ids & right_ids
+
+
+def bench_search(args):
+    """Compare full-text index queries with a regular expression scan of the studies CSV."""
+    import study_search
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index_dir = os.path.join(tmp_dir, 'text_index')
+        _, csv_file = prepare_synthetic(tmp_dir, args.studies, seed=args.seed)
+        with contextlib.redirect_stdout(io.StringIO()):
+            etl.build_text_index(csv_file, index_dir)
+        index = study_search.TextIndex(index_dir)
+        scan = SubstringScan(csv_file)
+
+        mismatches = 0
+        selective = 0
+        index_times = []
+        for _ in range(args.queries):
+            query, expected = random_search_query(rng, scan)
+            selective += 0 < len(expected) < len(scan.nct_ids)
+            start = time.perf_counter()
+            found = index.search(query)
+            index_times.append(time.perf_counter() - start)
+            if found != sorted(expected):
+                mismatches += 1
+                print(f"search: {query} returned {len(found)} studies, the scan {len(expected)}")
+
+    print(f"search: median {np.median(index_times) * 1e3:.3f} ms, p95 {np.percentile(index_times, 95) * 1e3:.3f} ms "
+          f"per query over {len(index_times)} queries")
+    print(f"search: {args.queries - mismatches}/{args.queries} queries match the scan, "
+          f"{selective} of them matching some but not all studies")
+    return not mismatches
+
+
+def bench_eligibility(args):
+    """Build the eligibility index and compare its queries with a pandas filter and merge."""
+    import eligibility_search
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as work_dir:
+        locations_csv = os.path.join(work_dir, 'locations.csv')
+        membership_csv = os.path.join(work_dir, etl.COHORT_MEMBERSHIP_FILE)
+        index_dir = os.path.join(work_dir, 'eligibility_index')
+        _, csv_file = prepare_synthetic(work_dir, args.studies, seed=args.seed, locations=args.locations)
+        nct_ids = [f"NCT{index:08d}" for index in range(args.studies)]
+        cohort_ids = [sorted(rng.sample(nct_ids, len(nct_ids) // 2)), nct_ids]
+        etl.write_cohort_membership(membership_csv, {'HFpEF': ['HFpEF'], 'Heart Failure': ['Heart Failure']},
+                                    ['HFpEF', 'Heart Failure'], cohort_ids, nct_ids)
+
+        start = time.perf_counter()
+        etl.build_eligibility_index(csv_file, locations_csv, membership_csv, index_dir)
+        print(f"eligibility: index built in {time.perf_counter() - start:.2f}s")
+        index = eligibility_search.get_index(index_dir)
+
+        studies = etl.read_study_csv(csv_file, usecols=['NCTId', 'Sex', 'OverallStatus', 'MaximumAge',
+                                                        'MinimumAgeMonths', 'MaximumAgeMonths'])
+        locations = etl.read_study_csv(locations_csv, usecols=['NCTId', 'country'])
+        membership = etl.read_study_csv(membership_csv)
+        queries = [{'age_months': rng.choice([None, rng.randint(18, 95) * 12]),
+                    'sex': rng.choice([None, 'Female', 'Male']),
+                    'status': rng.choice([None] + [etl.format_title_case(status) for status in STATUSES]),
+                    'country': rng.choice([None] + COUNTRIES),
+                    'cohort': rng.choice([None, 'HFpEF'])} for _ in range(args.queries)]
+
+        mismatches = 0
+        index_times = []
+        pandas_times = []
+        for query in queries:
+            start = time.perf_counter()
+            found = index.find(**query)
+            index_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            expected = pandas_find_studies(studies, locations, membership, **query)
+            pandas_times.append(time.perf_counter() - start)
+            if found != expected:
+                mismatches += 1
+                print(f"eligibility: {query} returned {len(found)} studies, pandas {len(expected)}")
+
+    for name, times in (('index', index_times), ('pandas', pandas_times)):
+        print(f"{name}: median {np.median(times) * 1e3:.3f} ms, p95 {np.percentile(times, 95) * 1e3:.3f} ms "
+              f"per query over {len(times)} queries")
+    print(f"eligibility: {len(queries) - mismatches}/{len(queries)} queries match pandas")
+    return not mismatches
+
+
+def filter_changes_since(changes, snapshots, since):
+    """
+    Entries of a changes report that backfill_changes reports with since.
+
+    Field changes and new studies are kept when their final_date is at or after since,
+    removed studies when the first snapshot after their last one is.
+
+    Args:
+        changes (pd.DataFrame): Changes report read with read_child_csv
+        snapshots (list): Snapshot Timestamp strings of the history, in order
+        since (str): Cut-off timestamp
+
+    Returns:
+        pd.DataFrame: Kept entries, reindexed
+    """
+    snapshot_times = pd.to_datetime(pd.Series(snapshots))
+    start_dates = pd.to_datetime(changes['start_date'].replace('', None))
+    removed_at = snapshot_times.to_numpy()[np.minimum(
+        np.searchsorted(snapshot_times.to_numpy(), start_dates.to_numpy(), side='right'), len(snapshots) - 1)]
+    removed = changes['field_changed'] == etl.make_human_readable('Study Removed')
+    changed_at = pd.to_datetime(changes['final_date'].replace('', None)).where(~removed, removed_at)
+    return changes[changed_at >= pd.Timestamp(since)].reset_index(drop=True)
+
+
+def bench_backfill(args):
+    """
+    Compare the sharded change backfill with generate_changes_last_n across worker counts
+    on a churning history, in full and from several since cut-offs.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        history_dir = os.path.join(tmp_dir, 'history')
+        _, csv_file = prepare_synthetic(tmp_dir, args.studies, seed=args.seed)
+        make_churn_history(csv_file, history_dir, args.months, args.change_rate, seed=args.seed)
+
+        reference_csv = os.path.join(tmp_dir, 'changes_reference.csv')
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            etl.generate_changes_last_n(history_dir, reference_csv, args.window)
+        reference_time = time.perf_counter() - start
+        print(f"backfill: generate_changes_last_n {reference_time:.2f}s")
+        reference = read_child_csv(reference_csv)
+
+        # The second snapshot, a date between two snapshots and the latest snapshot
+        snapshots = sorted(etl.load_history_snapshots(history_dir).values())
+        middle = pd.Timestamp(snapshots[len(snapshots) // 2]) - pd.Timedelta(days=1)
+        cutoffs = [None] + sorted({snapshots[min(1, len(snapshots) - 1)], middle.isoformat(), snapshots[-1]})
+
+        identical = True
+        for since in cutoffs:
+            expected = reference if since is None else filter_changes_since(reference, snapshots, since)
+            times = {}
+            for workers in args.workers:
+                changes_csv = os.path.join(tmp_dir, f"changes_{workers}.csv")
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    etl.backfill_changes(history_dir, changes_csv, args.window, since=since, workers=workers)
+                times[workers] = time.perf_counter() - start
+                matches = read_child_csv(changes_csv).equals(expected)
+                identical &= matches
+                print(f"backfill: since {since or 'the first snapshot'}, {workers} workers {times[workers]:.2f}s, "
+                      f"speedup {times[min(times)] / times[workers]:.2f}x over {min(times)} worker(s), "
+                      f"{len(expected)} changes, changes.csv {'matches' if matches else 'DIFFERS FROM'} the reference")
+    print(f"backfill: {os.cpu_count()} CPUs available")
+    return identical
+
+
+def bench_delta(args):
+    """
+    Check that the delta-encoded history only rewrites the studies whose values changed,
+    when a value is nulled in one study and when the version table was hashed with an
+    older content_hash scheme.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        history_dir = os.path.join(tmp_dir, 'history')
+        _, csv_file = prepare_synthetic(tmp_dir, args.studies, seed=args.seed)
+        base = etl.read_study_csv(csv_file)
+        # Without nulls in the typed columns, so that a single null changes how pandas would type them
+        base['EnrollmentCount'] = base['EnrollmentCount'].where(base['EnrollmentCount'].notna(), '100')
+        base['HasResults'] = base['HasResults'].where(base['HasResults'].notna(), 'False')
+        first, second = base['NCTId'].iloc[0], base['NCTId'].iloc[1]
+
+        def append(month, df):
+            timestamp = f"2025-{month:02d}-01 00:00:00"
+            return etl.append_history_snapshot(history_dir, etl.to_history_table(df.assign(Timestamp=timestamp)), timestamp)
+
+        snapshots = [('first snapshot', base, len(base))]
+        snapshots.append(('EnrollmentCount nulled in one study',
+                          base.assign(EnrollmentCount=base['EnrollmentCount'].where(base['NCTId'] != first)), 1))
+        snapshots.append(('EnrollmentCount restored, HasResults nulled in another study',
+                          base.assign(HasResults=base['HasResults'].where(base['NCTId'] != second)), 2))
+        passed = True
+        for month, (label, df, expected) in enumerate(snapshots, start=1):
+            written = append(month, df)
+            passed &= written == expected
+            print(f"delta: {label}: {written} studies written, expected {expected}")
+
+        # A version table from an older hash scheme is rehashed once instead of rewriting every study
+        versions = etl.load_history_versions(history_dir)
+        versions['ContentHash'] = '0' * 16
+        table = pa.Table.from_pandas(versions.astype(object), schema=etl.HISTORY_VERSIONS_SCHEMA, preserve_index=False)
+        pq.write_table(table, os.path.join(history_dir, etl.HISTORY_VERSIONS_FILE))
+        written = append(len(snapshots) + 1, snapshots[-1][1])
+        passed &= written == 0 and etl.load_history_hash_version(history_dir) == etl.HISTORY_HASH_VERSION
+        print(f"delta: unchanged snapshot after an older hash scheme: {written} studies written, expected 0")
+    print(f"delta: {'passed' if passed else 'FAILED'}")
+    return passed
+
+
+# Stages of the suite, run in that order on the same working directory
+STAGES = ['download', 'transform', 'history_append', 'changes']
+# Regressions must exceed the baseline by the threshold plus this slack
+REGRESSION_SLACK = {'wall_s': 0.05, 'peak_rss_mb': 10.0}
+
+
+def resource_usage():
+    """
+    Resource usage of this process and its finished child processes.
+
+    Returns:
+        tuple: CPU seconds and peak RSS in MB, or None for the peak where the platform
+        has no resource module
+    """
+    if resource is None:
+        return time.process_time(), None
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+    # ru_maxrss survives exec on Linux, so a spawned process would report the peak of its
+    # parent; VmHWM only covers the current program
+    peak_kb = own.ru_maxrss
+    if os.path.isfile('/proc/self/status'):
+        with open('/proc/self/status', 'r') as f:
+            peak_kb = next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+    return cpu, max(peak_kb, children.ru_maxrss) / 1024
+
+
+def stage_process(function_name, args, kwargs, results):
+    """Run one etl function in a fresh interpreter and report its timings and peak memory."""
+    function = getattr(etl, function_name)
+    cpu_before, rss_before = resource_usage()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        function(*args, **kwargs)
+    wall = time.perf_counter() - start
+    cpu_after, peak_rss = resource_usage()
+    results.put({'wall_s': round(wall, 3), 'cpu_s': round(cpu_after - cpu_before, 3),
+                 'peak_rss_mb': peak_rss if peak_rss is None else round(peak_rss, 1),
+                 'startup_rss_mb': rss_before if rss_before is None else round(rss_before, 1)})
+
+
+def run_stage(function_name, *args, **kwargs):
+    """
+    Run an etl function in a spawned process, so its peak RSS is not shared with other stages.
+
+    Args:
+        function_name (str): Name of the function in etl.py
+        *args, **kwargs: Arguments of the function
+
+    Returns:
+        dict: Wall and CPU seconds, peak RSS and RSS after the imports, in MB
+    """
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=stage_process, args=(function_name, args, kwargs, results))
+    process.start()
+    metrics = results.get()
+    process.join()
+    return metrics
+
+
+def bench_stages_once(n_studies, args):
+    """
+    Run every stage of the pipeline on a synthetic corpus of n_studies studies.
+
+    Args:
+        n_studies (int): Number of studies
+        args (argparse.Namespace): Options of the stages benchmark
+
+    Returns:
+        dict: Metrics of each stage
+    """
+    corpus = SyntheticCorpus(n_studies, seed=args.seed, locations=args.locations, text_words=args.text_words)
+    metrics = {}
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            StandInAPI({term: corpus for term in etl.QUERY_TERMS}, page_cache_dir=os.path.join(tmp_dir, 'pages')) as api:
+        json_file = os.path.join(tmp_dir, 'studies.ndjson')
+        csv_file = os.path.join(tmp_dir, 'studies.csv')
+        history_dir = os.path.join(tmp_dir, 'history')
+
+        # An untimed download fills the stand-in's page cache, so the timed one only measures the client
+        warmup_dir = os.path.join(tmp_dir, 'warmup')
+        with contextlib.redirect_stdout(io.StringIO()):
+            etl.download_studies(etl.MAX_PAGE_SIZE, api.url, None, os.path.join(warmup_dir, 'studies.ndjson'),
+                                 rate_limit=None)
+        shutil.rmtree(warmup_dir)
+
+        metrics['download'] = run_stage('download_studies', etl.MAX_PAGE_SIZE, api.url, None, json_file,
+                                        rate_limit=None)
+        metrics['transform'] = run_stage('data_preparation', json_file, csv_file, None, args.workers)
+
+        # The appended snapshot follows a history of args.months earlier runs
+        last_csv = make_history(csv_file, history_dir, args.months, args.change_rate, seed=args.seed)
+        current_csv = os.path.join(tmp_dir, 'studies_current.csv')
+        evolve_studies_csv(last_csv, current_csv, args.months, args.change_rate, seed=args.seed)
+        metrics['history_append'] = run_stage('append_to_history', current_csv, history_dir)
+        metrics['changes'] = run_stage('generate_changes_last_n', history_dir,
+                                       os.path.join(tmp_dir, 'changes.csv'), 10)
+    for stage in STAGES:
+        metrics[stage]['studies_per_s'] = round(n_studies / max(metrics[stage]['wall_s'], 1e-9), 1)
+    return metrics
+
+
+def format_rss(rss_mb):
+    """Format an RSS in MB, which resource_usage leaves out where the platform cannot measure it."""
+    return 'n/a' if rss_mb is None else f"{rss_mb:.0f}"
+
+
+def find_regressions(results, baseline, threshold):
+    """
+    Compare suite results against a stored baseline.
+
+    Args:
+        results (dict): Metrics by corpus size and stage
+        baseline (dict): Baseline metrics in the same layout
+        threshold (float): Allowed relative increase, e.g. 0.25 for 25%
+
+    Returns:
+        list: Descriptions of the metrics that regressed
+    """
+    regressions = []
+    for size, stages in results.items():
+        for stage, metrics in stages.items():
+            reference = baseline.get(size, {}).get(stage)
+            if reference is None:
+                continue
+            for metric, slack in REGRESSION_SLACK.items():
+                if metrics[metric] is None or reference.get(metric) is None:
+                    continue
+                limit = reference[metric] * (1 + threshold) + slack
+                if metrics[metric] > limit:
+                    regressions.append(f"{size} studies, {stage}: {metric} {metrics[metric]} "
+                                       f"> {reference[metric]} (+{threshold:.0%})")
+    return regressions
+
+
+def bench_stages(args):
+    """Time every pipeline stage at several corpus sizes and compare against a stored baseline."""
+    results = {}
+    for n_studies in args.sizes:
+        results[str(n_studies)] = bench_stages_once(n_studies, args)
+        for stage, metrics in results[str(n_studies)].items():
+            print(f"{n_studies:>8} {stage:<15} {metrics['wall_s']:>9.2f}s wall {metrics['cpu_s']:>9.2f}s cpu "
+                  f"{format_rss(metrics['peak_rss_mb']):>8} MB peak ({format_rss(metrics['startup_rss_mb'])} MB at start) "
+                  f"{metrics['studies_per_s']:>10.0f} studies/s")
+
+    if args.update_baseline:
+        stored = {'results': {}}
+        if os.path.isfile(args.baseline):
+            with open(args.baseline, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+        stored['machine'] = {'platform': platform.platform(), 'python': platform.python_version(),
+                             'cpus': os.cpu_count()}
+        stored['options'] = {'months': args.months, 'change_rate': args.change_rate, 'locations': args.locations,
+                             'text_words': args.text_words, 'workers': args.workers, 'seed': args.seed}
+        stored['results'].update(results)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(stored, f, indent=2)
+        print(f"stages: baseline written to {args.baseline}")
+        return True
+
+    if not os.path.isfile(args.baseline):
+        print(f"stages: no baseline at {args.baseline}; rerun with --update-baseline to store one")
+        return True
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)['results']
+    for size in results:
+        if size not in baseline:
+            print(f"stages: no baseline for {size} studies; rerun with --update-baseline to compare them")
+    regressions = find_regressions(results, baseline, args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    print(f"stages: {len(regressions)} regressions against {args.baseline}")
+    return not regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    download = subparsers.add_parser('download', help='paginated concurrent download against a stand-in API')
+    download.add_argument('--studies', type=int, default=5000)
+    download.add_argument('--overlap', type=float, default=0.3, help='share of studies matching every query')
+    download.add_argument('--page-size', type=int, default=etl.MAX_PAGE_SIZE)
+    download.add_argument('--max-page-size', type=int, default=1000, help='page cap enforced by the server')
+    download.add_argument('--latency', type=float, default=0.0, help='seconds added to each response')
+    download.add_argument('--seed', type=int, default=0)
+    download.set_defaults(func=bench_download)
+
+    resume = subparsers.add_parser('resume', help='interrupted and resumed download against a faulty stand-in API')
+    resume.add_argument('--studies', type=int, default=5000)
+    resume.add_argument('--overlap', type=float, default=0.3, help='share of studies matching every query')
+    resume.add_argument('--page-size', type=int, default=100)
+    resume.add_argument('--error-rate', type=float, default=0.1, help='share of requests failing with a 503 or a dropped connection')
+    resume.add_argument('--throttle-rate', type=float, default=0.05, help='share of requests answered with a 429')
+    resume.add_argument('--fail-at', type=float, default=0.8, help='share of the download served before the outage')
+    resume.add_argument('--rate-limit', type=float, default=5.0, help='requests per second of the resumed run')
+    resume.add_argument('--seed', type=int, default=0)
+    resume.set_defaults(func=bench_resume)
+
+    incremental = subparsers.add_parser('incremental', help='incremental versus full monthly run')
+    incremental.add_argument('--studies', type=int, default=5000)
+    incremental.add_argument('--overlap', type=float, default=0.3, help='share of studies matching every query')
+    incremental.add_argument('--change-rate', type=float, default=0.05, help='share of studies updated')
+    incremental.add_argument('--repeats', type=int, default=3, help='transform runs per mode, the best is reported')
+    incremental.add_argument('--seed', type=int, default=0)
+    incremental.set_defaults(func=bench_incremental)
+
+    workers = subparsers.add_parser('workers', help='sharded transform against the serial transform')
+    workers.add_argument('--studies', type=int, default=5000)
+    workers.add_argument('--workers', type=int, nargs='+', default=[2, 4])
+    workers.add_argument('--seed', type=int, default=0)
+    workers.set_defaults(func=bench_workers)
+
+    normalizers = subparsers.add_parser('normalizers', help='field normalizers against their previous versions')
+    normalizers.add_argument('--studies', type=int, default=2000)
+    normalizers.add_argument('--seed', type=int, default=0)
+    normalizers.set_defaults(func=bench_normalizers)
+
+    projection = subparsers.add_parser('projection', help='download field projection against the fields the transform reads')
+    projection.add_argument('--studies', type=int, default=2000)
+    projection.add_argument('--seed', type=int, default=0)
+    projection.set_defaults(func=bench_projection)
+
+    normalized = subparsers.add_parser('normalized', help='normalized child tables against the plain CSV files')
+    normalized.add_argument('--studies', type=int, default=2000)
+    normalized.add_argument('--seed', type=int, default=0)
+    normalized.set_defaults(func=bench_normalized)
+
+    changes = subparsers.add_parser('changes', help='columnar change detection against the per-row loop it replaced')
+    changes.add_argument('--studies', type=int, default=1000)
+    changes.add_argument('--months', type=int, default=6, help='snapshots in the history')
+    changes.add_argument('--change-rate', type=float, default=0.05, help='share of studies updated each month')
+    changes.add_argument('--windows', type=int, nargs='+', default=[1, 2, 3, 10], help='versions compared per study')
+    changes.add_argument('--seed', type=int, default=0)
+    changes.set_defaults(func=bench_changes)
+
+    incremental_changes = subparsers.add_parser('incremental-changes',
+                                                help='incremental change detection against a full diff')
+    incremental_changes.add_argument('--studies', type=int, default=2000)
+    incremental_changes.add_argument('--months', type=int, default=6, help='snapshots in the history')
+    incremental_changes.add_argument('--change-rate', type=float, default=0.05, help='share of studies updated each month')
+    incremental_changes.add_argument('--seed', type=int, default=0)
+    incremental_changes.set_defaults(func=bench_incremental_changes)
+
+    history = subparsers.add_parser('history-query', help='point-in-time history queries against a snapshot scan')
+    history.add_argument('--studies', type=int, default=2000)
+    history.add_argument('--months', type=int, default=6, help='snapshots in the history')
+    history.add_argument('--change-rate', type=float, default=0.05, help='share of studies updated each month')
+    history.add_argument('--queries', type=int, default=50, help='random dates and NCTIds queried')
+    history.add_argument('--seed', type=int, default=0)
+    history.set_defaults(func=bench_history_query)
+
+    stage_cache = subparsers.add_parser('stage-cache', help='stages skipped when their inputs are unchanged')
+    stage_cache.add_argument('--studies', type=int, default=500)
+    stage_cache.add_argument('--seed', type=int, default=0)
+    stage_cache.set_defaults(func=bench_stage_cache)
+
+    sqlite = subparsers.add_parser('sqlite', help='incremental SQLite loads against a full load')
+    sqlite.add_argument('--studies', type=int, default=2000)
+    sqlite.add_argument('--runs', type=int, default=4, help='simulated runs loaded one after the other')
+    sqlite.add_argument('--change-rate', type=float, default=0.05, help='share of studies updated each run')
+    sqlite.add_argument('--seed', type=int, default=0)
+    sqlite.set_defaults(func=bench_sqlite)
+
+    aggregates = subparsers.add_parser('aggregates', help='incremental dashboard rollups against a recompute')
+    aggregates.add_argument('--studies', type=int, default=2000)
+    aggregates.add_argument('--runs', type=int, default=4, help='simulated runs aggregated one after the other')
+    aggregates.add_argument('--change-rate', type=float, default=0.05, help='share of studies updated each run')
+    aggregates.add_argument('--seed', type=int, default=0)
+    aggregates.set_defaults(func=bench_aggregates)
+
+    parquet = subparsers.add_parser('parquet', help='Parquet child tables against the CSV child tables')
+    parquet.add_argument('--studies', type=int, default=2000)
+    parquet.add_argument('--seed', type=int, default=0)
+    parquet.set_defaults(func=bench_parquet)
+
+    generate = subparsers.add_parser('generate', help='write a synthetic raw corpus and monthly history')
+    generate.add_argument('--studies', type=int, default=10000)
+    generate.add_argument('--months', type=int, default=12, help='snapshots in the history')
+    generate.add_argument('--change-rate', type=float, default=0.05, help='share of studies updated each month')
+    generate.add_argument('--locations', type=int, default=6, help='average sites per study')
+    generate.add_argument('--text-words', type=int, default=60, help='words in each brief summary')
+    generate.add_argument('--workers', type=int, default=1)
+    generate.add_argument('--output-dir', default=os.path.join('data', 'synthetic'))
+    generate.add_argument('--seed', type=int, default=0)
+    generate.set_defaults(func=bench_generate)
+
+    search = subparsers.add_parser('search', help='full-text index queries against a regular expression scan')
+    search.add_argument('--studies', type=int, default=2000)
+    search.add_argument('--queries', type=int, default=300)
+    search.add_argument('--seed', type=int, default=0)
+    search.set_defaults(func=bench_search)
+
+    eligibility = subparsers.add_parser('eligibility', help='eligibility index queries against a pandas filter and merge')
+    eligibility.add_argument('--studies', type=int, default=10000)
+    eligibility.add_argument('--queries', type=int, default=200)
+    eligibility.add_argument('--locations', type=int, default=6, help='average sites per study')
+    eligibility.add_argument('--seed', type=int, default=0)
+    eligibility.set_defaults(func=bench_eligibility)
+
+    backfill = subparsers.add_parser('backfill', help='sharded change backfill against generate_changes_last_n')
+    backfill.add_argument('--studies', type=int, default=10000)
+    backfill.add_argument('--months', type=int, default=12, help='snapshots in the history')
+    backfill.add_argument('--change-rate', type=float, default=0.05, help='share of studies updated each month')
+    backfill.add_argument('--window', type=int, default=etl.CHANGES_WINDOW, help='snapshots compared per study')
+    backfill.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    backfill.add_argument('--seed', type=int, default=0)
+    backfill.set_defaults(func=bench_backfill)
+
+    delta = subparsers.add_parser('delta', help='studies rewritten by the delta-encoded history when one value changes')
+    delta.add_argument('--studies', type=int, default=2000)
+    delta.add_argument('--seed', type=int, default=0)
+    delta.set_defaults(func=bench_delta)
+
+    stages = subparsers.add_parser('stages', help='per-stage timings and peak memory against a baseline')
+    stages.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='corpus sizes; sizes missing from the baseline are timed but not compared')
+    stages.add_argument('--months', type=int, default=6, help='snapshots in the history before the appended one')
+    stages.add_argument('--change-rate', type=float, default=0.05, help='share of studies updated each month')
+    stages.add_argument('--locations', type=int, default=6, help='average sites per study')
+    stages.add_argument('--text-words', type=int, default=60, help='words in each brief summary')
+    stages.add_argument('--workers', type=int, default=1)
+    stages.add_argument('--baseline', default='benchmark_baseline.json')
+    stages.add_argument('--update-baseline', action='store_true', help='store these results as the baseline')
+    stages.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown or memory growth')
+    stages.add_argument('--seed', type=int, default=0)
+    stages.set_defaults(func=bench_stages)
+
+    args = parser.parse_args()
+    raise SystemExit(0 if args.func(args) else 1)
+
+
+if __name__ == '__main__':
+    main()
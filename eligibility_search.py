@@ -0,0 +1,143 @@
+"""
+Eligibility and Location Queries over the Studies
+-------------------------------------------------
+
+This module answers questions such as "recruiting HFpEF trials that accept a 78-year-old
+woman with a site in Germany" from the eligibility index written by etl.py
+(build_eligibility_index), without scanning or joining the CSV files.
+
+Every study is a document id. The accepted age range is answered from two sorted endpoint
+arrays: a study accepts an age when it ranks among the studies whose minimum age is at or
+below it and among those whose maximum age is at or above it. Sex, OverallStatus,
+every site country and every cohort are stored as posting lists of document ids, and
+expanded into one bitmap per value when the index is loaded, so a query is a few
+vectorized ANDs over the bitmaps and the age ranks.
+
+Usage:
+    from eligibility_search import find_studies
+
+    find_studies(age_years=78, sex='Female', status='Recruiting', country='Germany', cohort='HFpEF')
+"""
+import os
+
+import numpy as np
+import pyarrow.parquet as pq
+
+import etl
+
+# Sex of the participants -> values of the Sex column of the studies that accept them
+SEX_VALUES = {'female': ('female', 'all'), 'male': ('male', 'all'), 'all': ('all',)}
+
+
+def normalize_value(value):
+    """
+    Key of an attribute value in the index, so that 'RECRUITING', 'recruiting' and
+    'Recruiting' find the same studies.
+    """
+    return etl.clean_unicode_text(str(value)).replace('_', ' ').casefold()
+
+
+class EligibilityIndex:
+    """
+    In-memory view of the eligibility index: NCTIds by document id, the sorted age endpoints
+    and one bitmap per value of the categorical attributes.
+    """
+
+    def __init__(self, index_dir=etl.ELIGIBILITY_INDEX_DIR):
+        self.index_dir = index_dir
+        studies_file = os.path.join(index_dir, etl.ELIGIBILITY_STUDIES_FILE)
+        if not os.path.isfile(studies_file):
+            raise ValueError(f"{index_dir} holds no eligibility index; run the index stage of etl.py first.")
+        self.nct_ids = np.array(pq.read_table(studies_file).column('NCTId').to_pylist(), dtype=object)
+        n_studies = len(self.nct_ids)
+
+        ages = pq.read_table(os.path.join(index_dir, etl.ELIGIBILITY_AGES_FILE)).to_pydict()
+        self.minimum_sorted = np.array(ages['MinimumAgeMonths'], dtype=np.float64)
+        self.maximum_sorted = np.array(ages['MaximumAgeMonths'], dtype=np.float64)
+        self.minimum_order = np.array(ages['MinimumAgeDocIds'], dtype=np.int32)
+        self.maximum_order = np.array(ages['MaximumAgeDocIds'], dtype=np.int32)
+        # Rank of every document in each endpoint order
+        self.minimum_rank = np.empty(n_studies, dtype=np.int32)
+        self.minimum_rank[self.minimum_order] = np.arange(n_studies, dtype=np.int32)
+        self.maximum_rank = np.empty(n_studies, dtype=np.int32)
+        self.maximum_rank[self.maximum_order] = np.arange(n_studies, dtype=np.int32)
+
+        # Posting lists are stored compactly and expanded to one bitmap per value on load
+        postings = pq.read_table(os.path.join(index_dir, etl.ELIGIBILITY_POSTINGS_FILE)).to_pydict()
+        self.bitmaps = {}
+        for attribute, value, doc_ids in zip(postings['Attribute'], postings['Value'], postings['DocIds']):
+            bitmap = self.bitmaps.setdefault((attribute, normalize_value(value)), np.zeros(n_studies, dtype=bool))
+            bitmap[np.array(doc_ids, dtype=np.int32)] = True
+
+    def _bitmap(self, attribute, values):
+        """
+        Bitmap of the studies with any of the values of an attribute.
+
+        Args:
+            attribute (str): Indexed attribute (Sex, OverallStatus, Country or Cohort)
+            values (str or list): Accepted value or values
+
+        Returns:
+            numpy.ndarray: Boolean array indexed by document id
+        """
+        if isinstance(values, str):
+            values = [values]
+        bitmaps = [self.bitmaps.get((attribute, normalize_value(value))) for value in values]
+        bitmaps = [bitmap for bitmap in bitmaps if bitmap is not None]
+        if not bitmaps:
+            return np.zeros(len(self.nct_ids), dtype=bool)
+        return bitmaps[0] if len(bitmaps) == 1 else np.logical_or.reduce(bitmaps)
+
+    def find(self, age_months=None, sex=None, status=None, country=None, cohort=None):
+        """
+        Find the studies matching every given filter; filters left as None are not applied.
+
+        Args:
+            age_months (float): Age of the participant in months, within the accepted age range
+            sex (str): Sex of the participant (Female or Male); studies open to all sexes match
+            status (str or list): OverallStatus of the study, or any of a list of them
+            country (str or list): Country of at least one site, or any of a list of them
+            cohort (str or list): Cohort of the study, or any of a list of them
+
+        Returns:
+            list: Sorted NCTIds of the matching studies
+        """
+        matches = np.ones(len(self.nct_ids), dtype=bool)
+        if sex is not None:
+            matches &= self._bitmap('Sex', SEX_VALUES.get(normalize_value(sex), (sex,)))
+        for attribute, values in (('OverallStatus', status), ('Country', country), ('Cohort', cohort)):
+            if values is not None:
+                matches &= self._bitmap(attribute, values)
+        if age_months is not None:
+            # Studies ranked before the first bound have a minimum age at or below the age and
+            # studies ranked from the second one on have a maximum age at or above it
+            minimum_bound = np.searchsorted(self.minimum_sorted, age_months, side='right')
+            maximum_bound = np.searchsorted(self.maximum_sorted, age_months, side='left')
+            matches &= self.minimum_rank < minimum_bound
+            matches &= self.maximum_rank >= maximum_bound
+        # Document ids follow NCTId order, so the NCTIds come out sorted
+        return self.nct_ids[matches].tolist()
+
+
+def get_index(index_dir=etl.ELIGIBILITY_INDEX_DIR):
+    """
+    Return an EligibilityIndex for an index directory, reusing it until the index is rebuilt.
+
+    Args:
+        index_dir (str): Directory of the eligibility index
+
+    Returns:
+        EligibilityIndex: Loaded index
+    """
+    return etl.get_cached_index(EligibilityIndex, index_dir, etl.ELIGIBILITY_POSTINGS_FILE)
+
+
+def find_studies(age_years=None, age_months=None, sex=None, status=None, country=None, cohort=None,
+                 index_dir=etl.ELIGIBILITY_INDEX_DIR):
+    """
+    NCTIds of the studies matching every given filter; see EligibilityIndex.find. The age can
+    be given in years or in months.
+    """
+    if age_years is not None:
+        age_months = age_years * 12
+    return get_index(index_dir).find(age_months, sex, status, country, cohort)
@@ -3,7 +3,7 @@ ETL Pipeline for Clinical Trials Data Processing
 ---------------------------------------------
 
 This script implements an ETL (Extract, Transform, Load) pipeline for processing clinical trials data
-specifically related to Duchenne Muscular Dystrophy (DMD) from clinicaltrials.gov.
+for the cohorts of conditions configured in cohorts.json (by default HFpEF) from clinicaltrials.gov.
 
 The pipeline consists of four main components:
 1. Data Extraction: Downloads clinical trials data from clinicaltrials.gov API
@@ -15,27 +15,537 @@ Key Features:
 - Fetches clinical trial data using the clinicaltrials.gov API v2
 - Processes and standardizes various data fields including dates and measures
 - Maintains a historical record of all data changes
-- Generates detailed change logs for tracking updates
+- Generates detailed change logs for tracking updates, with a parallel backfill over the full history
 - Handles multiple data types and formats (JSON, CSV)
+- Precomputes dashboard rollups by status, phase, sponsor class, start year, country and intervention type
+- Maintains a positional full-text index over titles, summaries, outcomes and interventions
+- Builds an eligibility index over age range, sex, status, site countries and cohorts
+- Optionally loads the outputs into an indexed SQLite database (data/studies.sqlite)
+- Records per-stage timings, memory, row counts and API traffic in data/metrics.jsonl
 
 Dependencies:
 - pandas: Data manipulation and analysis
 - requests: HTTP requests to the API
+- tenacity: Retries of transient API errors
+- pyarrow: Parquet storage of the study history
 - json: JSON data processing
 - csv: CSV file operations
 - datetime: Date and time operations
 """
+import argparse
+import cProfile
+import contextlib
 import json
 import csv
 import datetime
+import functools
+import hashlib
+import html
+import io
+import itertools
+import operator
 import os
+import random
+import shutil
+import threading
+import time
+import tracemalloc
+import collections
+import concurrent.futures
 import requests
+import requests.adapters
+import tenacity
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import re
+import sqlite3
+import unicodedata
+import zlib
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# clinicaltrials.gov API v2 studies endpoint and the conditions queried for the HFpEF cohort
+API_URL = "https://clinicaltrials.gov/api/v2/studies"
+QUERY_TERMS = ["HFpEF", "Heart Failure With Preserved Ejection Fraction"]
+# API v2 field paths read by transform_study, get_nct_id and get_last_update_date; downloads
+# are projected to these fields unless full records are requested
+TRANSFORM_FIELDS = [
+    'protocolSection.identificationModule.nctId',
+    'protocolSection.identificationModule.briefTitle',
+    'protocolSection.identificationModule.acronym',
+    'protocolSection.identificationModule.orgStudyIdInfo.id',
+    'protocolSection.identificationModule.secondaryIdInfos.id',
+    'protocolSection.statusModule.overallStatus',
+    'protocolSection.statusModule.startDateStruct.date',
+    'protocolSection.statusModule.primaryCompletionDateStruct.date',
+    'protocolSection.statusModule.completionDateStruct.date',
+    'protocolSection.statusModule.studyFirstPostDateStruct.date',
+    'protocolSection.statusModule.resultsFirstPostDateStruct.date',
+    'protocolSection.statusModule.lastUpdatePostDateStruct.date',
+    'protocolSection.sponsorCollaboratorsModule.leadSponsor.name',
+    'protocolSection.sponsorCollaboratorsModule.leadSponsor.class',
+    'protocolSection.sponsorCollaboratorsModule.collaborators.name',
+    'protocolSection.sponsorCollaboratorsModule.collaborators.class',
+    'protocolSection.descriptionModule.briefSummary',
+    'protocolSection.conditionsModule.conditions',
+    'protocolSection.designModule.studyType',
+    'protocolSection.designModule.phases',
+    'protocolSection.designModule.designInfo.primaryPurpose',
+    'protocolSection.designModule.enrollmentInfo.count',
+    'protocolSection.armsInterventionsModule.interventions.type',
+    'protocolSection.armsInterventionsModule.interventions.name',
+    'protocolSection.armsInterventionsModule.interventions.description',
+    'protocolSection.armsInterventionsModule.interventions.armGroupLabels',
+    'protocolSection.armsInterventionsModule.interventions.otherNames',
+    'protocolSection.outcomesModule.primaryOutcomes.measure',
+    'protocolSection.outcomesModule.secondaryOutcomes.measure',
+    'protocolSection.eligibilityModule.sex',
+    'protocolSection.eligibilityModule.minimumAge',
+    'protocolSection.eligibilityModule.maximumAge',
+    'protocolSection.eligibilityModule.stdAges',
+    'protocolSection.contactsLocationsModule.locations.facility',
+    'protocolSection.contactsLocationsModule.locations.city',
+    'protocolSection.contactsLocationsModule.locations.state',
+    'protocolSection.contactsLocationsModule.locations.country',
+    'protocolSection.contactsLocationsModule.locations.zip',
+    'protocolSection.contactsLocationsModule.locations.status',
+    'protocolSection.contactsLocationsModule.locations.recruitmentStatus',
+    'hasResults',
+]
+# Named cohorts and their condition terms; without the file the pipeline searches QUERY_TERMS as one cohort
+COHORTS_FILE = 'cohorts.json'
+DEFAULT_COHORT = 'HFpEF'
+COHORT_MEMBERSHIP_FILE = 'cohort_membership.csv'
+COHORT_MEMBERSHIP_COLUMNS = ['NCTId', 'Cohort']
+# The API rejects or silently caps larger pages, so bigger result sets are paginated
+MAX_PAGE_SIZE = 1000
+REQUEST_TIMEOUT = 60
+# The API allows about 50 requests per minute per client; short bursts are let through
+API_RATE_LIMIT = 50 / 60
+API_RATE_BURST = 5
+# Transient errors (dropped connections, timeouts, throttling and server errors) are retried
+# with jittered exponential backoff, or after the delay of a Retry-After header
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+RETRY_ATTEMPTS = 6
+RETRY_BACKOFF = 1.0
+RETRY_MAX_WAIT = 60
+# Fetched pages are checkpointed until the download completes, so a rerun resumes where a
+# failed one stopped; checkpoints older than this are discarded instead of resumed
+DOWNLOAD_CHECKPOINT_DIR = os.path.join('data', 'download_checkpoints')
+DOWNLOAD_CHECKPOINT_MAX_AGE = 24 * 3600
+# Per-study raw cache used by the incremental download mode
+RAW_CACHE_DIR = os.path.join('data', 'raw_cache')
+RAW_CACHE_INDEX = '_index.json'
+# Number of NCTIds passed per request when fetching studies by filter.ids
+IDS_PER_REQUEST = 100
+# Transformed rows are cached in one file next to the raw records, keyed by a hash of each
+# raw record; bump TRANSFORM_VERSION whenever transform_study changes
+TRANSFORM_CACHE_FILE = '_transformed.parquet'
+TRANSFORM_VERSION = 1
+# Per-study transform cache files of earlier versions, removed when the cache is saved
+TRANSFORM_CACHE_SUFFIX = '.transformed.json'
+# Characters read at a time when streaming a legacy JSON array file
+JSON_READ_CHUNK_SIZE = 1 << 16
+# Number of studies sent to a worker process at a time by the parallel transform
+TRANSFORM_SHARD_SIZE = 200
+
+# Bounded LRU caches of the field normalizers; only strings up to CACHED_TEXT_MAX_LENGTH
+# characters are memoized by clean_unicode_text
+NORMALIZER_CACHE_SIZE = 65536
+CACHED_TEXT_MAX_LENGTH = 256
+# Date shapes published by clinicaltrials.gov: YYYY, YYYY-MM and YYYY-MM-DD
+DATE_PATTERN = re.compile(r'(\d{4})(?:-(\d{2})(?:-(\d{2}))?)?')
+PANDAS_MIN_YEAR = pd.Timestamp.min.year
+PANDAS_MAX_YEAR = pd.Timestamp.max.year
+
+# Columns of the main studies CSV file, in output order
+STUDY_COLUMNS = [
+    'NCTId', 'BriefTitle', 'Acronym', 'OverallStatus', 'BriefSummary',
+    'HasResults', 'Condition', 'InterventionType', 'InterventionName',
+    'PrimaryOutcomeMeasure', 'SecondaryOutcomeMeasure', 'LeadSponsorName',
+    'CollaboratorName', 'Sex', 'MinimumAge', 'MaximumAge', 'MinimumAgeMonths',
+    'MaximumAgeMonths', 'StdAge', 'Phase', 'EnrollmentCount', 'LeadSponsorClass',
+    'StudyType', 'DesignPrimaryPurpose', 'OrgStudyId', 'SecondaryId', 'StartDate',
+    'PrimaryCompletionDate', 'CompletionDate', 'StudyFirstPostDate',
+    'ResultsFirstPostDate', 'LastUpdatePostDate', 'Timestamp'
+]
+
+# Date columns parsed before comparing study versions
+DATE_COLUMNS = ['StartDate', 'PrimaryCompletionDate', 'CompletionDate',
+                'StudyFirstPostDate', 'ResultsFirstPostDate', 'LastUpdatePostDate']
+# Study history stored as a Parquet dataset with one snapshot=<key> partition per run
+HISTORY_DIR = os.path.join('data', 'history')
+# Non-text columns of the history; every other column, including Timestamp, is stored as a string
+HISTORY_COLUMN_TYPES = {
+    'HasResults': pa.bool_(),
+    'MinimumAgeMonths': pa.float64(),
+    'MaximumAgeMonths': pa.float64(),
+    'EnrollmentCount': pa.int64(),
+}
+HISTORY_SCHEMA = pa.schema([(column, HISTORY_COLUMN_TYPES.get(column, pa.string())) for column in STUDY_COLUMNS])
+SNAPSHOT_KEY_FORMAT = '%Y%m%dT%H%M%S%f'
+HISTORY_PARTITIONING = ds.partitioning(pa.schema([('snapshot', pa.string())]), flavor='hive')
+# Delta encoding: each partition only holds new versions; the version table records their validity
+HISTORY_VERSIONS_FILE = '_versions.parquet'
+HISTORY_SNAPSHOTS_FILE = '_snapshots.json'
+HISTORY_VERSION_COLUMNS = ['NCTId', 'ContentHash', 'ValidFrom', 'ValidTo', 'RowGroup', 'RowOffset']
+HISTORY_VERSIONS_SCHEMA = pa.schema([(column, pa.string()) for column in HISTORY_VERSION_COLUMNS[:4]]
+                                    + [('RowGroup', pa.int32()), ('RowOffset', pa.int32())])
+# Rows per Parquet row group; the version table locates each version by row group and offset
+HISTORY_ROW_GROUP_SIZE = 1000
+# Sorts after every snapshot key; stands for the ValidTo of current versions
+HISTORY_OPEN_KEY = '~'
+# Version of the content_hash scheme, stored in the metadata of the version table; the
+# ContentHash of a table written with another scheme is recomputed before appending
+HISTORY_HASH_VERSION = 2
+HISTORY_HASH_VERSION_KEY = b'content_hash_version'
+
+# Last known version of every study, used by the incremental change detection
+LATEST_STATE_FILE = os.path.join('data', 'latest_state.parquet')
+# Columns of the changes report
+CHANGES_COLUMNS = ['NCTId', 'final_date', 'start_date', 'field_changed', 'final_value', 'start_value']
+
+# Versions compared per study by the changes stage
+CHANGES_WINDOW = 10
+
+# SQLite analytical store loaded from the CSV outputs
+SQLITE_DB_FILE = os.path.join('data', 'studies.sqlite')
+SQLITE_BATCH_SIZE = 5000
+SQLITE_INDEXES = {
+    'studies': ['OverallStatus', 'Phase', 'LeadSponsorClass'],
+    'conditions': ['NCTId'],
+    'locations': ['NCTId', 'country'],
+    'interventions': ['NCTId'],
+    'sponsors_collaborators': ['NCTId'],
+    'changes': ['NCTId'],
+    'cohort_membership': ['NCTId', 'Cohort'],
+}
+
+# Dashboard rollups: one by_<dimension>.csv file of study counts and enrollment per value
+AGGREGATES_DIR = os.path.join('data', 'aggregates')
+AGGREGATE_DIMENSIONS = {
+    'status': 'OverallStatus',
+    'phase': 'Phase',
+    'sponsor_class': 'LeadSponsorClass',
+    'start_year': 'StartYear',
+    'country': 'Country',
+    'intervention_type': 'InterventionType',
+}
+# Per-study dimension values, kept to subtract the old contribution of changed studies
+AGGREGATE_STATE_FILE = '_contributions.parquet'
+
+# Rows buffered per child table before they are written out
+CHILD_TABLE_BATCH_SIZE = 1000
+
+# Optional normalized output: repeated child table values are replaced by integer keys
+# into shared dimension tables (dim_<dimension>.csv), keyed by table then column
+NORMALIZED_DIR = os.path.join('data', 'normalized')
+NORMALIZED_DIMENSIONS = {
+    'conditions': {'condition': 'conditions'},
+    'locations': {'facility': 'facilities', 'city': 'cities', 'state': 'states', 'country': 'countries',
+                  'status': 'location_statuses', 'recruitment_status': 'location_statuses'},
+    'interventions': {'type': 'intervention_types'},
+    'sponsors_collaborators': {'Sponsor': 'sponsors', 'SponsorClass': 'sponsor_classes',
+                               'Collaborator': 'sponsors', 'CollaboratorClass': 'sponsor_classes'},
+}
+
+# Full-text index: positional postings of the tokens of these columns, one row per token
+TEXT_INDEX_DIR = os.path.join('data', 'text_index')
+TEXT_INDEX_COLUMNS = ['BriefTitle', 'BriefSummary', 'PrimaryOutcomeMeasure', 'SecondaryOutcomeMeasure',
+                      'InterventionName']
+TEXT_INDEX_POSTINGS_FILE = 'postings.parquet'
+TEXT_INDEX_DOCUMENTS_FILE = 'documents.parquet'
+TOKEN_PATTERN = re.compile(r'\w+')
+# Positions skipped between two columns, so that phrases never match across columns
+TEXT_INDEX_COLUMN_GAP = 1
+
+# Eligibility index: sorted age endpoints and posting lists of the categorical attributes
+ELIGIBILITY_INDEX_DIR = os.path.join('data', 'eligibility_index')
+ELIGIBILITY_STUDIES_FILE = 'studies.parquet'
+ELIGIBILITY_AGES_FILE = 'ages.parquet'
+ELIGIBILITY_POSTINGS_FILE = 'postings.parquet'
+
+# Columns of the child tables written next to the main CSV file
+CHILD_TABLE_COLUMNS = {
+    'conditions': ['NCTId', 'condition'],
+    'locations': ['NCTId', 'facility', 'city', 'state', 'country', 'zip', 'status', 'recruitment_status'],
+    'interventions': ['NCTId', 'type', 'name', 'description', 'arm_group_labels', 'other_names'],
+    'sponsors_collaborators': ['NCTId', 'Sponsor', 'SponsorClass', 'Collaborator', 'CollaboratorClass'],
+}
+
+# Instrumentation: one JSON line of per-stage metrics is appended per run
+METRICS_FILE = os.path.join('data', 'metrics.jsonl')
+PROFILE_DIR = os.path.join('data', 'profiles')
+PIPELINE_STAGES = ['download', 'transform', 'aggregate', 'index', 'history', 'changes', 'load']
+# The load stage is optional and only runs when selected with --stages
+DEFAULT_STAGES = ['download', 'transform', 'aggregate', 'index', 'history', 'changes']
+# Allocation sites reported for stages traced with tracemalloc
+TRACEMALLOC_TOP = 10
+
+# Content hashes of the inputs and outputs of the last run of each stage, kept in the data directory
+STAGE_CACHE_FILE = '_stage_cache.json'
+HASH_CHUNK_SIZE = 1 << 20
+
+# Metrics record of the stage being run, if any; see PipelineMetrics.stage
+_active_stage = None
+_active_stage_lock = threading.Lock()
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS of this process where the platform allows it (Linux /proc/self/clear_refs).
+
+    Returns:
+        bool: Whether the peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process and of its finished child processes.
+
+    Returns:
+        float: Peak RSS in MB, or None if the platform does not report it
+    """
+    peak_kb = None
+    try:
+        with open('/proc/self/status', 'r') as f:
+            peak_kb = next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+    except (OSError, StopIteration):
+        if resource is not None:
+            peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if resource is not None:
+        peak_kb = max(peak_kb or 0, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return None if peak_kb is None else round(peak_kb / 1024, 1)
+
+def children_cpu_time():
+    """CPU seconds used by the finished child processes of this process, e.g. transform workers."""
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def record_rows(direction, path, count):
+    """
+    Record the number of rows read from or written to a file by the current stage.
+    Does nothing outside of an instrumented stage.
+
+    Args:
+        direction (str): 'rows_in' or 'rows_out'
+        path (str): File or dataset the rows were read from or written to
+        count (int): Number of rows
+    """
+    with _active_stage_lock:
+        if _active_stage is not None:
+            counts = _active_stage[direction]
+            counts[path] = counts.get(path, 0) + int(count)
+
+def record_error(error):
+    """
+    Mark the current stage as failed for an error that the stage reported and handled
+    itself. Does nothing outside of an instrumented stage.
+
+    Args:
+        error (Exception): The handled error
+    """
+    with _active_stage_lock:
+        if _active_stage is not None:
+            _active_stage['status'] = f"failed: {error!r}"
+
+def record_http(response):
+    """
+    Record the size and latency of one API response for the current stage.
+    Does nothing outside of an instrumented stage.
+
+    Args:
+        response (requests.Response): Response of the API
+    """
+    with _active_stage_lock:
+        if _active_stage is not None:
+            _active_stage['http']['bytes'] += len(response.content)
+            _active_stage['http']['latencies'].append(response.elapsed.total_seconds())
+
+class PipelineMetrics:
+    """
+    Collects the metrics of one pipeline run: wall and CPU time, peak memory, rows read
+    and written per file, and HTTP bytes and latency, for each stage run inside stage().
+
+    Stages listed in profile_stages are run under cProfile, whose stats are saved to
+    profile_dir; stages listed in trace_stages are run under tracemalloc, whose peak and
+    the top allocation sites still held at the end of the stage are added to their record.
+    """
+
+    def __init__(self, profile_stages=(), trace_stages=(), profile_dir=PROFILE_DIR):
+        self.started = datetime.datetime.now().isoformat()
+        self.stages = {}
+        self.profile_stages = set(profile_stages)
+        self.trace_stages = set(trace_stages)
+        self.profile_dir = profile_dir
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Instrument the block run inside the context as the stage called name.
+
+        Args:
+            name (str): Stage name, one of PIPELINE_STAGES
+
+        Yields:
+            dict: Metrics record of the stage
+        """
+        global _active_stage
+        record = {'status': 'ok', 'rows_in': {}, 'rows_out': {}, 'http': {'bytes': 0, 'latencies': []}}
+        profiler = cProfile.Profile() if name in self.profile_stages else None
+        tracing = name in self.trace_stages
+        if tracing:
+            tracemalloc.start()
+            tracemalloc.reset_peak()
+        peak_reset = reset_peak_rss()
+        with _active_stage_lock:
+            _active_stage = record
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time() + children_cpu_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        except BaseException as e:
+            record['status'] = f"failed: {e!r}"
+            raise
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            record['wall_s'] = round(time.perf_counter() - wall_start, 3)
+            record['cpu_s'] = round(time.process_time() + children_cpu_time() - cpu_start, 3)
+            with _active_stage_lock:
+                _active_stage = None
+            # Without a reset the peak RSS covers the run so far, not only this stage
+            record['peak_rss_mb'] = peak_rss_mb()
+            record['peak_rss_scope'] = 'stage' if peak_reset else 'process'
+            if tracing:
+                snapshot = tracemalloc.take_snapshot()
+                record['tracemalloc_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+                record['tracemalloc_top_retained'] = [f"{stat.traceback}: {stat.size / 2 ** 20:.1f} MB in {stat.count} blocks"
+                                                      for stat in snapshot.statistics('lineno')[:TRACEMALLOC_TOP]]
+                tracemalloc.stop()
+            if profiler is not None:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                profile_file = os.path.join(self.profile_dir, f"{snapshot_key(self.started)}_{name}.prof")
+                profiler.dump_stats(profile_file)
+                record['profile'] = profile_file
+            latencies = record['http'].pop('latencies')
+            record['http'].update({
+                'requests': len(latencies),
+                'latency_mean_s': round(float(np.mean(latencies)), 4) if latencies else None,
+                'latency_p95_s': round(float(np.percentile(latencies, 95)), 4) if latencies else None,
+                'latency_max_s': round(max(latencies), 4) if latencies else None,
+            })
+            self.stages[name] = record
+
+    def write(self, metrics_file=METRICS_FILE):
+        """
+        Append the metrics of the run as one JSON line.
+
+        Args:
+            metrics_file (str): Path of the JSON Lines metrics file
+        """
+        os.makedirs(os.path.dirname(metrics_file) or '.', exist_ok=True)
+        with open(metrics_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'run': self.started, 'stages': self.stages}) + '\n')
+        print(f"Metrics of {len(self.stages)} stages appended to {metrics_file}.")
+
+def hash_path(path):
+    """
+    SHA-256 content hash of a file, or of every file under a directory together with
+    its relative path.
+
+    Args:
+        path (str): File or directory
+
+    Returns:
+        str: Hex digest, or None if the path does not exist
+    """
+    if os.path.isfile(path):
+        files = [(os.path.basename(path), path)]
+    elif os.path.isdir(path):
+        files = sorted((os.path.relpath(os.path.join(root, name), path), os.path.join(root, name))
+                       for root, _, names in os.walk(path) for name in names)
+    else:
+        return None
+    digest = hashlib.sha256()
+    for relative_path, file_path in files:
+        digest.update(relative_path.encode('utf-8') + b'\0')
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+class StageCache:
+    """
+    Content hashes of the inputs, outputs and parameters of the last successful run of
+    each stage. Like make, a stage whose inputs and outputs still hash the same, with
+    the same parameters, does not need to run again.
+    """
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.entries = {}
+        if os.path.isfile(cache_file):
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+
+    def fingerprint(self, inputs, outputs, params=None):
+        return {
+            'inputs': {path: hash_path(path) for path in inputs},
+            'outputs': {path: hash_path(path) for path in outputs},
+            'params': params or {},
+        }
+
+    def is_current(self, stage, inputs, outputs, params=None):
+        """
+        Check whether a stage was last run on the same inputs and parameters and its
+        outputs were not modified since.
+
+        Args:
+            stage (str): Stage name
+            inputs (list): Files or directories read by the stage
+            outputs (list): Files or directories written by the stage
+            params (dict): Parameters that change the outputs of the stage
+
+        Returns:
+            bool: Whether the stage can be skipped
+        """
+        entry = self.entries.get(stage)
+        return entry is not None and entry == self.fingerprint(inputs, outputs, params)
+
+    def record(self, stage, inputs, outputs, params=None):
+        """
+        Save the hashes of a stage after it ran. Inputs are hashed after the run too, so a
+        file that the stage both reads and rewrites is compared with its rewritten content.
+        """
+        self.entries[stage] = self.fingerprint(inputs, outputs, params)
+        os.makedirs(os.path.dirname(self.cache_file) or '.', exist_ok=True)
+        with open(self.cache_file, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, indent=2)
 
 def clean_unicode_text(text):
     """
     Clean and normalize Unicode text by properly handling special characters.
+
+    Short strings (facility, city, country names...) repeat across studies and are
+    memoized in a bounded LRU cache; plain ASCII text without HTML entities only needs
+    stripping, since unescaping and NFKC normalization leave it unchanged.
     
     Args:
         text (str): Text that may contain Unicode characters
@@ -45,9 +555,14 @@ def clean_unicode_text(text):
     """
     if not isinstance(text, str):
         return ''
-    
+    if text.isascii() and '&' not in text:
+        return text.strip()
+    if len(text) <= CACHED_TEXT_MAX_LENGTH:
+        return _clean_unicode_text_cached(text)
+    return _clean_unicode_text(text)
+
+def _clean_unicode_text(text):
     # Handle HTML entities and common Unicode issues
-    import html
     try:
         # First unescape any HTML entities
         text = html.unescape(text)
@@ -56,7 +571,6 @@ def clean_unicode_text(text):
         text = text.encode('utf-8', errors='ignore').decode('utf-8')
         
         # Normalize to composed form (combining characters are merged)
-        import unicodedata
         text = unicodedata.normalize('NFKC', text)
         
         return text.strip()
@@ -64,79 +578,544 @@ def clean_unicode_text(text):
         print(f"Error cleaning text: {e}")
         return text
 
-def download_studies(page_size):
+_clean_unicode_text_cached = functools.lru_cache(maxsize=NORMALIZER_CACHE_SIZE)(_clean_unicode_text)
+
+def get_nct_id(study):
     """
-    Downloads clinical trials data from clinicaltrials.gov API.
-    Searches for studies related to both 'duchenne' and 'DMD' conditions.
-    
+    Extract the NCTId from a raw study record.
+
     Args:
-        page_size (int): Number of studies to retrieve
-    
+        study (dict): Study record as returned by the clinicaltrials.gov API v2
+
     Returns:
-        None. Saves downloaded data to a JSON file in the data directory.
+        str: The study NCTId, or None if the record has no identification module
     """
-    # Download studies from clinicaltrials.gov for both 'HFpEF' and 'Heart Failure With Preserved Ejection Fraction'
-    # and merge them by NCTId, removing duplicates.
-    # The parameter page_size is applied to each query independently.
-    # The '-' operator is not used in the queries.
-    base_url = "https://clinicaltrials.gov/api/v2/studies"
-    params_1 = {
-        "format": "json",
-        "pageSize": page_size,
-        "query.cond": "HFpEF",
-    }
-    params_2 = {
+    return study.get('protocolSection', {}).get('identificationModule', {}).get('nctId', None)
+
+def create_session(pool_size=10):
+    """
+    Create an HTTP session whose connection pool is shared by all download workers.
+
+    Args:
+        pool_size (int): Maximum number of pooled connections per host
+
+    Returns:
+        requests.Session: Session with keep-alive connections mounted for http and https
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def get_last_update_date(study):
+    """
+    Extract the raw LastUpdatePostDate of a study record.
+
+    Args:
+        study (dict): Study record as returned by the clinicaltrials.gov API v2
+
+    Returns:
+        str: Date string from lastUpdatePostDateStruct, or empty string if missing
+    """
+    return study.get('protocolSection', {}).get('statusModule', {}).get('lastUpdatePostDateStruct', {}).get('date', '')
+
+class TokenBucket:
+    """
+    Token-bucket rate limiter shared by the download workers.
+
+    Tokens are added at `rate` per second up to `capacity`; each request takes one and
+    waits for it when the bucket is empty, so bursts of up to `capacity` requests go out
+    immediately and the long-run rate never exceeds `rate`.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take one token, sleeping until it is available."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # The token is reserved now; a negative balance is the wait for its refill
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+class PageCheckpoints:
+    """
+    On-disk checkpoints of the result pages fetched during a download.
+
+    Each query (endpoint and parameters other than pageToken) gets its own directory of
+    numbered pages: the response body as received, and a small metadata file holding the
+    query term, the page token the page was requested with and the next page token. The
+    metadata file is written last, so only complete pages are resumed. A rerun yields the
+    stored pages and continues from the last next page token.
+    """
+
+    def __init__(self, checkpoint_dir, max_age=DOWNLOAD_CHECKPOINT_MAX_AGE):
+        self.checkpoint_dir = checkpoint_dir
+        self.max_age = max_age
+        self.resumed_pages = 0
+        self._lock = threading.Lock()
+
+    def _query_dir(self, base_url, params):
+        query = {key: value for key, value in params.items() if key != 'pageToken'}
+        key = hashlib.sha256(json.dumps([base_url, query], sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.checkpoint_dir, key)
+
+    def load(self, base_url, params):
+        """
+        Read the pages checkpointed for a query, discarding them if they are too old to resume.
+
+        Args:
+            base_url (str): Studies endpoint of the API
+            params (dict): Query parameters
+
+        Returns:
+            list: Page metadata in page order, each with the decoded response under 'data'
+        """
+        query_dir = self._query_dir(base_url, params)
+        names = sorted(name for name in os.listdir(query_dir) if name.endswith('.meta.json')) if os.path.isdir(query_dir) else []
+        pages = []
+        for name in names:
+            with open(os.path.join(query_dir, name), 'r', encoding='utf-8') as f:
+                page = json.load(f)
+            if page['page_number'] != len(pages):
+                break
+            pages.append(page)
+        if pages and time.time() - pages[0]['fetched_at'] > self.max_age:
+            shutil.rmtree(query_dir, ignore_errors=True)
+            return []
+        for page in pages:
+            with open(os.path.join(query_dir, f"{page['page_number']:06d}.json"), 'rb') as f:
+                page['data'] = json.loads(f.read())
+        with self._lock:
+            self.resumed_pages += len(pages)
+        return pages
+
+    def save(self, base_url, params, page_number, content, next_page_token):
+        """
+        Checkpoint one fetched page.
+
+        Args:
+            base_url (str): Studies endpoint of the API
+            params (dict): Query parameters the page was requested with
+            page_number (int): Position of the page in the query results
+            content (bytes): Response body of the page
+            next_page_token (str): Token of the next page, None for the last page
+        """
+        query_dir = self._query_dir(base_url, params)
+        os.makedirs(query_dir, exist_ok=True)
+        page_file = os.path.join(query_dir, f"{page_number:06d}")
+        with open(page_file + '.json', 'wb') as f:
+            f.write(content)
+        page = {'term': params.get('query.cond'), 'page_number': page_number, 'page_token': params.get('pageToken'),
+                'next_page_token': next_page_token, 'fetched_at': time.time()}
+        # Written aside and renamed, so an interrupted write never leaves a page marked complete
+        with open(page_file + '.meta.tmp', 'w', encoding='utf-8') as f:
+            json.dump(page, f)
+        os.replace(page_file + '.meta.tmp', page_file + '.meta.json')
+
+    def clear(self):
+        """Remove every checkpoint, once the download they belong to has completed."""
+        shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+
+def is_transient_error(error):
+    """
+    Whether a failed API request is worth retrying.
+
+    Args:
+        error (Exception): Exception raised by the request
+
+    Returns:
+        bool: True for connection errors, timeouts and the status codes of RETRY_STATUS_CODES
+    """
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    response = getattr(error, 'response', None)
+    return isinstance(error, requests.HTTPError) and response is not None and response.status_code in RETRY_STATUS_CODES
+
+def retry_wait(retry_state):
+    """
+    Delay before retrying a request: the server's Retry-After delay when it sent one,
+    otherwise full-jitter exponential backoff (random up to RETRY_BACKOFF * 2^attempt).
+    """
+    response = getattr(retry_state.outcome.exception(), 'response', None)
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after and retry_after.strip().isdigit():
+        return min(float(retry_after), RETRY_MAX_WAIT)
+    return random.uniform(0, min(RETRY_MAX_WAIT, RETRY_BACKOFF * 2 ** retry_state.attempt_number))
+
+def log_retry(retry_state):
+    """Report a failed request before it is retried."""
+    error = retry_state.outcome.exception()
+    response = getattr(error, 'response', None)
+    reason = f"HTTP {response.status_code}" if response is not None else type(error).__name__
+    print(f"Step 1: Retrying a request after {reason} "
+          f"(attempt {retry_state.attempt_number} of {RETRY_ATTEMPTS}).")
+
+def request_page(session, base_url, params, rate_limiter=None):
+    """
+    Requests one result page, pacing it with the rate limiter and retrying transient errors.
+
+    Args:
+        session (requests.Session): Session used for the request
+        base_url (str): Studies endpoint of the API
+        params (dict): Query parameters of the page
+        rate_limiter (TokenBucket): Limiter shared by the workers; None sends requests unpaced
+
+    Returns:
+        requests.Response: Successful response
+    """
+    for attempt in tenacity.Retrying(retry=tenacity.retry_if_exception(is_transient_error), wait=retry_wait,
+                                     stop=tenacity.stop_after_attempt(RETRY_ATTEMPTS),
+                                     before_sleep=log_retry, reraise=True):
+        with attempt:
+            if rate_limiter is not None:
+                rate_limiter.acquire()
+            response = session.get(base_url, params=params, timeout=REQUEST_TIMEOUT)
+            # Failed and retried responses count towards the HTTP metrics too
+            record_http(response)
+            response.raise_for_status()
+            return response
+
+def fetch_study_pages(session, base_url, term, page_size, extra_params=None, rate_limiter=None, checkpoints=None):
+    """
+    Iterates over every result page of a condition query, following nextPageToken.
+
+    With checkpoints, every fetched page is stored before it is yielded, and pages stored
+    by an earlier, interrupted run of the same query are yielded from disk first.
+
+    Args:
+        session (requests.Session): Session used for the requests
+        base_url (str): Studies endpoint of the API
+        term (str): Condition searched with the query.cond parameter
+        page_size (int): Number of studies requested per page
+        extra_params (dict): Additional API parameters, e.g. filters or field projections
+        rate_limiter (TokenBucket): Limiter pacing the requests; None sends them unpaced
+        checkpoints (PageCheckpoints): Page checkpoints to resume from and write to
+
+    Yields:
+        list: Studies contained in each page, in the order returned by the API
+    """
+    params = {
         "format": "json",
         "pageSize": page_size,
-        "query.cond": "Heart Failure With Preserved Ejection Fraction",
+        "query.cond": term,
     }
+    params.update(extra_params or {})
+    saved_pages = checkpoints.load(base_url, params) if checkpoints else []
+    for page in saved_pages:
+        yield page['data'].get('studies', [])
+    if saved_pages:
+        if not saved_pages[-1]['next_page_token']:
+            return
+        params['pageToken'] = saved_pages[-1]['next_page_token']
+    page_number = len(saved_pages)
+    while True:
+        response = request_page(session, base_url, params, rate_limiter)
+        data = response.json()
+        next_page_token = data.get('nextPageToken')
+        if checkpoints:
+            checkpoints.save(base_url, params, page_number, response.content, next_page_token)
+        yield data.get('studies', [])
+
+        if not next_page_token:
+            break
+        params['pageToken'] = next_page_token
+        page_number += 1
+
+def fetch_merged_studies(session, base_url, query_terms, page_size, max_workers, extra_params=None,
+                         rate_limiter=None, checkpoints=None):
+    """
+    Runs every query concurrently and merges the returned studies by NCTId as pages arrive.
+
+    When a study matches several queries the record from the first query wins, which
+    keeps the merged order deterministic regardless of which page arrives first.
+
+    Args:
+        session (requests.Session): Pooled session shared by the workers
+        base_url (str): Studies endpoint of the API
+        query_terms (list): Conditions to search
+        page_size (int): Number of studies requested per page
+        max_workers (int): Number of concurrent queries
+        extra_params (dict): Additional API parameters applied to every query
+        rate_limiter (TokenBucket): Limiter shared by the workers; None sends requests unpaced
+        checkpoints (PageCheckpoints): Page checkpoints to resume from and write to
+
+    Returns:
+        tuple: (list of unique studies in query order, list of the NCTIds returned by each query)
+    """
+    # Merged studies keyed by NCTId, each stored with its (query index, position) rank
+    studies_dict = {}
+    lock = threading.Lock()
+
+    def fetch_term(term_index, term):
+        position = 0
+        term_ids = []
+        for page in fetch_study_pages(session, base_url, term, page_size, extra_params, rate_limiter, checkpoints):
+            with lock:
+                for study in page:
+                    nctid = get_nct_id(study)
+                    if nctid:
+                        rank = (term_index, position)
+                        if nctid not in studies_dict or rank < studies_dict[nctid][0]:
+                            studies_dict[nctid] = (rank, study)
+                        term_ids.append(nctid)
+                    position += 1
+        return term_ids
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fetch_term, i, term) for i, term in enumerate(query_terms)]
+        term_ids = [future.result() for future in futures]
+
+    merged_studies = [study for _, study in sorted(studies_dict.values(), key=lambda item: item[0])]
+    return merged_studies, term_ids
+
+def load_raw_cache_index(cache_dir):
+    """
+    Load the index of the per-study raw cache.
+
+    Args:
+        cache_dir (str): Directory holding one <NCTId>.json file per cached study
+
+    Returns:
+        dict: {'watermark': last LastUpdatePostDate fetched (or None),
+               'studies': {NCTId: LastUpdatePostDate of the cached record}}
+    """
+    index_file = os.path.join(cache_dir, RAW_CACHE_INDEX)
+    if not os.path.isfile(index_file):
+        return {'watermark': None, 'studies': {}}
+    with open(index_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def update_raw_cache(cache_dir, index, studies):
+    """
+    Store raw study records in the per-study cache and record their LastUpdatePostDate.
+
+    Args:
+        cache_dir (str): Directory holding one <NCTId>.json file per cached study
+        index (dict): Cache index as returned by load_raw_cache_index, updated in place
+        studies (list): Raw study records to store
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    for study in studies:
+        nctid = get_nct_id(study)
+        with open(os.path.join(cache_dir, f"{nctid}.json"), 'w', encoding='utf-8') as f:
+            json.dump(study, f)
+        index['studies'][nctid] = get_last_update_date(study)
+
+def save_raw_cache_index(cache_dir, index):
+    """
+    Persist the raw cache index, moving the watermark to the newest LastUpdatePostDate seen.
+
+    Args:
+        cache_dir (str): Directory holding the cached studies
+        index (dict): Cache index to save
+    """
+    dates = [standardize_date(date) for date in index['studies'].values()]
+    index['watermark'] = max((date for date in dates if date), default=None)
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, RAW_CACHE_INDEX), 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+
+def read_cached_study(cache_dir, nctid):
+    """
+    Read one raw study record from the per-study cache.
+
+    Args:
+        cache_dir (str): Directory holding the cached studies
+        nctid (str): NCTId of the study
+
+    Returns:
+        dict: Raw study record
+    """
+    with open(os.path.join(cache_dir, f"{nctid}.json"), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def load_cohorts(config_file=COHORTS_FILE):
+    """
+    Loads the named cohorts searched by the pipeline.
+
+    The config file maps each cohort name to its condition terms, e.g.
+    {"HFpEF": {"terms": ["HFpEF", "Heart Failure With Preserved Ejection Fraction"]}}.
+
+    Args:
+        config_file (str): Path of the JSON cohort config
+
+    Returns:
+        dict: List of condition terms keyed by cohort name, in config order
+    """
+    if not os.path.isfile(config_file):
+        return {DEFAULT_COHORT: list(QUERY_TERMS)}
+    with open(config_file, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    cohorts = {}
+    for name, cohort in config.items():
+        terms = cohort.get('terms') if isinstance(cohort, dict) else None
+        if not terms or not all(isinstance(term, str) and term for term in terms):
+            raise ValueError(f"Cohort '{name}' in {config_file} needs a non-empty list of terms.")
+        cohorts[name] = list(terms)
+    if not cohorts:
+        raise ValueError(f"{config_file} does not define any cohort.")
+    return cohorts
+
+def write_cohort_membership(membership_file, cohorts, query_terms, term_ids, study_ids):
+    """
+    Writes the mapping of studies to the cohorts whose terms matched them.
+
+    Args:
+        membership_file (str): Path of the CSV file to write
+        cohorts (dict): Terms of each cohort
+        query_terms (list): Terms searched, in the order of term_ids
+        term_ids (list): NCTIds returned by each term
+        study_ids (list): NCTIds of the downloaded studies, in output order
+
+    Returns:
+        int: Number of (study, cohort) pairs written
+    """
+    ids_by_term = dict(zip(query_terms, (set(ids) for ids in term_ids)))
+    writer = CsvTableWriter(membership_file, COHORT_MEMBERSHIP_COLUMNS)
+    for name, terms in cohorts.items():
+        matched = set().union(*(ids_by_term[term] for term in terms))
+        writer.writerows({'NCTId': nctid, 'Cohort': name} for nctid in study_ids if nctid in matched)
+        print(f"Step 1: Cohort '{name}' has {len(matched & set(study_ids))} studies.")
+    writer.close()
+    return writer.row_count
+
+def download_studies(page_size, base_url=API_URL, query_terms=None, output_file=None, max_workers=None,
+                     incremental=False, cache_dir=RAW_CACHE_DIR, cohorts=None, full_records=False,
+                     checkpoint_dir=None, rate_limit=API_RATE_LIMIT):
+    """
+    Downloads clinical trials data from clinicaltrials.gov API.
+    Searches for studies related to each term of each cohort (by default the cohorts of
+    cohorts.json) and merges them by NCTId, so a study matching several cohorts is
+    downloaded and stored once. The cohorts each study belongs to are written to
+    cohort_membership.csv next to the output file.
+
+    The queries run concurrently over a shared pooled session and every query follows
+    nextPageToken until the last page, so no results are dropped at the server's page cap.
+    Unless full records are requested, the API only returns the fields listed in
+    TRANSFORM_FIELDS, which are all data_preparation reads.
+
+    In incremental mode a per-NCTId cache of raw study records is kept in cache_dir.
+    Once the cache holds a watermark, only the NCTIds matching the queries and the
+    studies updated since the watermark (AREA[LastUpdatePostDate]) are downloaded;
+    the output file is rebuilt from the cache plus these deltas, and studies that no
+    longer match the queries are dropped. Without a watermark a full download is made
+    and used to seed the cache.
+
+    Requests are paced by a token bucket (rate_limit per second) and transient errors are
+    retried with jittered backoff. Every fetched page is checkpointed in checkpoint_dir
+    until the download completes: if it fails, the error is raised so that no later stage
+    runs on stale data, and the next run resumes from the checkpointed pages.
+
+    Args:
+        page_size (int): Number of studies requested per page (capped at MAX_PAGE_SIZE)
+        base_url (str): Studies endpoint of the API
+        query_terms (list): Conditions to search as a single cohort; ignored when cohorts is given
+        output_file (str): Path of the raw file to write, NDJSON (.ndjson) or a JSON array (.json);
+            defaults to data/studies.ndjson
+        max_workers (int): Number of concurrent queries; defaults to one per query term
+        incremental (bool): Download only the studies updated since the last run
+        cache_dir (str): Directory of the per-study raw cache used in incremental mode
+        cohorts (dict): Condition terms keyed by cohort name; defaults to load_cohorts()
+        full_records (bool): Download complete study records instead of the TRANSFORM_FIELDS projection
+        checkpoint_dir (str): Directory of the page checkpoints; defaults to download_checkpoints
+            next to the output file
+        rate_limit (float): Maximum requests per second; None disables the rate limiter
+
+    Returns:
+        None. Saves downloaded data to a raw studies file in the data directory.
+    """
+    if cohorts is None:
+        cohorts = {DEFAULT_COHORT: list(query_terms)} if query_terms else load_cohorts()
+    # Every term of every cohort is searched once, concurrently
+    query_terms = list(dict.fromkeys(term for terms in cohorts.values() for term in terms))
+    output_file = output_file or os.path.join('data', 'studies.ndjson')
+    page_size = min(page_size, MAX_PAGE_SIZE)
+    max_workers = max_workers or len(query_terms)
+    cache_index = load_raw_cache_index(cache_dir) if incremental else None
+    projection = {} if full_records else {'fields': ','.join(TRANSFORM_FIELDS)}
+    checkpoints = PageCheckpoints(checkpoint_dir or os.path.join(os.path.dirname(output_file),
+                                                                 os.path.basename(DOWNLOAD_CHECKPOINT_DIR)))
+    rate_limiter = TokenBucket(rate_limit, API_RATE_BURST) if rate_limit else None
+    fetch = functools.partial(fetch_merged_studies, rate_limiter=rate_limiter, checkpoints=checkpoints)
 
     try:
-        response_1 = requests.get(base_url, params=params_1)
-        response_1.raise_for_status()
-        data_1 = response_1.json()
-        studies_1 = data_1.get('studies', [])
-        print(f"Step 1a: Downloaded {len(studies_1)} studies for query 'HFpEF'.")
-
-        response_2 = requests.get(base_url, params=params_2)
-        response_2.raise_for_status()
-        data_2 = response_2.json()
-        studies_2 = data_2.get('studies', [])
-        print(f"Step 1b: Downloaded {len(studies_2)} studies for query 'Heart Failure With Preserved Ejection Fraction'.")
-
-        # Merge studies by NCTId, removing duplicates
-        studies_dict = {}
-        duplicate_count = 0
-        for study in studies_1:
-            nctid = study.get('protocolSection', {}).get('identificationModule', {}).get('nctId', None)
-            if nctid:
-                studies_dict[nctid] = study
-        for study in studies_2:
-            nctid = study.get('protocolSection', {}).get('identificationModule', {}).get('nctId', None)
-            if nctid:
-                if nctid in studies_dict:
-                    duplicate_count += 1
-                else:
-                    studies_dict[nctid] = study
+        with create_session(max_workers) as session:
+            if cache_index and cache_index['watermark']:
+                watermark = cache_index['watermark']
+                # Current membership of the queries, projected down to the NCTId only
+                members, term_ids = fetch(
+                    session, base_url, query_terms, page_size, max_workers, {'fields': 'NCTId'})
+                updated_studies, _ = fetch(
+                    session, base_url, query_terms, page_size, max_workers,
+                    {'filter.advanced': f"AREA[LastUpdatePostDate]RANGE[{watermark},MAX]", **projection})
+
+                update_raw_cache(cache_dir, cache_index, updated_studies)
+                member_ids = [get_nct_id(study) for study in members]
+                # Studies that no longer match the queries are dropped from the index
+                cache_index['studies'] = {nctid: cache_index['studies'][nctid]
+                                          for nctid in member_ids if nctid in cache_index['studies']}
+                # Studies that started matching without being updated are fetched by NCTId
+                missing_ids = [nctid for nctid in member_ids if nctid not in cache_index['studies']]
+                for i in range(0, len(missing_ids), IDS_PER_REQUEST):
+                    missing_studies, _ = fetch(
+                        session, base_url, query_terms, page_size, max_workers,
+                        {'filter.ids': ','.join(missing_ids[i:i + IDS_PER_REQUEST]), **projection})
+                    update_raw_cache(cache_dir, cache_index, missing_studies)
+                print(f"Step 1: Downloaded {len(updated_studies)} studies updated since {watermark} "
+                      f"and {len(missing_ids)} newly matching studies.")
+                merged_studies = [read_cached_study(cache_dir, nctid) for nctid in member_ids
+                                  if nctid in cache_index['studies']]
+            else:
+                merged_studies, term_ids = fetch(
+                    session, base_url, query_terms, page_size, max_workers, projection)
+                if cache_index is not None:
+                    update_raw_cache(cache_dir, cache_index, merged_studies)
+
+        if checkpoints.resumed_pages:
+            print(f"Step 1: Resumed {checkpoints.resumed_pages} pages from the checkpoints of an interrupted run.")
+        for i, (term, ids) in enumerate(zip(query_terms, term_ids)):
+            print(f"Step 1{chr(ord('a') + i)}: Downloaded {len(ids)} studies for query '{term}'.")
 
-        merged_studies = list(studies_dict.values())
         unique_count = len(merged_studies)
+        duplicate_count = sum(len(ids) for ids in term_ids) - unique_count
 
         if not merged_studies:
             print("No studies found. Please try again with a different number of studies.")
+            checkpoints.clear()
             return
 
-        os.makedirs('data', exist_ok=True)
-        file_name = os.path.join('data', "studies.json")
-        with open(file_name, mode="w") as f:
-            json.dump(merged_studies, f, indent=2)
-        print(f"Step 1: Successfully downloaded and saved {unique_count} unique studies to {file_name}.")
-        print(f"Step 1: Found {duplicate_count} duplicate studies (by NCTId) between the two queries.")
+        if cache_index is not None:
+            save_raw_cache_index(cache_dir, cache_index)
+
+        os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+        write_studies(merged_studies, output_file)
+        record_rows('rows_out', output_file, unique_count)
+        membership_file = os.path.join(os.path.dirname(output_file), COHORT_MEMBERSHIP_FILE)
+        membership_count = write_cohort_membership(membership_file, cohorts, query_terms, term_ids,
+                                                   [get_nct_id(study) for study in merged_studies])
+        record_rows('rows_out', membership_file, membership_count)
+        print(f"Step 1: Successfully downloaded and saved {unique_count} unique studies to {output_file}.")
+        print(f"Step 1: Found {duplicate_count} duplicate studies (by NCTId) between the queries.")
+        checkpoints.clear()
 
     except requests.RequestException as e:
         print(f"Error in Step 1: {e}")
+        record_error(e)
         if hasattr(e, 'response') and e.response is not None:
             print(f"Response content: {e.response.text}")
+        print(f"Step 1: Fetched pages are kept in {checkpoints.checkpoint_dir}; rerun to resume the download.")
+        raise
 
 def parse_age_to_months(age_str: str) -> float:
     """
@@ -175,377 +1154,2201 @@ def parse_age_to_months(age_str: str) -> float:
         # If the unit is unrecognized, return 0
         return 0.0
 
-def data_preparation(json_file, csv_file):
+def transform_study(study):
     """
-    Transforms JSON clinical trials data into a structured CSV format and creates separate files for conditions and locations.
-    
+    Transforms one raw study record into its main CSV row and its child table rows.
+
     Args:
-        json_file (str): Path to the source JSON file
-        csv_file (str): Path where the main CSV file will be saved
-    
+        study (dict): Study record as returned by the clinicaltrials.gov API v2
+
     Returns:
-        None. Writes processed data to specified CSV files.
+        tuple: (main row without Timestamp, conditions rows, locations rows,
+                interventions rows, sponsors and collaborators rows)
     """
-    with open(json_file, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-
-    csv_columns = [
-        'NCTId', 'BriefTitle', 'Acronym', 'OverallStatus', 'BriefSummary',
-        'HasResults', 'Condition', 'InterventionType', 'InterventionName',
-        'PrimaryOutcomeMeasure', 'SecondaryOutcomeMeasure', 'LeadSponsorName',
-        'CollaboratorName', 'Sex', 'MinimumAge', 'MaximumAge', 'MinimumAgeMonths', 
-        'MaximumAgeMonths', 'StdAge', 'Phase', 'EnrollmentCount', 'LeadSponsorClass', 
-        'StudyType', 'DesignPrimaryPurpose', 'OrgStudyId', 'SecondaryId', 'StartDate', 
-        'PrimaryCompletionDate', 'CompletionDate', 'StudyFirstPostDate', 
-        'ResultsFirstPostDate', 'LastUpdatePostDate', 'Timestamp'
-    ]
-
-    # Create lists to store condition, location, and intervention mappings
-    conditions_data = []
-    locations_data = []
-    interventions_data = []
-    sponsors_collaborators_data = []  # New list for sponsors and collaborators
-
-    with open(csv_file, 'w', newline='', encoding='utf-8-sig') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=csv_columns, extrasaction='ignore')
-        writer.writeheader()
-
-        timestamp = datetime.datetime.now().isoformat()
-
-        for study in data:
-            protocol = study.get('protocolSection', {})
-            identification = protocol.get('identificationModule', {})
-            status = protocol.get('statusModule', {})
-            sponsor = protocol.get('sponsorCollaboratorsModule', {})
-            outcomes = protocol.get('outcomesModule', {})
-            interventions = protocol.get('armsInterventionsModule', {}).get('interventions', [])
-            eligibility = protocol.get('eligibilityModule', {})
-            conditions = protocol.get('conditionsModule', {})
-            design = protocol.get('designModule', {})
-            description = protocol.get('descriptionModule', {})
-            contacts_locations = protocol.get('contactsLocationsModule', {})
-
-            # Process interventions for the main CSV file
-            intervention_types = [format_title_case(i.get('type', '')) for i in interventions]
-            intervention_names = [i.get('name', '') for i in interventions]
-
-            row = {
-                'NCTId': identification.get('nctId', ''),
-                'BriefTitle': clean_unicode_text(identification.get('briefTitle', '')),
-                'Acronym': clean_unicode_text(identification.get('acronym', '')),
-                'OverallStatus': format_title_case(status.get('overallStatus', '')),
-                'BriefSummary': clean_unicode_text(description.get('briefSummary', '')),
-                'HasResults': study.get('hasResults', ''),
-                'Condition': clean_unicode_text(', '.join(conditions.get('conditions', []))),
-                'InterventionType': clean_unicode_text(', '.join(intervention_types)),
-                'InterventionName': clean_unicode_text(', '.join(intervention_names)),
-                'PrimaryOutcomeMeasure': clean_unicode_text(', '.join(o.get('measure', '') for o in outcomes.get('primaryOutcomes', []))),
-                'SecondaryOutcomeMeasure': clean_unicode_text(', '.join(o.get('measure', '') for o in outcomes.get('secondaryOutcomes', []))),
-                'LeadSponsorName': clean_unicode_text(sponsor.get('leadSponsor', {}).get('name', '')),
-                'CollaboratorName': clean_unicode_text(', '.join(c.get('name', '') for c in sponsor.get('collaborators', []))),
-                'Sex': format_title_case(eligibility.get('sex', '')),
-                'MinimumAge': eligibility.get('minimumAge', ''),
-                'MaximumAge': eligibility.get('maximumAge', ''),
-                'MinimumAgeMonths': parse_age_to_months(eligibility.get('minimumAge', '')),
-                'MaximumAgeMonths': parse_age_to_months(eligibility.get('maximumAge', '')),
-                'StdAge': ', '.join(format_title_case(age) for age in eligibility.get('stdAges', [])),
-                'Phase': ', '.join(format_title_case(phase) for phase in design.get('phases', [])),
-                'EnrollmentCount': design.get('enrollmentInfo', {}).get('count', ''),
-                'LeadSponsorClass': format_title_case(sponsor.get('leadSponsor', {}).get('class', '')),
-                'StudyType': format_title_case(design.get('studyType', '')),
-                'DesignPrimaryPurpose': format_title_case(design.get('designInfo', {}).get('primaryPurpose', '')),
-                'OrgStudyId': identification.get('orgStudyIdInfo', {}).get('id', ''),
-                'SecondaryId': clean_unicode_text(', '.join(sid.get('id', '') for sid in identification.get('secondaryIdInfos', []))),
-                'StartDate': standardize_date(status.get('startDateStruct', {}).get('date', '')),
-                'PrimaryCompletionDate': standardize_date(status.get('primaryCompletionDateStruct', {}).get('date', '')),
-                'CompletionDate': standardize_date(status.get('completionDateStruct', {}).get('date', '')),
-                'StudyFirstPostDate': standardize_date(status.get('studyFirstPostDateStruct', {}).get('date', '')),
-                'ResultsFirstPostDate': standardize_date(status.get('resultsFirstPostDateStruct', {}).get('date', '')),
-                'LastUpdatePostDate': standardize_date(status.get('lastUpdatePostDateStruct', {}).get('date', '')),
-                'Timestamp': timestamp
-            }
-            writer.writerow(row)
-
-            # Process conditions for the separate conditions file
-            nct_id = identification.get('nctId', '')
-            study_conditions = conditions.get('conditions', [])
-            for condition in study_conditions:
-                conditions_data.append({
-                    'NCTId': nct_id,
-                    'condition': condition.strip()
-                })
+    protocol = study.get('protocolSection', {})
+    identification = protocol.get('identificationModule', {})
+    status = protocol.get('statusModule', {})
+    sponsor = protocol.get('sponsorCollaboratorsModule', {})
+    outcomes = protocol.get('outcomesModule', {})
+    interventions = protocol.get('armsInterventionsModule', {}).get('interventions', [])
+    eligibility = protocol.get('eligibilityModule', {})
+    conditions = protocol.get('conditionsModule', {})
+    design = protocol.get('designModule', {})
+    description = protocol.get('descriptionModule', {})
+    contacts_locations = protocol.get('contactsLocationsModule', {})
 
-            # Process locations for the separate locations file
-            locations = contacts_locations.get('locations', [])
-            for location in locations:
-                locations_data.append({
-                    'NCTId': nct_id,
-                    'facility': clean_unicode_text(location.get('facility', '')),
-                    'city': clean_unicode_text(location.get('city', '')),
-                    'state': clean_unicode_text(location.get('state', '')),
-                    'country': clean_unicode_text(location.get('country', '')),
-                    'zip': clean_unicode_text(location.get('zip', '')),
-                    'status': format_title_case(location.get('status', '')),
-                    'recruitment_status': format_title_case(location.get('recruitmentStatus', ''))
-                })
+    # Process interventions for the main CSV file
+    intervention_types = [format_title_case(i.get('type', '')) for i in interventions]
+    intervention_names = [i.get('name', '') for i in interventions]
+
+    row = {
+        'NCTId': identification.get('nctId', ''),
+        'BriefTitle': clean_unicode_text(identification.get('briefTitle', '')),
+        'Acronym': clean_unicode_text(identification.get('acronym', '')),
+        'OverallStatus': format_title_case(status.get('overallStatus', '')),
+        'BriefSummary': clean_unicode_text(description.get('briefSummary', '')),
+        'HasResults': study.get('hasResults', ''),
+        'Condition': clean_unicode_text(', '.join(conditions.get('conditions', []))),
+        'InterventionType': clean_unicode_text(', '.join(intervention_types)),
+        'InterventionName': clean_unicode_text(', '.join(intervention_names)),
+        'PrimaryOutcomeMeasure': clean_unicode_text(', '.join(o.get('measure', '') for o in outcomes.get('primaryOutcomes', []))),
+        'SecondaryOutcomeMeasure': clean_unicode_text(', '.join(o.get('measure', '') for o in outcomes.get('secondaryOutcomes', []))),
+        'LeadSponsorName': clean_unicode_text(sponsor.get('leadSponsor', {}).get('name', '')),
+        'CollaboratorName': clean_unicode_text(', '.join(c.get('name', '') for c in sponsor.get('collaborators', []))),
+        'Sex': format_title_case(eligibility.get('sex', '')),
+        'MinimumAge': eligibility.get('minimumAge', ''),
+        'MaximumAge': eligibility.get('maximumAge', ''),
+        'MinimumAgeMonths': parse_age_to_months(eligibility.get('minimumAge', '')),
+        'MaximumAgeMonths': parse_age_to_months(eligibility.get('maximumAge', '')),
+        'StdAge': ', '.join(format_title_case(age) for age in eligibility.get('stdAges', [])),
+        'Phase': ', '.join(format_title_case(phase) for phase in design.get('phases', [])),
+        'EnrollmentCount': design.get('enrollmentInfo', {}).get('count', ''),
+        'LeadSponsorClass': format_title_case(sponsor.get('leadSponsor', {}).get('class', '')),
+        'StudyType': format_title_case(design.get('studyType', '')),
+        'DesignPrimaryPurpose': format_title_case(design.get('designInfo', {}).get('primaryPurpose', '')),
+        'OrgStudyId': identification.get('orgStudyIdInfo', {}).get('id', ''),
+        'SecondaryId': clean_unicode_text(', '.join(sid.get('id', '') for sid in identification.get('secondaryIdInfos', []))),
+        'StartDate': standardize_date(status.get('startDateStruct', {}).get('date', '')),
+        'PrimaryCompletionDate': standardize_date(status.get('primaryCompletionDateStruct', {}).get('date', '')),
+        'CompletionDate': standardize_date(status.get('completionDateStruct', {}).get('date', '')),
+        'StudyFirstPostDate': standardize_date(status.get('studyFirstPostDateStruct', {}).get('date', '')),
+        'ResultsFirstPostDate': standardize_date(status.get('resultsFirstPostDateStruct', {}).get('date', '')),
+        'LastUpdatePostDate': standardize_date(status.get('lastUpdatePostDateStruct', {}).get('date', '')),
+    }
+
+    # Process conditions for the separate conditions file
+    nct_id = identification.get('nctId', '')
+    conditions_rows = []
+    study_conditions = conditions.get('conditions', [])
+    for condition in study_conditions:
+        conditions_rows.append({
+            'NCTId': nct_id,
+            'condition': condition.strip()
+        })
 
-            # Process interventions for the separate interventions file
-            for intervention in interventions:
-                interventions_data.append({
+    # Process locations for the separate locations file
+    locations_rows = []
+    locations = contacts_locations.get('locations', [])
+    for location in locations:
+        locations_rows.append({
+            'NCTId': nct_id,
+            'facility': clean_unicode_text(location.get('facility', '')),
+            'city': clean_unicode_text(location.get('city', '')),
+            'state': clean_unicode_text(location.get('state', '')),
+            'country': clean_unicode_text(location.get('country', '')),
+            'zip': clean_unicode_text(location.get('zip', '')),
+            'status': format_title_case(location.get('status', '')),
+            'recruitment_status': format_title_case(location.get('recruitmentStatus', ''))
+        })
+
+    # Process interventions for the separate interventions file
+    interventions_rows = []
+    for intervention in interventions:
+        interventions_rows.append({
+            'NCTId': nct_id,
+            'type': format_title_case(intervention.get('type', '')),
+            'name': clean_unicode_text(intervention.get('name', '')),
+            'description': clean_unicode_text(intervention.get('description', '')),
+            'arm_group_labels': clean_unicode_text(', '.join(intervention.get('armGroupLabels', []))),
+            'other_names': clean_unicode_text(', '.join(intervention.get('otherNames', [])))
+        })
+
+    # Process sponsors and collaborators for the separate sponsors file
+    sponsors_collaborators_rows = []
+    lead_sponsor = sponsor.get('leadSponsor', {})
+    collaborators = sponsor.get('collaborators', [])
+
+    if lead_sponsor:
+        if collaborators:
+            # If there are collaborators, create a row for each collaborator
+            for collaborator in collaborators:
+                sponsors_collaborators_rows.append({
                     'NCTId': nct_id,
-                    'type': format_title_case(intervention.get('type', '')),
-                    'name': clean_unicode_text(intervention.get('name', '')),
-                    'description': clean_unicode_text(intervention.get('description', '')),
-                    'arm_group_labels': clean_unicode_text(', '.join(intervention.get('armGroupLabels', []))),
-                    'other_names': clean_unicode_text(', '.join(intervention.get('otherNames', [])))
+                    'Sponsor': clean_unicode_text(lead_sponsor.get('name', '')),
+                    'SponsorClass': format_title_case(lead_sponsor.get('class', '')),
+                    'Collaborator': clean_unicode_text(collaborator.get('name', '')),
+                    'CollaboratorClass': format_title_case(collaborator.get('class', ''))
                 })
+        else:
+            # If there are no collaborators, create a single row with empty collaborator fields
+            sponsors_collaborators_rows.append({
+                'NCTId': nct_id,
+                'Sponsor': clean_unicode_text(lead_sponsor.get('name', '')),
+                'SponsorClass': format_title_case(lead_sponsor.get('class', '')),
+                'Collaborator': '',
+                'CollaboratorClass': ''
+            })
 
-            # Process sponsors and collaborators for the separate sponsors file
-            lead_sponsor = sponsor.get('leadSponsor', {})
-            collaborators = sponsor.get('collaborators', [])
-            
-            if lead_sponsor:
-                if collaborators:
-                    # If there are collaborators, create a row for each collaborator
-                    for collaborator in collaborators:
-                        sponsors_collaborators_data.append({
-                            'NCTId': nct_id,
-                            'Sponsor': clean_unicode_text(lead_sponsor.get('name', '')),
-                            'SponsorClass': format_title_case(lead_sponsor.get('class', '')),
-                            'Collaborator': clean_unicode_text(collaborator.get('name', '')),
-                            'CollaboratorClass': format_title_case(collaborator.get('class', ''))
-                        })
-                else:
-                    # If there are no collaborators, create a single row with empty collaborator fields
-                    sponsors_collaborators_data.append({
-                        'NCTId': nct_id,
-                        'Sponsor': clean_unicode_text(lead_sponsor.get('name', '')),
-                        'SponsorClass': format_title_case(lead_sponsor.get('class', '')),
-                        'Collaborator': '',
-                        'CollaboratorClass': ''
-                    })
+    return row, conditions_rows, locations_rows, interventions_rows, sponsors_collaborators_rows
 
-    print(f"Step 2: Main data has been successfully written to {csv_file}.")
+def iter_studies(json_file):
+    """
+    Streams study records from a raw data file without loading the whole file.
 
-    # Write conditions to a separate CSV file
-    conditions_file = os.path.join(os.path.dirname(csv_file), 'conditions.csv')
-    conditions_df = pd.DataFrame(conditions_data)
-    conditions_df.to_csv(conditions_file, index=False, encoding='utf-8-sig')
-    print(f"Step 3: Conditions data has been successfully written to {conditions_file}.")
-
-    # Write locations to a separate CSV file
-    locations_file = os.path.join(os.path.dirname(csv_file), 'locations.csv')
-    locations_df = pd.DataFrame(locations_data)
-    locations_df.to_csv(locations_file, index=False, encoding='utf-8-sig')
-    print(f"Step 4: Locations data has been successfully written to {locations_file}.")
-
-    # Write interventions to a separate CSV file
-    if interventions_data:  # Only create and save if we have intervention data
-        interventions_df = pd.DataFrame(interventions_data)
-        interventions_file = os.path.join(os.path.dirname(csv_file), 'interventions.csv')
-        interventions_df.to_csv(interventions_file, index=False, encoding='utf-8-sig')
-        print(f"Step 5: Interventions data has been successfully written to {interventions_file}.")
+    NDJSON files (.ndjson, one study per line) are read line by line. Legacy JSON
+    array files are decoded incrementally, one array element at a time.
 
-    # Write sponsors and collaborators to a separate CSV file
-    sponsors_file = os.path.join(os.path.dirname(csv_file), 'sponsors_collaborators.csv')
-    sponsors_df = pd.DataFrame(sponsors_collaborators_data)
-    sponsors_df.to_csv(sponsors_file, index=False, encoding='utf-8-sig')
-    print(f"Step 6: Sponsors and collaborators data has been successfully written to {sponsors_file}.")
+    Args:
+        json_file (str): Path to the raw studies file
 
-def append_to_history(current_csv, history_csv):
+    Yields:
+        dict: One raw study record at a time, in file order
     """
-    Appends current data to the historical record.
-    
+    with open(json_file, 'r', encoding='utf-8') as f:
+        if json_file.endswith('.ndjson'):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        decoder = json.JSONDecoder()
+        buffer = ''
+        position = 0
+        started = False
+        while True:
+            # Skip whitespace, the opening bracket and separators between elements
+            while position < len(buffer) and buffer[position] in ' \t\r\n,[':
+                started = started or buffer[position] == '['
+                position += 1
+            if position < len(buffer) and buffer[position] == ']' and started:
+                return
+            try:
+                study, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                chunk = f.read(JSON_READ_CHUNK_SIZE)
+                if not chunk:
+                    if buffer[position:].strip():
+                        raise
+                    return
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield study
+            position = end
+
+def write_studies(studies, output_file):
+    """
+    Writes raw study records as NDJSON (one study per line) or as a legacy JSON array,
+    depending on the file extension.
+
     Args:
-        current_csv (str): Path to the current CSV data file
-        history_csv (str): Path to the historical CSV file
-    
-    Returns:
-        None. Appends current data to historical record.
+        studies (iterable): Raw study records
+        output_file (str): Path of the .ndjson or .json file to write
     """
-    file_exists = os.path.isfile(history_csv)
+    with open(output_file, mode="w", encoding='utf-8') as f:
+        if output_file.endswith('.ndjson'):
+            for study in studies:
+                f.write(json.dumps(study))
+                f.write('\n')
+        else:
+            json.dump(list(studies), f, indent=2)
 
-    with open(history_csv, 'a', newline='', encoding='utf-8') as history_file:
-        with open(current_csv, 'r', newline='', encoding='utf-8') as current_file:
+def row_values_getter(columns):
+    """Function returning the values of the given columns of a row dict, as a tuple."""
+    return operator.itemgetter(*columns) if len(columns) > 1 else lambda row: (row[columns[0]],)
+
+def format_transformed_rows(records):
+    """
+    Format the result of transform_study the way data_preparation writes it.
+
+    Args:
+        records (tuple): Result of transform_study
+
+    Returns:
+        tuple: (main CSV row without its Timestamp field and line end, list of the CSV lines
+        of each child table, list of the row counts of each child table), child tables in
+        CHILD_TABLE_COLUMNS order
+    """
+    row, *child_rows = records
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='').writerow([row.get(column, '') for column in STUDY_COLUMNS[:-1]])
+    study_text = buffer.getvalue()
+    texts = []
+    for columns, rows in zip(CHILD_TABLE_COLUMNS.values(), child_rows):
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator='\n').writerows(map(row_values_getter(columns), rows))
+        texts.append(buffer.getvalue())
+    return study_text, texts, [len(rows) for rows in child_rows]
+
+class TransformCache:
+    """
+    Transform results of the previous run, kept in one Parquet file keyed by a hash of each
+    raw study record. A record that is byte-identical to one transformed in the previous run
+    reuses its rows, already formatted as CSV, without being parsed, transformed or formatted
+    again. The file is read and written in one piece and only keeps the records of the latest run.
+
+    The transform_study results are cached too, for the outputs written from the values of
+    the rows (Parquet and normalized child tables); they are only decoded when decode_records is set.
+    """
+
+    def __init__(self, cache_dir, decode_records=False):
+        self.cache_dir = cache_dir
+        self.cache_file = os.path.join(cache_dir, TRANSFORM_CACHE_FILE)
+        self.decode_records = decode_records
+        self.entries = {}
+        self.current = {}
+        if os.path.isfile(self.cache_file):
+            table = pq.read_table(self.cache_file)
+            if (table.schema.metadata or {}).get(b'transform_version') == str(TRANSFORM_VERSION).encode():
+                columns = table.to_pydict()
+                self.entries = {key: (records, study_text, texts, counts) for key, records, study_text, texts, counts
+                                in zip(columns['Key'], columns['Records'], columns['StudyText'],
+                                       columns['ChildTexts'], columns['ChildRowCounts'])}
+
+    @staticmethod
+    def key(raw):
+        """Cache key of a raw study: one NDJSON line, or a decoded study record."""
+        if isinstance(raw, dict):
+            raw = json.dumps(raw)
+        if isinstance(raw, str):
+            raw = raw.encode('utf-8')
+        return hashlib.blake2b(raw.strip(), digest_size=16).hexdigest()
+
+    def get(self, key):
+        """
+        Look up the transform result of a raw study and keep it for the next run.
+
+        Returns:
+            tuple: (transform_study result, or None unless decode_records is set, and
+            format_transformed_rows result), or None if the record was not transformed before
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.current[key] = entry
+        records, study_text, texts, counts = entry
+        return (json.loads(records) if self.decode_records else None), (study_text, texts, counts)
+
+    def put(self, key, records):
+        """
+        Store the transform_study result of a raw study for the next run.
+
+        Returns:
+            tuple: format_transformed_rows result
+        """
+        formatted = format_transformed_rows(records)
+        self.current[key] = (json.dumps(records), *formatted)
+        return formatted
+
+    def save(self):
+        """Write the results of this run to the cache file, replacing those of the previous run."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        records, study_texts, texts, counts = zip(*self.current.values()) if self.current else ((), (), (), ())
+        table = pa.table({'Key': pa.array(list(self.current), type=pa.string()),
+                          'Records': pa.array(records, type=pa.string()),
+                          'StudyText': pa.array(study_texts, type=pa.string()),
+                          'ChildTexts': pa.array(texts, type=pa.list_(pa.string())),
+                          'ChildRowCounts': pa.array(counts, type=pa.list_(pa.int32()))})
+        table = table.replace_schema_metadata({b'transform_version': str(TRANSFORM_VERSION).encode()})
+        pq.write_table(table, self.cache_file)
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(TRANSFORM_CACHE_SUFFIX):
+                os.remove(os.path.join(self.cache_dir, name))
+
+class CsvTableWriter:
+    """
+    Streams the rows of one child table to CSV, formatted exactly like DataFrame.to_csv
+    with index=False and encoding='utf-8-sig' would format the complete list of rows.
+
+    Rows are formatted into a text buffer as they arrive and flushed every batch_size rows,
+    to the CSV file and, when parquet_file is given, as a record batch of a Parquet file with
+    string columns, from the tuples of column values kept for it. pyarrow's CSV writer quotes
+    every string, so the CSV itself is still written by csv.writer to keep it byte-identical
+    to the pandas output. Rows already formatted, e.g. by the transform cache, are buffered
+    as they are.
+    """
+
+    def __init__(self, path, columns, write_empty=True, parquet_file=None, batch_size=CHILD_TABLE_BATCH_SIZE):
+        self.path = path
+        self.columns = columns
+        self.write_empty = write_empty
+        self.parquet_file = parquet_file
+        self.batch_size = batch_size
+        self.row_count = 0
+        self._row_values = row_values_getter(columns)
+        self._text = io.StringIO()
+        self._text_writer = csv.writer(self._text, lineterminator='\n')
+        self._values = []
+        self._buffered = 0
+        self._file = None
+        self._parquet_writer = None
+
+    def writerows(self, rows):
+        values = list(map(self._row_values, rows))
+        self._text_writer.writerows(values)
+        if self.parquet_file:
+            self._values.extend(values)
+        self._buffer_rows(len(values))
+
+    def write_formatted(self, text, row_count, rows=None):
+        """
+        Write rows already formatted as CSV lines (see format_transformed_rows).
+
+        Args:
+            text (str): CSV lines of the rows
+            row_count (int): Number of rows in text
+            rows (list): The same rows as dicts; required when the table is also written to Parquet
+        """
+        self._text.write(text)
+        if self.parquet_file:
+            self._values.extend(map(self._row_values, rows))
+        self._buffer_rows(row_count)
+
+    def _buffer_rows(self, row_count):
+        self.row_count += row_count
+        self._buffered += row_count
+        if self._buffered >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows and empty the buffer."""
+        if not self._buffered:
+            return
+        if self._file is None:
+            self._file = open(self.path, 'w', newline='', encoding='utf-8-sig')
+            csv.writer(self._file, lineterminator='\n').writerow(self.columns)
+        self._file.write(self._text.getvalue())
+        self._text.seek(0)
+        self._text.truncate()
+        if self.parquet_file:
+            batch = pa.table([pa.array(values, type=pa.string()) for values in zip(*self._values)], names=self.columns)
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(self.parquet_file, batch.schema)
+            self._parquet_writer.write_table(batch)
+            self._values = []
+        self._buffered = 0
+
+    def close(self):
+        """
+        Flush and close the files. An empty table is written the way pandas writes an empty
+        DataFrame, unless write_empty is False, in which case no file is created.
+
+        Returns:
+            bool: Whether the file was written
+        """
+        self.flush()
+        if self.parquet_file and (self._parquet_writer is not None or self.write_empty):
+            if self._parquet_writer is None:
+                schema = pa.schema([(column, pa.string()) for column in self.columns])
+                self._parquet_writer = pq.ParquetWriter(self.parquet_file, schema)
+            self._parquet_writer.close()
+        if self._file is not None:
+            self._file.close()
+            return True
+        if self.write_empty:
+            with open(self.path, 'w', newline='', encoding='utf-8-sig') as f:
+                f.write('\n')
+            return True
+        return False
+
+class NormalizedTablesWriter:
+    """
+    Streams the child tables in normalized form: each value of a dimension column is
+    interned once in a dimension table with an integer surrogate key, and the fact
+    tables store the keys in <column>_id columns. Dimensions such as sponsors are shared
+    by several columns, so their keys can be compared across columns. Empty strings are
+    interned like any other value; only a missing value leaves its key blank.
+    """
+
+    def __init__(self, output_dir, dimensions=NORMALIZED_DIMENSIONS):
+        self.output_dir = output_dir
+        self.dimensions = dimensions
+        self.keys = {dimension: {} for columns in dimensions.values() for dimension in columns.values()}
+        self.writers = {}
+        self._files = []
+        os.makedirs(output_dir, exist_ok=True)
+
+    def fact_columns(self, table):
+        encoded = self.dimensions.get(table, {})
+        return [f"{column}_id" if column in encoded else column for column in CHILD_TABLE_COLUMNS[table]]
+
+    def writerows(self, table, rows):
+        if table not in self.writers:
+            f = open(os.path.join(self.output_dir, f"{table}.csv"), 'w', newline='', encoding='utf-8')
+            self._files.append(f)
+            self.writers[table] = csv.writer(f, lineterminator='\n')
+            self.writers[table].writerow(self.fact_columns(table))
+        encoded = self.dimensions.get(table, {})
+        writer = self.writers[table]
+        for row in rows:
+            values = []
+            for column in CHILD_TABLE_COLUMNS[table]:
+                value = row[column]
+                if column in encoded and value is not None:
+                    keys = self.keys[encoded[column]]
+                    value = keys.setdefault(value, len(keys))
+                values.append(value)
+            writer.writerow(values)
+
+    def close(self):
+        """Write the dimension tables and close the fact tables; tables without rows get a header only."""
+        for table in CHILD_TABLE_COLUMNS:
+            self.writerows(table, [])
+        for f in self._files:
+            f.close()
+        for dimension, keys in self.keys.items():
+            with open(os.path.join(self.output_dir, f"dim_{dimension}.csv"), 'w', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f, lineterminator='\n')
+                writer.writerow(['id', 'value'])
+                writer.writerows((key, value) for value, key in keys.items())
+
+def read_normalized_table(table, normalized_dir=NORMALIZED_DIR):
+    """
+    Load a normalized child table with its dimension columns as pandas categoricals.
+
+    The categories are the dimension table in key order and the codes are the stored
+    keys, so no string is repeated in memory and group-bys run on integer codes. The other
+    columns are read as strings, blanks included, so every value equals the one in the
+    plain CSV file; a blank key, i.e. a missing value, is decoded as NaN.
+
+    Args:
+        table (str): Child table name, e.g. 'locations'
+        normalized_dir (str): Directory written by data_preparation with normalized_dir set
+
+    Returns:
+        pd.DataFrame: The table with the columns of CHILD_TABLE_COLUMNS[table]
+    """
+    encoded = NORMALIZED_DIMENSIONS.get(table, {})
+    dtypes = {column: str for column in CHILD_TABLE_COLUMNS[table] if column not in encoded}
+    dtypes.update({f"{column}_id": 'Int32' for column in encoded})
+    df = pd.read_csv(os.path.join(normalized_dir, f"{table}.csv"), dtype=dtypes, keep_default_na=False,
+                     na_values={f"{column}_id": [''] for column in encoded})
+    categories = {}
+    for column, dimension in encoded.items():
+        if dimension not in categories:
+            dimension_table = pd.read_csv(os.path.join(normalized_dir, f"dim_{dimension}.csv"),
+                                          dtype={'value': str}, keep_default_na=False)
+            categories[dimension] = pd.Index(dimension_table.sort_values('id')['value'])
+        codes = df.pop(f"{column}_id").fillna(-1).to_numpy(dtype=np.int32)
+        df[column] = pd.Categorical.from_codes(codes, categories=categories[dimension])
+    return df[CHILD_TABLE_COLUMNS[table]]
+
+def load_raw_study(raw):
+    """Decode a raw study given as one NDJSON line; decoded records are returned as is."""
+    return json.loads(raw) if isinstance(raw, (str, bytes)) else raw
+
+def transform_cached_study(raw, transform_cache=None):
+    """
+    Transforms one study, going through the transform cache when one is given.
+
+    Args:
+        raw (dict, str or bytes): Raw study record, or one NDJSON line holding it
+        transform_cache (TransformCache): Optional cache of the previous run's results
+
+    Returns:
+        tuple: (result of transform_study, format_transformed_rows result or None without a
+        cache, whether it came from the cache); the transform_study result of a cached study
+        is None unless the cache decodes records
+    """
+    if transform_cache is None:
+        return transform_study(load_raw_study(raw)), None, False
+
+    key = transform_cache.key(raw)
+    cached = transform_cache.get(key)
+    if cached is not None:
+        return (*cached, True)
+    records = transform_study(load_raw_study(raw))
+    return records, transform_cache.put(key, records), False
+
+def transform_shard(studies):
+    """
+    Transforms a shard of studies; this is the unit of work sent to each worker process.
+
+    Args:
+        studies (list): Raw study records or NDJSON lines
+
+    Returns:
+        list: transform_study results, in the order of the shard
+    """
+    return [transform_study(load_raw_study(study)) for study in studies]
+
+def iter_raw_studies(json_file):
+    """
+    Streams the raw studies of a file. NDJSON lines are passed through undecoded, so that
+    they can be looked up in the transform cache or decoded in a worker process.
+
+    Args:
+        json_file (str): Path to the source .ndjson or .json file
+
+    Yields:
+        bytes or dict: One NDJSON line or decoded study record at a time, in file order
+    """
+    if json_file.endswith('.ndjson'):
+        with open(json_file, 'rb') as f:
+            yield from (line for line in f if line.strip())
+    else:
+        yield from iter_studies(json_file)
+
+def iter_study_shards(json_file, shard_size):
+    """
+    Groups the raw studies of a file into shards (see iter_raw_studies).
+
+    Args:
+        json_file (str): Path to the source .ndjson or .json file
+        shard_size (int): Number of studies per shard
+
+    Yields:
+        list: Raw study records or NDJSON lines, in file order
+    """
+    shard = []
+    for study in iter_raw_studies(json_file):
+        shard.append(study)
+        if len(shard) == shard_size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+def iter_transformed_studies(json_file, transform_cache=None, workers=1, shard_size=TRANSFORM_SHARD_SIZE):
+    """
+    Streams the transformed studies of a raw file in input order.
+
+    With more than one worker the studies missing from the transform cache are sharded
+    across a process pool. At most two shards per worker are in flight and results are
+    yielded in submission order, so the output is identical to the serial path and memory
+    stays bounded.
+
+    Args:
+        json_file (str): Path to the source .ndjson or .json file
+        transform_cache (TransformCache): Optional cache of the previous run's results
+        workers (int): Number of worker processes; 1 transforms in the current process
+        shard_size (int): Number of studies sent to a worker at a time
+
+    Yields:
+        tuple: transform_cached_study result
+    """
+    if workers <= 1:
+        for raw in iter_raw_studies(json_file):
+            yield transform_cached_study(raw, transform_cache)
+        return
+
+    def shard_results(keys, cached, future):
+        transformed = iter(future.result() if future is not None else ())
+        for key, entry in zip(keys, cached):
+            if entry is not None:
+                yield (*entry, True)
+                continue
+            records = next(transformed)
+            yield records, transform_cache.put(key, records) if transform_cache is not None else None, False
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for shard in iter_study_shards(json_file, shard_size):
+            keys = [transform_cache.key(raw) for raw in shard] if transform_cache is not None else [None] * len(shard)
+            cached = [transform_cache.get(key) for key in keys] if transform_cache is not None else keys
+            misses = [raw for raw, entry in zip(shard, cached) if entry is None]
+            pending.append((keys, cached, executor.submit(transform_shard, misses) if misses else None))
+            if len(pending) >= 2 * workers:
+                yield from shard_results(*pending.popleft())
+        while pending:
+            yield from shard_results(*pending.popleft())
+
+def data_preparation(json_file, csv_file, transform_cache_dir=None, workers=1, normalized_dir=None, parquet_dir=None):
+    """
+    Transforms JSON clinical trials data into a structured CSV format and creates separate files for conditions and locations.
+
+    Studies are streamed from the raw file (NDJSON or legacy JSON array) and each one is
+    transformed and written to the main and child CSV files as soon as it is read, so
+    peak memory does not depend on the number of studies.
+
+    When a transform cache directory is given, studies whose raw record is unchanged since
+    the previous run reuse their cached rows instead of being parsed and transformed again
+    (see TransformCache).
+    With several workers the transform is sharded across a process pool; rows are still
+    written in input order, so the output files are byte-identical to the serial path.
+
+    Args:
+        json_file (str): Path to the source .ndjson or .json file
+        csv_file (str): Path where the main CSV file will be saved
+        transform_cache_dir (str): Optional directory of the transform cache
+        workers (int): Number of worker processes used for the transform
+        normalized_dir (str): Optional directory where the child tables are also written in
+            normalized form, with dimension tables (see NormalizedTablesWriter)
+        parquet_dir (str): Optional directory where the child tables are also written as Parquet files
+
+    Returns:
+        None. Writes processed data to specified CSV files.
+    """
+    data_dir = os.path.dirname(csv_file)
+    conditions_file = os.path.join(data_dir, 'conditions.csv')
+    locations_file = os.path.join(data_dir, 'locations.csv')
+    interventions_file = os.path.join(data_dir, 'interventions.csv')
+    sponsors_file = os.path.join(data_dir, 'sponsors_collaborators.csv')
+
+    parquet_files = dict.fromkeys(CHILD_TABLE_COLUMNS)
+    if parquet_dir:
+        os.makedirs(parquet_dir, exist_ok=True)
+        parquet_files = {table: os.path.join(parquet_dir, f"{table}.parquet") for table in CHILD_TABLE_COLUMNS}
+
+    # Child tables are streamed to their own files alongside the main CSV file
+    conditions_writer = CsvTableWriter(conditions_file, CHILD_TABLE_COLUMNS['conditions'],
+                                       parquet_file=parquet_files['conditions'])
+    locations_writer = CsvTableWriter(locations_file, CHILD_TABLE_COLUMNS['locations'],
+                                      parquet_file=parquet_files['locations'])
+    # Only create and save interventions if we have intervention data
+    interventions_writer = CsvTableWriter(interventions_file, CHILD_TABLE_COLUMNS['interventions'], write_empty=False,
+                                          parquet_file=parquet_files['interventions'])
+    sponsors_writer = CsvTableWriter(sponsors_file, CHILD_TABLE_COLUMNS['sponsors_collaborators'],
+                                     parquet_file=parquet_files['sponsors_collaborators'])
+    normalized_writer = NormalizedTablesWriter(normalized_dir) if normalized_dir else None
+
+    # The Parquet and normalized child tables are written from the values of the rows
+    transform_cache = (TransformCache(transform_cache_dir, decode_records=bool(parquet_dir or normalized_dir))
+                       if transform_cache_dir else None)
+    study_count = 0
+    cache_hits = 0
+
+    try:
+        with open(csv_file, 'w', newline='', encoding='utf-8-sig') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=STUDY_COLUMNS, extrasaction='ignore')
+            writer.writeheader()
+
+            timestamp = datetime.datetime.now().isoformat()
+
+            child_writers = [conditions_writer, locations_writer, interventions_writer, sponsors_writer]
+            for records, formatted, cache_hit in iter_transformed_studies(json_file, transform_cache, workers):
+                study_count += 1
+                cache_hits += cache_hit
+
+                if formatted is None:
+                    row, *child_rows = records
+                    writer.writerow({**row, 'Timestamp': timestamp})
+                    for table_writer, rows in zip(child_writers, child_rows):
+                        table_writer.writerows(rows)
+                else:
+                    # Rows formatted by the transform cache are written as they are
+                    study_text, texts, counts = formatted
+                    csvfile.write(f"{study_text},{timestamp}\r\n")
+                    child_rows = records[1:] if records is not None else [None] * len(child_writers)
+                    for table_writer, text, count, rows in zip(child_writers, texts, counts, child_rows):
+                        table_writer.write_formatted(text, count, rows)
+                if normalized_writer is not None:
+                    for table, rows in zip(CHILD_TABLE_COLUMNS, records[1:]):
+                        normalized_writer.writerows(table, rows)
+    finally:
+        conditions_written = conditions_writer.close()
+        locations_written = locations_writer.close()
+        interventions_written = interventions_writer.close()
+        sponsors_written = sponsors_writer.close()
+        if normalized_writer is not None:
+            normalized_writer.close()
+
+    if transform_cache is not None:
+        transform_cache.save()
+    record_rows('rows_in', json_file, study_count)
+    record_rows('rows_out', csv_file, study_count)
+    for table_writer in (conditions_writer, locations_writer, interventions_writer, sponsors_writer):
+        record_rows('rows_out', table_writer.path, table_writer.row_count)
+    print(f"Step 2: Main data has been successfully written to {csv_file}.")
+    if transform_cache_dir:
+        print(f"Step 2: Reused cached rows for {cache_hits} of {study_count} studies.")
+    if conditions_written:
+        print(f"Step 3: Conditions data has been successfully written to {conditions_file}.")
+    if locations_written:
+        print(f"Step 4: Locations data has been successfully written to {locations_file}.")
+    if interventions_written:
+        print(f"Step 5: Interventions data has been successfully written to {interventions_file}.")
+    if sponsors_written:
+        print(f"Step 6: Sponsors and collaborators data has been successfully written to {sponsors_file}.")
+    if parquet_dir:
+        print(f"Step 6: Child tables have also been written as Parquet files to {parquet_dir}.")
+    if normalized_writer is not None:
+        print(f"Step 6: Normalized child tables and {len(normalized_writer.keys)} dimension tables "
+              f"have been written to {normalized_dir}.")
+
+def snapshot_key(timestamp):
+    """
+    Convert a snapshot Timestamp into the fixed-width key used to name history partitions.
+
+    Args:
+        timestamp (str or datetime): Snapshot timestamp, or a date to compare against
+
+    Returns:
+        str: Key such as '20250725T150858106468', which sorts like the timestamp
+    """
+    return pd.Timestamp(timestamp).strftime(SNAPSHOT_KEY_FORMAT)
+
+def to_history_table(df):
+    """
+    Convert study rows to the Arrow table layout of the Parquet history.
+
+    Values are coerced to HISTORY_SCHEMA so that every snapshot shares one schema;
+    empty strings are stored as nulls, as they are read back from the CSV files.
+
+    Args:
+        df (pd.DataFrame): Study rows with the STUDY_COLUMNS columns
+
+    Returns:
+        pyarrow.Table: Rows in the HISTORY_SCHEMA layout
+    """
+    arrays = {}
+    for field in HISTORY_SCHEMA:
+        values = df[field.name] if field.name in df.columns else pd.Series(None, index=df.index, dtype=object)
+        if pa.types.is_boolean(field.type):
+            values = values.map({True: True, False: False, 'True': True, 'False': False}).astype(object)
+        elif pa.types.is_integer(field.type) or pa.types.is_floating(field.type):
+            values = pd.to_numeric(values, errors='coerce')
+            if pa.types.is_integer(field.type):
+                values = values.astype('Int64')
+        else:
+            values = values.astype(object).where(values.notna(), None).map(
+                lambda value: str(value) if value is not None else None)
+        arrays[field.name] = pa.array(values, type=field.type, from_pandas=True)
+    return pa.table(arrays, schema=HISTORY_SCHEMA)
+
+def read_study_csv(csv_file, **kwargs):
+    """
+    Read a studies CSV file (current snapshot or legacy history) with the text columns as strings.
+
+    Args:
+        csv_file (str): Path to the CSV file
+        **kwargs: Extra arguments forwarded to pd.read_csv
+
+    Returns:
+        pd.DataFrame or iterator: Result of pd.read_csv
+    """
+    text_columns = {field.name: str for field in HISTORY_SCHEMA if pa.types.is_string(field.type)}
+    return pd.read_csv(csv_file, encoding='utf-8-sig', dtype=text_columns, **kwargs)
+
+def history_partition_file(history_dir, key, part=0):
+    """
+    Path of a file of one snapshot partition of the Parquet history dataset.
+
+    Args:
+        history_dir (str): Root directory of the history dataset
+        key (str): Snapshot key of the partition, see snapshot_key
+        part (int): Number of the file within the partition
+
+    Returns:
+        str: Path of the file
+    """
+    return os.path.join(history_dir, f"snapshot={key}", f"part-{part}.parquet")
+
+def write_history_partition(table, history_dir, key, part=0):
+    """
+    Write rows of one snapshot into its partition of the Parquet history dataset.
+
+    Args:
+        table (pyarrow.Table): Rows in the HISTORY_SCHEMA layout
+        history_dir (str): Root directory of the history dataset
+        key (str): Snapshot key of the partition, see snapshot_key
+        part (int): Number of the file within the partition
+
+    Returns:
+        str: Path of the written file
+    """
+    path = history_partition_file(history_dir, key, part)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pq.write_table(table, path, row_group_size=HISTORY_ROW_GROUP_SIZE)
+    return path
+
+def content_hash(table):
+    """
+    Hash the normalized fields of study rows, ignoring the snapshot Timestamp.
+
+    Fields are compared the way change detection compares them: missing values and
+    empty strings are equal, and double line breaks count as single ones. Each column is
+    cast to its HISTORY_SCHEMA type and then to text by Arrow, so a value hashes the same
+    whatever the other rows hold (an integer does not turn into a float when a row of
+    the snapshot is null).
+
+    Args:
+        table (pyarrow.Table): Rows in the HISTORY_SCHEMA layout
+
+    Returns:
+        np.ndarray: One 16-character hexadecimal hash per row
+    """
+    columns = {}
+    for column in table.column_names:
+        if column == 'Timestamp':
+            continue
+        values = table[column]
+        if column in HISTORY_SCHEMA.names:
+            values = values.cast(HISTORY_SCHEMA.field(column).type)
+        values = pc.replace_substring(pc.fill_null(pc.cast(values, pa.string()), ''), '\n\n', '\n')
+        columns[column] = values.to_numpy(zero_copy_only=False).astype(object)
+    hashes = pd.util.hash_pandas_object(pd.DataFrame(columns, index=range(table.num_rows)), index=False).to_numpy()
+    return np.char.mod('%016x', hashes)
+
+def load_history_versions(history_dir):
+    """
+    Load the version table of a delta-encoded history.
+
+    Each row describes one stored version of a study, valid from the snapshot that wrote
+    it (ValidFrom) until the first snapshot where it changed or disappeared (ValidTo,
+    null while the version is current), in the style of a type 2 slowly changing dimension.
+    RowGroup and RowOffset locate the stored row inside the ValidFrom partition, which
+    makes the table an index from (NCTId, Timestamp) to storage location.
+
+    Args:
+        history_dir (str): Root directory of the history dataset
+
+    Returns:
+        pd.DataFrame: Columns NCTId, ContentHash, ValidFrom and ValidTo (snapshot keys),
+        RowGroup and RowOffset; None if the history is not delta-encoded
+    """
+    versions_file = os.path.join(history_dir, HISTORY_VERSIONS_FILE)
+    if not os.path.isfile(versions_file):
+        return None
+    versions = pq.read_table(versions_file).to_pandas()
+    return versions.reindex(columns=HISTORY_VERSION_COLUMNS)
+
+def load_history_hash_version(history_dir):
+    """
+    Version of the content_hash scheme the ContentHash of a version table was written with.
+
+    Args:
+        history_dir (str): Root directory of the history dataset
+
+    Returns:
+        int: Hash scheme version; 1 for tables written before it was recorded, None if the
+        history is not delta-encoded
+    """
+    versions_file = os.path.join(history_dir, HISTORY_VERSIONS_FILE)
+    if not os.path.isfile(versions_file):
+        return None
+    metadata = pq.read_schema(versions_file).metadata or {}
+    return int(metadata.get(HISTORY_HASH_VERSION_KEY, 1))
+
+def save_history_versions(history_dir, versions, hash_version=HISTORY_HASH_VERSION):
+    """
+    Write the version table of a delta-encoded history.
+
+    Args:
+        history_dir (str): Root directory of the history dataset
+        versions (pd.DataFrame): Version table with the HISTORY_VERSION_COLUMNS columns
+        hash_version (int): Version of the content_hash scheme of its ContentHash column
+    """
+    table = pa.Table.from_pandas(versions[HISTORY_VERSION_COLUMNS].astype(object), schema=HISTORY_VERSIONS_SCHEMA,
+                                 preserve_index=False)
+    table = table.replace_schema_metadata({HISTORY_HASH_VERSION_KEY: str(hash_version).encode()})
+    pq.write_table(table, os.path.join(history_dir, HISTORY_VERSIONS_FILE))
+
+def rehash_history_versions(history_dir, versions):
+    """
+    Recompute the ContentHash of every version from its stored row, e.g. for a version
+    table written with an older content_hash scheme, so that unchanged studies are not
+    all rewritten by the next snapshot.
+
+    Args:
+        history_dir (str): Root directory of a delta-encoded history dataset
+        versions (pd.DataFrame): Version table of the history
+
+    Returns:
+        pd.DataFrame: The version table with the recomputed hashes, also saved to disk
+    """
+    if versions['RowGroup'].isna().any():
+        versions = index_history_versions(history_dir)
+    versions = versions.copy()
+    versions['ContentHash'] = content_hash(read_version_rows(history_dir, versions))
+    save_history_versions(history_dir, versions)
+    return versions
+
+def index_history_versions(history_dir):
+    """
+    Recompute the RowGroup and RowOffset of every version from the partition files,
+    e.g. for a version table written before they were recorded.
+
+    Args:
+        history_dir (str): Root directory of a delta-encoded history dataset
+
+    Returns:
+        pd.DataFrame: The updated version table, also saved to disk
+    """
+    versions = load_history_versions(history_dir)
+    locations = []
+    for key in versions['ValidFrom'].unique():
+        parquet_file = pq.ParquetFile(history_partition_file(history_dir, key))
+        for row_group in range(parquet_file.num_row_groups):
+            nct_ids = parquet_file.read_row_group(row_group, columns=['NCTId'])['NCTId'].to_pylist()
+            locations.append(pd.DataFrame({'NCTId': nct_ids, 'ValidFrom': key, 'RowGroup': row_group,
+                                           'RowOffset': np.arange(len(nct_ids))}))
+    locations = pd.concat(locations, ignore_index=True).drop_duplicates(['NCTId', 'ValidFrom'], keep='last')
+    versions = versions.drop(columns=['RowGroup', 'RowOffset']).merge(locations, on=['NCTId', 'ValidFrom'], how='left')
+    save_history_versions(history_dir, versions, load_history_hash_version(history_dir))
+    return versions
+
+def load_history_snapshots(history_dir):
+    """
+    Load the log of snapshots appended to a delta-encoded history.
+
+    Args:
+        history_dir (str): Root directory of the history dataset
+
+    Returns:
+        dict: Snapshot Timestamp string keyed by snapshot key, in snapshot order
+    """
+    snapshots_file = os.path.join(history_dir, HISTORY_SNAPSHOTS_FILE)
+    if not os.path.isfile(snapshots_file):
+        return {}
+    with open(snapshots_file, 'r', encoding='utf-8') as f:
+        return dict(sorted(json.load(f).items()))
+
+def append_history_snapshot(history_dir, table, timestamp):
+    """
+    Append one snapshot to a delta-encoded history.
+
+    Only studies that are new or whose content hash differs from their current version
+    are written, to the snapshot=<key> partition. The versions they replace, and those of
+    studies missing from the snapshot, are closed by setting ValidTo to this snapshot.
+
+    Args:
+        history_dir (str): Root directory of the history dataset
+        table (pyarrow.Table): All rows of the snapshot in the HISTORY_SCHEMA layout
+        timestamp (str): Snapshot Timestamp as written in the studies CSV file
+
+    Returns:
+        int: Number of versions written, or None if the snapshot was already appended
+    """
+    key = snapshot_key(timestamp)
+    snapshots = load_history_snapshots(history_dir)
+    if key in snapshots:
+        return None
+    if snapshots and key < max(snapshots):
+        raise ValueError(f"Snapshot {timestamp} is older than the last snapshot of {history_dir}.")
+    if list_snapshots(history_dir) and load_history_versions(history_dir) is None:
+        raise ValueError(f"{history_dir} holds full snapshots; migrate it before appending delta snapshots.")
+
+    versions = load_history_versions(history_dir)
+    if versions is None:
+        versions = pd.DataFrame({name: pd.Series(dtype=object) for name in HISTORY_VERSION_COLUMNS})
+    elif load_history_hash_version(history_dir) != HISTORY_HASH_VERSION:
+        versions = rehash_history_versions(history_dir, versions)
+
+    nct_ids = table['NCTId'].to_pandas()
+    hashes = pd.Series(content_hash(table), index=nct_ids.to_numpy())
+    hashes = hashes[~hashes.index.duplicated(keep='last')]
+
+    current = versions['ValidTo'].isna()
+    current_hashes = pd.Series(versions.loc[current, 'ContentHash'].to_numpy(),
+                               index=versions.loc[current, 'NCTId'].to_numpy())
+    unchanged = hashes.reindex(current_hashes.index).to_numpy() == current_hashes.to_numpy()
+    unchanged_ids = set(current_hashes.index[unchanged])
+
+    # Close the versions that changed or disappeared, then add the new ones
+    versions.loc[current & ~versions['NCTId'].isin(unchanged_ids), 'ValidTo'] = key
+    changed = ~nct_ids.isin(unchanged_ids).to_numpy() & ~nct_ids.duplicated(keep='last').to_numpy()
+    new_rows = table.filter(pa.array(changed))
+    new_versions = pd.DataFrame({
+        'NCTId': new_rows['NCTId'].to_pandas().to_numpy(dtype=object),
+        'ContentHash': hashes.loc[new_rows['NCTId'].to_pandas()].to_numpy(dtype=object),
+        'ValidFrom': key,
+        'ValidTo': None,
+        'RowGroup': np.arange(new_rows.num_rows) // HISTORY_ROW_GROUP_SIZE,
+        'RowOffset': np.arange(new_rows.num_rows) % HISTORY_ROW_GROUP_SIZE,
+    })
+    versions = pd.concat([versions, new_versions], ignore_index=True).astype(object)
+
+    if new_rows.num_rows:
+        write_history_partition(new_rows, history_dir, key)
+    save_history_versions(history_dir, versions)
+    snapshots[key] = timestamp
+    with open(os.path.join(history_dir, HISTORY_SNAPSHOTS_FILE), 'w', encoding='utf-8') as f:
+        json.dump(snapshots, f, indent=2)
+    return new_rows.num_rows
+
+def append_to_history(current_csv, history_csv):
+    """
+    Appends current data to the historical record.
+
+    The history is a delta-encoded Parquet dataset: each snapshot=<key> partition only
+    holds the studies whose normalized fields changed in that run, and a version table
+    records when each stored row was valid (see append_history_snapshot). Appending a
+    snapshot twice has no effect. A path ending in .csv keeps the legacy single CSV file format.
+    
+    Args:
+        current_csv (str): Path to the current CSV data file
+        history_csv (str): Path to the history dataset directory, or to a legacy CSV file
+    
+    Returns:
+        None. Appends current data to historical record.
+    """
+    if not history_csv.endswith('.csv'):
+        df = read_study_csv(current_csv)
+        record_rows('rows_in', current_csv, len(df))
+        for timestamp, snapshot in df.groupby('Timestamp', sort=True):
+            written = append_history_snapshot(history_csv, to_history_table(snapshot), timestamp)
+            record_rows('rows_out', history_csv, written or 0)
+            if written is None:
+                print(f"Step 6: Snapshot {timestamp} is already in {history_csv}.")
+            else:
+                print(f"Step 6: {written} new or changed studies from {current_csv} have been appended to {history_csv}.")
+        return
+
+    file_exists = os.path.isfile(history_csv)
+
+    with open(history_csv, 'a', newline='', encoding='utf-8') as history_file:
+        with open(current_csv, 'r', newline='', encoding='utf-8') as current_file:
             reader = csv.reader(current_file)
             writer = csv.writer(history_file, quoting=csv.QUOTE_MINIMAL)
 
-            # Read and write the header if history_csv doesn't exist
-            header = next(reader)
-            if not file_exists:
-                writer.writerow(header)
+            # Read and write the header if history_csv doesn't exist
+            header = next(reader)
+            if not file_exists:
+                writer.writerow(header)
+
+            # Append rows with proper quoting
+            row_count = 0
+            for row in reader:
+                writer.writerow(row)
+                row_count += 1
+    record_rows('rows_in', current_csv, row_count)
+    record_rows('rows_out', history_csv, row_count)
+
+    print(f"Step 6: Data from {current_csv} has been appended to {history_csv}.")
+
+def expand_history_versions(history_path, versions, snapshots, columns=None):
+    """
+    Rebuild full snapshots from the stored versions of a delta-encoded history.
+
+    Args:
+        history_path (str): Root directory of the history dataset
+        versions (pd.DataFrame): Version table rows to expand
+        snapshots (dict): Snapshot Timestamp strings keyed by snapshot key, for the snapshots to rebuild
+        columns (list): Columns to load; None loads every column
+
+    Returns:
+        pd.DataFrame: One row per study and requested snapshot, ordered by snapshot then NCTId,
+        with Timestamp set to the snapshot's Timestamp
+    """
+    columns = columns or HISTORY_SCHEMA.names
+    keys = np.array(list(snapshots), dtype=object)
+    first = np.searchsorted(keys, versions['ValidFrom'].to_numpy(dtype=object), side='left')
+    valid_to = versions['ValidTo'].fillna(HISTORY_OPEN_KEY).to_numpy(dtype=object)
+    last = np.searchsorted(keys, valid_to, side='left')
+    counts = np.maximum(last - first, 0)
+    versions = versions[counts > 0]
+    first, counts = first[counts > 0], counts[counts > 0]
+
+    stored_columns = [column for column in columns if column != 'Timestamp']
+    load_columns = list(dict.fromkeys(['NCTId'] + stored_columns))
+    dataset = ds.dataset(history_path, format='parquet', partitioning=HISTORY_PARTITIONING,
+                         schema=HISTORY_SCHEMA.append(pa.field('snapshot', pa.string())))
+    partitions = pa.array(sorted(set(versions['ValidFrom'])), type=pa.string())
+    rows = dataset.to_table(columns=load_columns + ['snapshot'], filter=ds.field('snapshot').isin(partitions)).to_pandas()
+    rows = versions[['NCTId', 'ValidFrom']].reset_index(drop=True).merge(
+        rows, left_on=['NCTId', 'ValidFrom'], right_on=['NCTId', 'snapshot'], how='left')
+
+    # Repeat each version once per snapshot in which it was valid
+    repeat = np.repeat(np.arange(len(rows)), counts)
+    offsets = np.arange(len(repeat)) - np.repeat(np.cumsum(counts) - counts, counts)
+    snapshot_positions = np.repeat(first, counts) + offsets
+    expanded = rows.iloc[repeat].reset_index(drop=True)
+    expanded['Timestamp'] = pd.Series(list(snapshots.values()), dtype=object).iloc[snapshot_positions].to_numpy()
+    expanded['_position'] = snapshot_positions
+    expanded.sort_values(by=['_position', 'NCTId'], kind='stable', inplace=True)
+    return expanded[columns].reset_index(drop=True)
+
+def read_history(history_path, columns=None, since=None, until=None):
+    """
+    Read rows from the study history, loading only the requested columns and snapshots.
+
+    For the Parquet dataset, columns are projected and snapshots outside [since, until]
+    are pruned by partition, so the other files are never opened. A delta-encoded
+    history is expanded back into full snapshots.
+
+    Args:
+        history_path (str): History dataset directory, or a legacy history CSV file
+        columns (list): Columns to load; None loads every column
+        since (str or datetime): Only load snapshots taken at or after this time
+        until (str or datetime): Only load snapshots taken at or before this time
+
+    Returns:
+        pd.DataFrame: History rows, with Timestamp kept as its raw string
+    """
+    if history_path.endswith('.csv'):
+        # Read historical data with error handling for inconsistent columns
+        df = read_study_csv(history_path, on_bad_lines='skip', usecols=columns)
+        if since is not None or until is not None:
+            timestamps = pd.to_datetime(df['Timestamp'], errors='coerce')
+            keep = pd.Series(True, index=df.index)
+            if since is not None:
+                keep &= timestamps >= pd.Timestamp(since)
+            if until is not None:
+                keep &= timestamps <= pd.Timestamp(until)
+            df = df[keep]
+        return df
+
+    since_key = snapshot_key(since) if since is not None else None
+    until_key = snapshot_key(until) if until is not None else None
+
+    versions = load_history_versions(history_path)
+    if versions is not None:
+        snapshots = {key: timestamp for key, timestamp in load_history_snapshots(history_path).items()
+                     if (since_key is None or key >= since_key) and (until_key is None or key <= until_key)}
+        if snapshots:
+            first_key, last_key = min(snapshots), max(snapshots)
+            # Only the versions valid during the requested snapshots are read
+            versions = versions[(versions['ValidFrom'] <= last_key)
+                                & (versions['ValidTo'].isna() | (versions['ValidTo'] > first_key))]
+        else:
+            versions = versions.iloc[0:0]
+        return expand_history_versions(history_path, versions, snapshots, columns)
+
+    dataset = ds.dataset(history_path, format='parquet', partitioning=HISTORY_PARTITIONING,
+                         schema=HISTORY_SCHEMA.append(pa.field('snapshot', pa.string())))
+    partition_filter = None
+    if since_key is not None:
+        partition_filter = ds.field('snapshot') >= since_key
+    if until_key is not None:
+        until_filter = ds.field('snapshot') <= until_key
+        partition_filter = until_filter if partition_filter is None else partition_filter & until_filter
+    return dataset.to_table(columns=columns or HISTORY_SCHEMA.names, filter=partition_filter).to_pandas()
+
+def rebuild_snapshot(history_path, timestamp=None, output_csv=None):
+    """
+    Rebuild the full corpus as of a given run from the history.
+
+    Args:
+        history_path (str): History dataset directory
+        timestamp (str or datetime): Point in time; the last snapshot taken at or before it
+            is rebuilt. None rebuilds the latest snapshot.
+        output_csv (str): Optional path where the snapshot is written like studies.csv
+
+    Returns:
+        pd.DataFrame: Rows of the rebuilt snapshot
+    """
+    keys = list_snapshots(history_path)
+    if timestamp is not None:
+        keys = [key for key in keys if key <= snapshot_key(timestamp)]
+    if not keys:
+        raise ValueError(f"No snapshot of {history_path} was taken at or before {timestamp}.")
+    snapshot_time = pd.to_datetime(keys[-1], format=SNAPSHOT_KEY_FORMAT)
+    snapshot = read_history(history_path, since=snapshot_time, until=snapshot_time)
+    if output_csv:
+        snapshot.to_csv(output_csv, index=False, encoding='utf-8-sig')
+    return snapshot
+
+def list_snapshots(history_path):
+    """
+    List the snapshot keys stored in a Parquet history dataset.
+
+    Args:
+        history_path (str): History dataset directory
+
+    Returns:
+        list: Sorted snapshot keys
+    """
+    if not os.path.isdir(history_path):
+        return []
+    snapshots = load_history_snapshots(history_path)
+    if snapshots:
+        return list(snapshots)
+    return sorted(name.split('=', 1)[1] for name in os.listdir(history_path) if name.startswith('snapshot='))
+
+def migrate_history_csv(history_csv, history_dir, chunksize=50000):
+    """
+    One-time migration of the legacy studies_history.csv into the delta-encoded Parquet history.
+
+    Snapshots are appended in file order; rows of a snapshot spanning several chunks are
+    buffered until the snapshot is complete.
+
+    Args:
+        history_csv (str): Path to the legacy history CSV file
+        history_dir (str): Root directory of the Parquet history dataset to create
+        chunksize (int): Number of CSV rows converted at a time
+
+    Returns:
+        None. Appends every snapshot found in the CSV file to the history dataset.
+    """
+    rows = 0
+    written = 0
+    snapshot_count = 0
+    pending = None
+    chunks = read_study_csv(history_csv, on_bad_lines='skip', chunksize=chunksize)
+    for chunk in itertools.chain(chunks, [None]):
+        if chunk is not None:
+            chunk = chunk[pd.to_datetime(chunk['Timestamp'], errors='coerce').notna()]
+            rows += len(chunk)
+            pending = chunk if pending is None else pd.concat([pending, chunk], ignore_index=True)
+        if pending is None or pending.empty:
+            continue
+        # The last snapshot of a chunk may continue in the next one
+        last_timestamp = pending['Timestamp'].iloc[-1]
+        complete = pending if chunk is None else pending[pending['Timestamp'] != last_timestamp]
+        for timestamp in sorted(complete['Timestamp'].unique(), key=snapshot_key):
+            snapshot = complete[complete['Timestamp'] == timestamp]
+            written += append_history_snapshot(history_dir, to_history_table(snapshot), timestamp) or 0
+            snapshot_count += 1
+        pending = pending[pending['Timestamp'] == last_timestamp] if chunk is not None else None
+    print(f"Migrated {rows} rows in {snapshot_count} snapshots from {history_csv} to {history_dir}, "
+          f"storing {written} study versions.")
+
+def prepare_history_frame(df):
+    """
+    Normalizes a frame of historical study rows for change detection.
+
+    The Timestamp and date columns are parsed, rows without a valid Timestamp are
+    dropped and the rows are sorted by NCTId and Timestamp.
+
+    Args:
+        df (pd.DataFrame): Raw rows read from the history
+
+    Returns:
+        pd.DataFrame: Normalized frame, modified in place and returned
+    """
+    # Ensure the Timestamp column is in datetime format
+    df['Timestamp'] = pd.to_datetime(df['Timestamp'], errors='coerce')
+
+    # Normalize relevant date columns
+    for col in DATE_COLUMNS:
+        if (col in df.columns):
+            try:
+                df[col] = pd.to_datetime(df[col], format='%Y-%m-%d', errors='coerce')
+            except ValueError:
+                df[col] = pd.to_datetime(df[col], errors='coerce')
+
+    # Drop rows with null values in the Timestamp column
+    df.dropna(subset=['Timestamp'], inplace=True)
+
+    # Sort by NCTId and Timestamp
+    df.sort_values(by=['NCTId', 'Timestamp'], inplace=True)
+    return df
+
+def detect_added_removed(df, latest_timestamp=None):
+    """
+    Finds the studies added in, or removed from, the latest snapshot with a single groupby.
+
+    A study is new when its first Timestamp is the latest snapshot, and removed when its
+    last Timestamp is before the latest snapshot.
+
+    Args:
+        df (pd.DataFrame): Normalized history frame
+        latest_timestamp (pd.Timestamp): Timestamp of the latest snapshot; defaults to the
+            latest Timestamp of df, which is only right when df holds every study
+
+    Returns:
+        pd.DataFrame: Change entries ('New Study Added' first, then 'Study Removed'), sorted by NCTId
+    """
+    if latest_timestamp is None:
+        latest_timestamp = df['Timestamp'].max()
+    spans = df.groupby('NCTId')['Timestamp'].agg(['min', 'max'])
+    new_studies = spans[spans['min'] == latest_timestamp]
+    removed_studies = spans[spans['max'] < latest_timestamp]
+
+    added = pd.DataFrame({
+        'NCTId': new_studies.index,
+        'final_date': new_studies['max'].to_numpy(),
+        'start_date': pd.NaT,
+        'field_changed': 'New Study Added',
+    })
+    removed = pd.DataFrame({
+        'NCTId': removed_studies.index,
+        'final_date': pd.NaT,
+        'start_date': removed_studies['max'].to_numpy(),
+        'field_changed': 'Study Removed',
+    })
+    return pd.concat([added, removed], ignore_index=True).reindex(columns=CHANGES_COLUMNS)
 
-            # Append rows with proper quoting
-            for row in reader:
-                writer.writerow(row)
+def diff_consecutive_versions(df, n=None):
+    """
+    Compares each row with the previous version of the same study, column by column,
+    using whole-column operations instead of a per-row loop.
+
+    Numeric columns report a change when both values are present and differ; date
+    columns are compared the same way and reported as YYYY-MM-DD; any other column is
+    compared as text, ignoring double line break differences.
+
+    Args:
+        df (pd.DataFrame): Normalized history frame, sorted by NCTId and Timestamp
+        n (int): Only the last n versions of each study are compared; None compares all
+
+    Returns:
+        pd.DataFrame: One change entry per changed field, ordered by study, version and column
+    """
+    df = df.reset_index(drop=True)
+    if n is not None:
+        # Take only the last N records per NCTId
+        df = df[df.groupby('NCTId').cumcount(ascending=False) < n].reset_index(drop=True)
+
+    # Pair each row with the previous row when it belongs to the same study
+    nct_ids = df['NCTId'].to_numpy()
+    current_index = np.flatnonzero(nct_ids[1:] == nct_ids[:-1]) + 1
+    previous_index = current_index - 1
+    timestamps = df['Timestamp'].to_numpy()
+
+    pieces = []
+    for position, column in enumerate(df.columns):
+        if column in ['NCTId', 'Timestamp']:
+            continue
+        current = df[column].iloc[current_index].reset_index(drop=True)
+        previous = df[column].iloc[previous_index].reset_index(drop=True)
+        both_present = (current.notna() & previous.notna()).to_numpy()
+
+        # Handle numeric values
+        if pd.api.types.is_numeric_dtype(df[column]):
+            changed = both_present & (current != previous).to_numpy()
+            final_values, start_values = current[changed], previous[changed]
+        # Handle date values
+        elif pd.api.types.is_datetime64_any_dtype(df[column]):
+            changed = both_present & (current != previous).to_numpy()
+            final_values = current[changed].dt.strftime('%Y-%m-%d')
+            start_values = previous[changed].dt.strftime('%Y-%m-%d')
+        # Handle text or other types, ignoring double carriage return differences
+        else:
+            current_text = current[both_present].astype(str).str.replace('\n\n', '\n', regex=False)
+            previous_text = previous[both_present].astype(str).str.replace('\n\n', '\n', regex=False)
+            text_changed = (current_text != previous_text).to_numpy()
+            changed = np.zeros(len(current), dtype=bool)
+            changed[np.flatnonzero(both_present)[text_changed]] = True
+            final_values, start_values = current_text[text_changed], previous_text[text_changed]
+
+        if changed.any():
+            pieces.append(pd.DataFrame({
+                'pair': current_index[changed],
+                'position': position,
+                'NCTId': nct_ids[current_index[changed]],
+                'final_date': timestamps[current_index[changed]],
+                'start_date': timestamps[previous_index[changed]],
+                'field_changed': column,
+                'final_value': final_values.to_numpy(dtype=object),
+                'start_value': start_values.to_numpy(dtype=object),
+            }))
+
+    if not pieces:
+        return pd.DataFrame(columns=CHANGES_COLUMNS)
+    changes = pd.concat(pieces, ignore_index=True)
+    changes.sort_values(by=['pair', 'position'], kind='stable', inplace=True)
+    return changes[CHANGES_COLUMNS].reset_index(drop=True)
+
+def make_human_readable(text):
+    """
+    Modify a 'field_changed' value to be more readable, e.g. 'OverallStatus' -> 'Overall Status'.
+
+    Args:
+        text (str): Column name or change label
+
+    Returns:
+        str: Label with a space before each capital letter
+    """
+    if pd.isna(text):
+        return "No changes detected"
+    return re.sub(r'(?<!^)(?=[A-Z])', ' ', text)
+
+def format_changes(changes_df):
+    """
+    Prepares change entries for the changes report.
+
+    Args:
+        changes_df (pd.DataFrame): Change entries with the CHANGES_COLUMNS columns
+
+    Returns:
+        pd.DataFrame: Report frame; a single empty row when there are no changes
+    """
+    if changes_df.empty:
+        # Add a dummy row to prevent empty DataFrame issues
+        changes_df = pd.DataFrame([dict.fromkeys(CHANGES_COLUMNS)])
+    else:
+        changes_df = changes_df.astype(object).where(changes_df.notna(), None).infer_objects()
+    changes_df['field_changed'] = changes_df['field_changed'].apply(make_human_readable)
+    return changes_df
 
-    print(f"Step 6: Data from {current_csv} has been appended to {history_csv}.")
-    
 def generate_changes_last_n(history_csv, changes_csv, n):
     """
     Analyzes and generates a report of changes in the last N versions of each study.
     
     Args:
-        history_csv (str): Path to the historical data CSV file
+        history_csv (str): Path to the history dataset directory, or to a legacy history CSV file
         changes_csv (str): Path where the changes report will be saved
-        n (int): Number of most recent versions to compare
+        n (int): Number of most recent versions to compare; None compares all
     
     Returns:
         None. Generates a CSV file containing detected changes.
     """
     try:
-        # Read historical data with error handling for inconsistent columns
-        df = pd.read_csv(history_csv, on_bad_lines='skip', encoding='utf-8-sig')
+        df = read_history(history_csv)
+        record_rows('rows_in', history_csv, len(df))
         print(f"Successfully read {len(df)} rows from history file")
-        
-        # Ensure the Timestamp column is in datetime format
-        df['Timestamp'] = pd.to_datetime(df['Timestamp'], errors='coerce')
-
-        # Normalize relevant date columns
-        date_columns = ['StartDate', 'PrimaryCompletionDate', 'CompletionDate',
-                        'StudyFirstPostDate', 'ResultsFirstPostDate', 'LastUpdatePostDate']
-        for col in date_columns:
-            if (col in df.columns):
-                try:
-                    df[col] = pd.to_datetime(df[col], format='%Y-%m-%d', errors='coerce')
-                except ValueError:
-                    df[col] = pd.to_datetime(df[col], errors='coerce')
-
-        # Drop rows with null values in the Timestamp column
-        df.dropna(subset=['Timestamp'], inplace=True)
-
-        # Sort by NCTId and Timestamp
-        df.sort_values(by=['NCTId', 'Timestamp'], inplace=True)
-
-        changes = []
-
-        # Initialize changes list with required columns
-        changes_template = {
-            'NCTId': None,
-            'final_date': None,
-            'start_date': None,
-            'field_changed': None,  # Changed from 'change' to 'field_changed'
-            'final_value': None,
-            'start_value': None
-        }
+        prepare_history_frame(df)
 
-        # Identify latest NCTIds in the dataset
-        latest_data = df[df['Timestamp'] == df['Timestamp'].max()]
-        latest_nct_ids = set(latest_data['NCTId'])
+        changes_df = pd.concat([detect_added_removed(df), diff_consecutive_versions(df, n)], ignore_index=True)
+        changes_df = format_changes(changes_df)
 
-        # Identify NCTIds in the previous dataset
-        previous_data = df[df['Timestamp'] < df['Timestamp'].max()]
-        previous_nct_ids = set(previous_data['NCTId'])
+        # Save changes to CSV
+        changes_df.to_csv(changes_csv, index=False)
+        record_rows('rows_out', changes_csv, len(changes_df))
 
-        # Identify new studies added (NCTIds that are in the latest data but not in the previous)
-        new_nct_ids = latest_nct_ids - previous_nct_ids
-        for nct_id in new_nct_ids:
-            change_entry = changes_template.copy()
-            change_entry.update({
-                'NCTId': nct_id,
-                'final_date': df[df['NCTId'] == nct_id]['Timestamp'].max(),
-                'field_changed': 'New Study Added'
-            })
-            changes.append(change_entry)
+        if changes_df['NCTId'].isna().all():
+            print("Step 7: No changes detected in the data.")
+        else:
+            print(f"Step 7: Changes file generated at: {changes_csv}")
+    except Exception as e:
+        print(f"Error in Step 7: {e}")
+        record_error(e)
 
-        # Identify studies removed (NCTIds that are in the previous data but not in the latest)
-        removed_nct_ids = previous_nct_ids - latest_nct_ids
-        for nct_id in removed_nct_ids:
-            change_entry = changes_template.copy()
-            change_entry.update({
-                'NCTId': nct_id,
-                'start_date': df[df['NCTId'] == nct_id]['Timestamp'].max(),
-                'field_changed': 'Study Removed'
-            })
-            changes.append(change_entry)
-
-        # Group by NCTId and analyze the last N Timestamps
-        for nct_id, group in df.groupby('NCTId'):
-            if len(group) > 1:
-                # Take only the last N records per NCTId
-                group = group.tail(n).reset_index(drop=True)
-
-                # Compare each row with the next
-                for i in range(1, len(group)):
-                    current_row = group.iloc[i]
-                    previous_row = group.iloc[i - 1]
-
-                    for column in group.columns:
-                        if column not in ['NCTId', 'Timestamp']:
-                            current_value = current_row[column]
-                            previous_value = previous_row[column]
-
-                            # Handle numeric values
-                            if pd.api.types.is_numeric_dtype(group[column]):
-                                if pd.notnull(current_value) and pd.notnull(previous_value) and current_value != previous_value:
-                                    change_entry = changes_template.copy()
-                                    change_entry.update({
-                                        'NCTId': nct_id,
-                                        'final_date': current_row['Timestamp'],
-                                        'start_date': previous_row['Timestamp'],
-                                        'field_changed': column,
-                                        'final_value': current_value,
-                                        'start_value': previous_value
-                                    })
-                                    changes.append(change_entry)
-                            # Handle date values
-                            elif pd.api.types.is_datetime64_any_dtype(group[column]):
-                                if pd.notnull(current_value) and pd.notnull(previous_value) and current_value != previous_value:
-                                    change_entry = changes_template.copy()
-                                    change_entry.update({
-                                        'NCTId': nct_id,
-                                        'final_date': current_row['Timestamp'],
-                                        'start_date': previous_row['Timestamp'],
-                                        'field_changed': column,
-                                        'final_value': current_value.strftime('%Y-%m-%d') if pd.notnull(current_value) else None,
-                                        'start_value': previous_value.strftime('%Y-%m-%d') if pd.notnull(previous_value) else None
-                                    })
-                                    changes.append(change_entry)
-                            # Handle text or other types
-                            else:
-                                # Ignore double carriage return differences
-                                if pd.notnull(current_value) and pd.notnull(previous_value):
-                                    current_value_str = str(current_value).replace('\n\n', '\n')
-                                    previous_value_str = str(previous_value).replace('\n\n', '\n')
-                                    if current_value_str != previous_value_str:
-                                        change_entry = changes_template.copy()
-                                        change_entry.update({
-                                            'NCTId': nct_id,
-                                            'final_date': current_row['Timestamp'],
-                                            'start_date': previous_row['Timestamp'],
-                                            'field_changed': column,
-                                            'final_value': current_value_str,
-                                            'start_value': previous_value_str
-                                        })
-                                        changes.append(change_entry)
-
-        # Create DataFrame with changes, handling empty changes list
-        if not changes:
-            changes = [changes_template]  # Add a dummy row to prevent empty DataFrame issues
-        
-        changes_df = pd.DataFrame(changes)
+def read_version_rows(history_dir, versions, columns=None, files=None):
+    """
+    Read the stored rows of versions of a delta-encoded history, one row group read per
+    distinct (ValidFrom, RowGroup) location.
+
+    Args:
+        history_dir (str): Root directory of the history dataset
+        versions (pd.DataFrame): Version table rows with ValidFrom, RowGroup and RowOffset
+        columns (list): Stored columns to read; None reads every stored column
+        files (dict): Cache of open pyarrow.parquet.ParquetFile objects keyed by snapshot key,
+            filled as partitions are opened; None opens them for this call only
 
-        # Modify the 'field_changed' column to be more readable
-        def make_human_readable(text):
-            if pd.isna(text):
-                return "No changes detected"
-            return re.sub(r'(?<!^)(?=[A-Z])', ' ', text)
+    Returns:
+        pyarrow.Table: The rows, in the order of versions
+    """
+    if versions.empty:
+        return HISTORY_SCHEMA.empty_table().select(columns or HISTORY_SCHEMA.names)
+    files = {} if files is None else files
+    versions = versions.reset_index(drop=True)
+    tables = []
+    order = []
+    for (key, row_group), group in versions.groupby(['ValidFrom', 'RowGroup'], sort=False):
+        if key not in files:
+            files[key] = pq.ParquetFile(history_partition_file(history_dir, key))
+        row_group_table = files[key].read_row_group(int(row_group), columns=columns)
+        tables.append(row_group_table.take(pa.array(group['RowOffset'].to_numpy(dtype=np.int64))))
+        order.append(group.index.to_numpy())
+    # Restore the order of the requested versions
+    positions = np.argsort(np.concatenate(order), kind='stable')
+    return pa.concat_tables(tables).take(pa.array(positions))
 
-        changes_df['field_changed'] = changes_df['field_changed'].apply(make_human_readable)
+def backfill_changes_shard(history_dir, versions, snapshots, n=None, since_key=None):
+    """
+    Diffs the version chains of one shard of the studies of a delta-encoded history.
+
+    A version is identical in every snapshot it is valid for, so the rows of a study only
+    differ at version boundaries: each version is represented by the rows of its first and
+    last snapshot instead of one row per snapshot. Only the row groups holding the shard's
+    versions are read.
+
+    Args:
+        history_dir (str): Root directory of the history dataset
+        versions (pd.DataFrame): Version table rows of the studies of the shard
+        snapshots (dict): Snapshot Timestamp strings keyed by snapshot key, in snapshot order
+        n (int): Only the last n snapshots of each study are compared; None compares all
+        since_key (str): Only changes in snapshots at or after this snapshot key are reported
+
+    Returns:
+        tuple: (added and removed study entries, field change entries ordered by study,
+        version and column)
+    """
+    keys = np.array(list(snapshots), dtype=object)
+    timestamps = np.array(list(snapshots.values()), dtype=object)
+    versions = versions.sort_values(by=['NCTId', 'ValidFrom'], kind='stable').reset_index(drop=True)
+    first = np.searchsorted(keys, versions['ValidFrom'].to_numpy(dtype=object), side='left')
+    last = np.searchsorted(keys, versions['ValidTo'].fillna(HISTORY_OPEN_KEY).to_numpy(dtype=object), side='left') - 1
+    valid = last >= first
+    versions, first, last = versions[valid].reset_index(drop=True), first[valid], last[valid]
+
+    # One row per version boundary: the first and, if different, the last snapshot of each version
+    counts = last - first + 1
+    start_rank = versions.assign(count=counts).groupby('NCTId')['count'].cumsum().to_numpy() - counts
+    boundary = np.repeat(np.arange(len(versions)), np.where(counts > 1, 2, 1))
+    is_last = np.zeros(len(boundary), dtype=bool)
+    is_last[1:] = boundary[1:] == boundary[:-1]
+    rows = pd.DataFrame({
+        'version': boundary,
+        'NCTId': versions['NCTId'].to_numpy(dtype=object)[boundary],
+        'position': np.where(is_last, last[boundary], first[boundary]),
+        'rank': np.where(is_last, start_rank[boundary] + counts[boundary] - 1, start_rank[boundary]),
+    })
+    rows['Timestamp'] = pd.to_datetime(pd.Series(timestamps[rows['position'].to_numpy()], dtype=object), errors='coerce')
+
+    latest_timestamp = pd.to_datetime(timestamps[-1], errors='coerce') if len(timestamps) else None
+    added_removed = detect_added_removed(rows[['NCTId', 'Timestamp']], latest_timestamp)
+
+    if n is not None:
+        # Only the last n snapshot rows of each study are compared
+        total = rows.groupby('NCTId')['rank'].transform('max').to_numpy() + 1
+        rows = rows[rows['rank'].to_numpy() >= total - n]
+    if since_key is not None:
+        # Keep the rows at or after since, and the row before them as the baseline of their changes
+        after_since = keys[rows['position'].to_numpy()] >= since_key
+        baseline = np.zeros(len(rows), dtype=bool)
+        baseline[:-1] = after_since[1:] & (rows['NCTId'].to_numpy()[1:] == rows['NCTId'].to_numpy()[:-1])
+        rows = rows[after_since | baseline]
+        # New studies change in the latest snapshot, removed ones in the snapshot after their last one
+        is_added = (added_removed['field_changed'] == 'New Study Added').to_numpy()
+        removal_position = pd.Series(last, index=versions['NCTId']).groupby(level=0).max() + 1
+        change_position = np.where(is_added, len(keys) - 1,
+                                   removal_position.reindex(added_removed['NCTId']).to_numpy())
+        added_removed = added_removed[keys[change_position.astype(np.int64)] >= since_key]
+
+    stored_columns = [column for column in HISTORY_SCHEMA.names if column != 'Timestamp']
+    kept_versions = np.unique(rows['version'].to_numpy())
+    content = read_version_rows(history_dir, versions.iloc[kept_versions], stored_columns).to_pandas()
+    df = content.iloc[np.searchsorted(kept_versions, rows['version'].to_numpy())].reset_index(drop=True)
+    df['Timestamp'] = timestamps[rows['position'].to_numpy()]
+    prepare_history_frame(df)
+    return added_removed, diff_consecutive_versions(df)
+
+def backfill_changes(history_dir, changes_csv, n=CHANGES_WINDOW, since=None, workers=1):
+    """
+    Regenerates the changes report from the full history, sharded across a process pool.
+
+    The studies are partitioned by a hash of their NCTId into one shard per worker. Each
+    worker diffs the version chains of its studies independently (backfill_changes_shard),
+    and the per-shard results are merged in the order generate_changes_last_n writes them,
+    so without since the report is identical to generate_changes_last_n(history_dir,
+    changes_csv, n).
+
+    Args:
+        history_dir (str): Root directory of a delta-encoded history dataset
+        changes_csv (str): Path where the changes report will be saved
+        n (int): Number of most recent snapshots of each study to compare; None compares all
+        since (str or datetime): Only report changes in snapshots taken at or after this time
+        workers (int): Number of worker processes; 1 diffs every study in the current process
+
+    Returns:
+        None. Generates a CSV file containing detected changes.
+    """
+    try:
+        versions = load_history_versions(history_dir)
+        if versions is None:
+            raise ValueError(f"{history_dir} is not a delta-encoded history; append or migrate a snapshot first.")
+        if versions['RowGroup'].isna().any():
+            versions = index_history_versions(history_dir)
+        snapshots = load_history_snapshots(history_dir)
+        since_key = snapshot_key(since) if since is not None else None
+        record_rows('rows_in', history_dir, len(versions))
+
+        workers = max(workers, 1)
+        shard_of = np.array([zlib.crc32(nct_id.encode('utf-8')) % workers for nct_id in versions['NCTId']])
+        shards = [versions[shard_of == shard] for shard in range(workers)]
+        shards = [shard for shard in shards if not shard.empty]
+        print(f"Step 7: Backfilling changes of {versions['NCTId'].nunique()} studies over {len(snapshots)} "
+              f"snapshots in {len(shards)} shards" + (f" since {since}" if since is not None else "") + ".")
+        if workers == 1:
+            results = [backfill_changes_shard(history_dir, shard, snapshots, n, since_key) for shard in shards]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(backfill_changes_shard, itertools.repeat(history_dir), shards,
+                                            itertools.repeat(snapshots), itertools.repeat(n),
+                                            itertools.repeat(since_key)))
+
+        # 'New Study Added' sorts before 'Study Removed', as in detect_added_removed; field
+        # changes keep their per-study order, since every study belongs to a single shard
+        added_removed = pd.concat([result[0] for result in results], ignore_index=True)
+        added_removed = added_removed.sort_values(by=['field_changed', 'NCTId'], kind='stable')
+        field_changes = pd.concat([result[1] for result in results], ignore_index=True)
+        field_changes = field_changes.sort_values(by='NCTId', kind='stable')
+        changes_df = pd.concat([added_removed, field_changes], ignore_index=True) if results \
+            else pd.DataFrame(columns=CHANGES_COLUMNS)
+        changes_df = format_changes(changes_df)
 
-        # Save changes to CSV
         changes_df.to_csv(changes_csv, index=False)
+        record_rows('rows_out', changes_csv, len(changes_df))
+        print(f"Step 7: Changes file generated at: {changes_csv}")
+    except Exception as e:
+        print(f"Error in Step 7: {e}")
+        record_error(e)
+
+def generate_changes_incremental(current_csv, state_file, changes_csv):
+    """
+    Detects the changes of the latest snapshot against a persisted "latest state per
+    NCTId" snapshot and appends them to the changes report.
+
+    Only the freshly prepared studies CSV and the state file are read, so the cost of a
+    run depends on the corpus size rather than on the length of the history. Studies
+    are reported as removed once, in the first run where they are missing. A snapshot
+    that is not newer than the state is ignored, which makes reruns idempotent.
+
+    Args:
+        current_csv (str): Path to the current CSV data file
+        state_file (str): Path of the Parquet latest-state snapshot, updated in place
+        changes_csv (str): Path of the changes report the detected changes are appended to
+
+    Returns:
+        None. Appends detected changes to the report and saves the new state.
+    """
+    try:
+        current = prepare_history_frame(read_study_csv(current_csv))
+        record_rows('rows_in', current_csv, len(current))
+        if os.path.isfile(state_file):
+            state = pd.read_parquet(state_file)
+            record_rows('rows_in', state_file, len(state))
+        else:
+            print(f"Step 7: No state found at {state_file}; every study is reported as new.")
+            state = current.iloc[0:0]
+
+        latest_timestamp = current['Timestamp'].max()
+        previous_timestamp = state['Timestamp'].max()
+        if pd.notna(previous_timestamp) and latest_timestamp <= previous_timestamp:
+            print(f"Step 7: {current_csv} is not newer than the state; no changes appended.")
+            return
+
+        in_state = current['NCTId'].isin(state['NCTId'])
+        still_present = state['NCTId'].isin(current['NCTId'])
+        new_studies = current[~in_state]
+        removed_studies = state[~still_present & (state['Timestamp'] == previous_timestamp)]
+
+        added_removed = pd.concat([
+            pd.DataFrame({'NCTId': new_studies['NCTId'].to_numpy(), 'final_date': new_studies['Timestamp'].to_numpy(),
+                          'start_date': pd.NaT, 'field_changed': 'New Study Added'}),
+            pd.DataFrame({'NCTId': removed_studies['NCTId'].to_numpy(), 'final_date': pd.NaT,
+                          'start_date': removed_studies['Timestamp'].to_numpy(), 'field_changed': 'Study Removed'}),
+        ], ignore_index=True).reindex(columns=CHANGES_COLUMNS)
+
+        # Each current row is compared with the last known version of the same study
+        versions = pd.concat([state[still_present], current], ignore_index=True)
+        versions.sort_values(by=['NCTId', 'Timestamp'], inplace=True)
+        changes_df = pd.concat([added_removed, diff_consecutive_versions(versions)], ignore_index=True)
+
+        if os.path.isfile(changes_csv):
+            if not changes_df.empty:
+                format_changes(changes_df).to_csv(changes_csv, mode='a', header=False, index=False)
+        else:
+            format_changes(changes_df).to_csv(changes_csv, index=False)
 
-        if len(changes) == 1 and all(v is None for v in changes[0].values()):
+        new_state = pd.concat([state[~still_present], current], ignore_index=True)
+        new_state.sort_values(by='NCTId', inplace=True)
+        new_state.to_parquet(state_file, index=False)
+        record_rows('rows_out', changes_csv, len(changes_df))
+        record_rows('rows_out', state_file, len(new_state))
+
+        if changes_df.empty:
             print("Step 7: No changes detected in the data.")
         else:
-            print(f"Step 7: Changes file generated at: {changes_csv}")
+            print(f"Step 7: {len(changes_df)} changes appended to {changes_csv}.")
     except Exception as e:
         print(f"Error in Step 7: {e}")
+        record_error(e)
+
+def rebuild_change_state(history_csv, state_file):
+    """
+    Rebuilds the latest-state snapshot used by generate_changes_incremental from the full history.
+
+    Args:
+        history_csv (str): Path to the history dataset directory, or to a legacy history CSV file
+        state_file (str): Path of the Parquet latest-state snapshot to write
+
+    Returns:
+        None. Writes the last known version of every study to the state file.
+    """
+    df = prepare_history_frame(read_history(history_csv))
+    state = df.groupby('NCTId').tail(1)
+    state.to_parquet(state_file, index=False)
+    print(f"Latest state of {len(state)} studies rebuilt from {history_csv} into {state_file}.")
+
+def sqlite_value(value, column_type):
+    """
+    Convert one CSV field to the value stored in SQLite.
+
+    Args:
+        value (str): Field as written in the CSV file
+        column_type (pyarrow.DataType): Type of the column in HISTORY_SCHEMA
+
+    Returns:
+        Value for SQLite: None for empty fields, int for booleans and counts, float for ages, else str
+    """
+    if value == '':
+        return None
+    if pa.types.is_boolean(column_type):
+        return {'True': 1, 'False': 0}.get(value, value)
+    if pa.types.is_integer(column_type):
+        return int(float(value))
+    if pa.types.is_floating(column_type):
+        return float(value)
+    return value
+
+def iter_csv_batches(csv_file, batch_size=SQLITE_BATCH_SIZE):
+    """
+    Read a CSV file written by the pipeline in batches of rows.
+
+    Args:
+        csv_file (str): Path to the CSV file
+        batch_size (int): Rows per batch
+
+    Yields:
+        tuple: Header, then each batch as a list of rows
+    """
+    with open(csv_file, 'r', newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        while True:
+            batch = list(itertools.islice(reader, batch_size))
+            if not batch:
+                break
+            yield header, batch
+
+def study_content_hashes(csv_file, child_files):
+    """
+    Hash each study over its main row, without Timestamp, and all of its child table rows.
+
+    Args:
+        csv_file (str): Main studies CSV file
+        child_files (dict): Child table CSV file keyed by table name
+
+    Returns:
+        dict: Hex digest keyed by NCTId
+    """
+    digests = {}
+    timestamp_position = STUDY_COLUMNS.index('Timestamp')
+    for header, batch in iter_csv_batches(csv_file):
+        for row in batch:
+            digest = hashlib.sha256()
+            digest.update('\x1f'.join(row[:timestamp_position] + row[timestamp_position + 1:]).encode('utf-8'))
+            digests[row[0]] = digest
+    for table, child_file in child_files.items():
+        if not os.path.isfile(child_file):
+            continue
+        for header, batch in iter_csv_batches(child_file):
+            for row in batch:
+                if row[0] in digests:
+                    digests[row[0]].update(f"\x1e{table}\x1f".encode('utf-8') + '\x1f'.join(row).encode('utf-8'))
+    return {nct_id: digest.hexdigest() for nct_id, digest in digests.items()}
+
+def create_sqlite_tables(conn):
+    """
+    Create the tables of the analytical store if they do not exist yet.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the store
+    """
+    sqlite_types = {'bool': 'INTEGER', 'int64': 'INTEGER', 'double': 'REAL'}
+    study_columns = ', '.join(f'"{field.name}" {sqlite_types.get(str(field.type), "TEXT")}'
+                              + (' PRIMARY KEY' if field.name == 'NCTId' else '')
+                              for field in HISTORY_SCHEMA)
+    conn.execute(f"CREATE TABLE IF NOT EXISTS studies ({study_columns})")
+    for table, columns in CHILD_TABLE_COLUMNS.items():
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(f'{column} TEXT' for column in columns)})")
+    conn.execute(f"CREATE TABLE IF NOT EXISTS changes ({', '.join(f'{column} TEXT' for column in CHANGES_COLUMNS)})")
+    conn.execute(f"CREATE TABLE IF NOT EXISTS cohort_membership ({', '.join(f'{column} TEXT' for column in COHORT_MEMBERSHIP_COLUMNS)})")
+    conn.execute("CREATE TABLE IF NOT EXISTS study_hashes (NCTId TEXT PRIMARY KEY, ContentHash TEXT)")
+
+def load_sqlite(csv_file, changes_csv, db_file=SQLITE_DB_FILE):
+    """
+    Loads the studies, child tables and changes report into an indexed SQLite database.
+
+    The load is incremental: each study is hashed over its main row and child rows, and
+    only new or changed studies are upserted by NCTId, with their child rows replaced.
+    Studies missing from the current snapshot are deleted. The changes and
+    cohort_membership tables mirror their CSV files. Everything is written in a single transaction with batched executemany
+    calls, and the database uses WAL mode so readers are not blocked by the load.
+
+    Args:
+        csv_file (str): Path to the main CSV file; child tables are read from the same directory
+        changes_csv (str): Path to the changes report
+        db_file (str): Path of the SQLite database
+
+    Returns:
+        None. Creates or updates the database.
+    """
+    data_dir = os.path.dirname(csv_file)
+    child_files = {table: os.path.join(data_dir, f"{table}.csv") for table in CHILD_TABLE_COLUMNS}
+    hashes = study_content_hashes(csv_file, child_files)
+
+    os.makedirs(os.path.dirname(db_file) or '.', exist_ok=True)
+    conn = sqlite3.connect(db_file, isolation_level=None)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("BEGIN")
+        create_sqlite_tables(conn)
+        stored_hashes = dict(conn.execute("SELECT NCTId, ContentHash FROM study_hashes"))
+        changed_ids = {nct_id for nct_id, content_hash in hashes.items() if stored_hashes.get(nct_id) != content_hash}
+        removed_ids = set(stored_hashes) - set(hashes)
+
+        # Child rows of changed and removed studies are deleted, then those of changed studies reinserted
+        conn.execute("CREATE TEMP TABLE stale_ids (NCTId TEXT PRIMARY KEY)")
+        conn.executemany("INSERT INTO stale_ids VALUES (?)", ((nct_id,) for nct_id in changed_ids | removed_ids))
+        for table in CHILD_TABLE_COLUMNS:
+            conn.execute(f"DELETE FROM {table} WHERE NCTId IN (SELECT NCTId FROM stale_ids)")
+        conn.executemany("DELETE FROM studies WHERE NCTId = ?", ((nct_id,) for nct_id in removed_ids))
+        conn.executemany("DELETE FROM study_hashes WHERE NCTId = ?", ((nct_id,) for nct_id in removed_ids))
+
+        column_types = [field.type for field in HISTORY_SCHEMA]
+        quoted_columns = ', '.join(f'"{column}"' for column in STUDY_COLUMNS)
+        upsert = (f"INSERT INTO studies ({quoted_columns}) VALUES ({', '.join('?' * len(STUDY_COLUMNS))}) "
+                  f"ON CONFLICT(NCTId) DO UPDATE SET "
+                  + ', '.join(f'"{column}" = excluded."{column}"' for column in STUDY_COLUMNS[1:]))
+        row_count = 0
+        for header, batch in iter_csv_batches(csv_file):
+            conn.executemany(upsert, ([sqlite_value(value, column_type) for value, column_type in zip(row, column_types)]
+                                      for row in batch if row[0] in changed_ids))
+            # Unchanged studies only get the Timestamp of the current snapshot
+            conn.executemany("UPDATE studies SET Timestamp = ? WHERE NCTId = ? AND Timestamp IS NOT ?",
+                             ((row[-1], row[0], row[-1]) for row in batch if row[0] not in changed_ids))
+            row_count += len(batch)
+        record_rows('rows_in', csv_file, row_count)
+
+        for table, child_file in child_files.items():
+            if not os.path.isfile(child_file):
+                continue
+            insert = f"INSERT INTO {table} VALUES ({', '.join('?' * len(CHILD_TABLE_COLUMNS[table]))})"
+            for header, batch in iter_csv_batches(child_file):
+                conn.executemany(insert, ([value or None for value in row] for row in batch if row[0] in changed_ids))
+                record_rows('rows_in', child_file, len(batch))
+
+        # The changes report is rewritten or appended to by the changes stage, so it is reloaded whole
+        conn.execute("DELETE FROM changes")
+        if os.path.isfile(changes_csv):
+            insert = f"INSERT INTO changes VALUES ({', '.join('?' * len(CHANGES_COLUMNS))})"
+            for header, batch in iter_csv_batches(changes_csv):
+                conn.executemany(insert, ([value or None for value in row] for row in batch))
+                record_rows('rows_in', changes_csv, len(batch))
+        conn.execute("DELETE FROM cohort_membership")
+        membership_file = os.path.join(data_dir, COHORT_MEMBERSHIP_FILE)
+        if os.path.isfile(membership_file):
+            for header, batch in iter_csv_batches(membership_file):
+                conn.executemany("INSERT INTO cohort_membership VALUES (?, ?)", batch)
+                record_rows('rows_in', membership_file, len(batch))
+
+        conn.executemany("INSERT INTO study_hashes VALUES (?, ?) ON CONFLICT(NCTId) DO UPDATE SET ContentHash = excluded.ContentHash",
+                         ((nct_id, hashes[nct_id]) for nct_id in changed_ids))
+        for table, columns in SQLITE_INDEXES.items():
+            for column in columns:
+                conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{column} ON {table} ({column})")
+        conn.execute("COMMIT")
+        record_rows('rows_out', db_file, len(changed_ids))
+        print(f"Step 8: Loaded {len(changed_ids)} new or changed studies into {db_file} "
+              f"and removed {len(removed_ids)} studies.")
+    except (sqlite3.Error, OSError, ValueError) as e:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        print(f"Error in Step 8: {e}")
+        record_error(e)
+    finally:
+        conn.close()
+
+def study_contributions(csv_file, nct_ids):
+    """
+    Extract the dimension values and enrollment each study contributes to the dashboard rollups.
+
+    Args:
+        csv_file (str): Path to the main CSV file; child tables are read from the same directory
+        nct_ids (set): Studies to extract
+
+    Returns:
+        pd.DataFrame: One row per study with NCTId, EnrollmentCount and one column per
+        dimension, holding a list of distinct values for multi-valued dimensions
+    """
+    data_dir = os.path.dirname(csv_file)
+    studies = read_study_csv(csv_file, usecols=['NCTId', 'OverallStatus', 'Phase', 'LeadSponsorClass',
+                                                'StartDate', 'EnrollmentCount'])
+    studies = studies[studies['NCTId'].isin(nct_ids)].drop_duplicates(subset='NCTId', keep='last')
+    contributions = pd.DataFrame({
+        'NCTId': studies['NCTId'].to_numpy(dtype=object),
+        'EnrollmentCount': pd.to_numeric(studies['EnrollmentCount'], errors='coerce').fillna(0).to_numpy(dtype=np.int64),
+        'OverallStatus': studies['OverallStatus'].to_numpy(dtype=object),
+        'Phase': [sorted(set(phases.split(', '))) if isinstance(phases, str) else [] for phases in studies['Phase']],
+        'LeadSponsorClass': studies['LeadSponsorClass'].to_numpy(dtype=object),
+        'StartYear': studies['StartDate'].str.extract(r'^(\d{4})', expand=False).to_numpy(dtype=object),
+    })
+    for column, table, child_column in (('Country', 'locations', 'country'), ('InterventionType', 'interventions', 'type')):
+        child_file = os.path.join(data_dir, f"{table}.csv")
+        values = {}
+        if os.path.isfile(child_file) and os.path.getsize(child_file) > 1:
+            child = pd.read_csv(child_file, encoding='utf-8-sig', usecols=['NCTId', child_column], dtype=str)
+            child = child[child['NCTId'].isin(nct_ids)].dropna()
+            values = child.groupby('NCTId')[child_column].agg(lambda s: sorted(set(s))).to_dict()
+        contributions[column] = [values.get(nct_id, []) for nct_id in contributions['NCTId']]
+    return contributions
+
+def aggregate_contributions(contributions):
+    """
+    Roll up study contributions into study counts and enrollment per dimension value.
+
+    A study counts once for each distinct value of a multi-valued dimension.
+
+    Args:
+        contributions (pd.DataFrame): Rows returned by study_contributions
+
+    Returns:
+        dict: DataFrame indexed by value with studies and enrollment columns, keyed by
+        dimension; the 'totals' entry holds the overall counts under the value 'All'
+    """
+    rollups = {}
+    for dimension, column in AGGREGATE_DIMENSIONS.items():
+        values = contributions[[column, 'EnrollmentCount']].explode(column).dropna(subset=[column])
+        rollups[dimension] = values.groupby(column).agg(studies=('EnrollmentCount', 'size'),
+                                                         enrollment=('EnrollmentCount', 'sum'))
+    rollups['totals'] = pd.DataFrame({'studies': [len(contributions)],
+                                      'enrollment': [contributions['EnrollmentCount'].sum()]},
+                                     index=pd.Index(['All'], name='Total'))
+    return rollups
+
+def materialize_aggregates(csv_file, aggregates_dir=AGGREGATES_DIR):
+    """
+    Precomputes the dashboard rollups (study counts and enrollment by status, phase,
+    sponsor class, start year, country and intervention type) into small CSV files.
+
+    The rollups are updated from the change set: studies whose main row or child rows
+    changed since the last run (by content hash) have their old contribution subtracted
+    and their new one added, and removed studies are subtracted. Only the changed
+    studies are parsed; the first run computes everything.
+
+    Args:
+        csv_file (str): Path to the main CSV file; child tables are read from the same directory
+        aggregates_dir (str): Directory of the by_<dimension>.csv files and their state
+
+    Returns:
+        None. Writes one CSV file per dimension and a totals.csv file.
+    """
+    data_dir = os.path.dirname(csv_file)
+    child_files = {table: os.path.join(data_dir, f"{table}.csv") for table in CHILD_TABLE_COLUMNS}
+    hashes = study_content_hashes(csv_file, child_files)
+    state_file = os.path.join(aggregates_dir, AGGREGATE_STATE_FILE)
+    rollup_files = {dimension: os.path.join(aggregates_dir, f"by_{dimension}.csv") for dimension in AGGREGATE_DIMENSIONS}
+    rollup_files['totals'] = os.path.join(aggregates_dir, 'totals.csv')
+
+    if os.path.isfile(state_file) and all(os.path.isfile(path) for path in rollup_files.values()):
+        state = pd.read_parquet(state_file)
+        rollups = {dimension: pd.read_csv(path, dtype=str, keep_default_na=False, index_col=0).astype(np.int64)
+                   for dimension, path in rollup_files.items()}
+    else:
+        state = study_contributions(csv_file, set()).assign(ContentHash=pd.Series(dtype=object))
+        rollups = None
+
+    stored_hashes = dict(zip(state['NCTId'], state['ContentHash']))
+    changed_ids = {nct_id for nct_id, content_hash in hashes.items() if stored_hashes.get(nct_id) != content_hash}
+    removed = ~state['NCTId'].isin(hashes)
+    stale = state['NCTId'].isin(changed_ids) | removed
+    added = study_contributions(csv_file, changed_ids)
+    added['ContentHash'] = added['NCTId'].map(hashes)
+
+    added_rollups = aggregate_contributions(added)
+    removed_rollups = aggregate_contributions(state[stale])
+    if rollups is None:
+        rollups = added_rollups
+    else:
+        rollups = {dimension: rollup.add(added_rollups[dimension], fill_value=0)
+                                    .sub(removed_rollups[dimension], fill_value=0)
+                   for dimension, rollup in rollups.items()}
+
+    os.makedirs(aggregates_dir, exist_ok=True)
+    for dimension, rollup in rollups.items():
+        rollup = rollup[rollup['studies'] > 0].astype(np.int64)
+        rollup = rollup.reset_index()
+        rollup = rollup.sort_values(by=['studies', rollup.columns[0]], ascending=[False, True], kind='stable')
+        rollup.to_csv(rollup_files[dimension], index=False)
+    pd.concat([state[~stale], added], ignore_index=True).to_parquet(state_file, index=False)
+    record_rows('rows_in', csv_file, len(hashes))
+    print(f"Step 9: Dashboard aggregates updated in {aggregates_dir} from {len(changed_ids)} new or changed "
+          f"and {int(removed.sum())} removed studies.")
+
+def tokenize(text):
+    """
+    Split text into the tokens of the full-text index.
+
+    Text is normalized with clean_unicode_text, case-folded and split on non-word
+    characters, so '6-minute walk' gives ['6', 'minute', 'walk'].
+
+    Args:
+        text (str): Text to tokenize
+
+    Returns:
+        list: Tokens in text order
+    """
+    return TOKEN_PATTERN.findall(clean_unicode_text(text).casefold())
+
+def tokenize_study(values):
+    """
+    Map each token of a study's indexed columns to its positions.
+
+    Args:
+        values (list): Text of each column of TEXT_INDEX_COLUMNS
+
+    Returns:
+        dict: Sorted list of positions keyed by token
+    """
+    positions = collections.defaultdict(list)
+    position = 0
+    for value in values:
+        for token in tokenize(value):
+            positions[token].append(position)
+            position += 1
+        position += TEXT_INDEX_COLUMN_GAP
+    return positions
+
+_loaded_indexes = {}
+
+
+def get_cached_index(index_class, index_dir, watched_file):
+    """
+    Return an index loaded from a directory, reusing it until the directory is rebuilt or
+    appended to. The query modules (study_search, eligibility_search, history_query) share
+    this cache.
+
+    Args:
+        index_class (type): Class of the index, built as index_class(index_dir)
+        index_dir (str): Directory the index is loaded from
+        watched_file (str): File in index_dir rewritten whenever the index changes; the index
+            is reloaded when its modification time changes
+
+    Returns:
+        object: Loaded index
+    """
+    watched_path = os.path.join(index_dir, watched_file)
+    modified = os.path.getmtime(watched_path) if os.path.isfile(watched_path) else None
+    key = (index_class, index_dir)
+    cached = _loaded_indexes.get(key)
+    if cached is None or cached[0] != modified:
+        cached = (modified, index_class(index_dir))
+        _loaded_indexes[key] = cached
+    return cached[1]
+
+def load_text_index(index_dir=TEXT_INDEX_DIR):
+    """
+    Load the full-text index into memory.
+
+    Args:
+        index_dir (str): Directory of the index
+
+    Returns:
+        tuple: (dict of {NCTId: positions} keyed by token, dict of content hashes keyed by NCTId),
+        both empty if the index does not exist
+    """
+    postings_file = os.path.join(index_dir, TEXT_INDEX_POSTINGS_FILE)
+    documents_file = os.path.join(index_dir, TEXT_INDEX_DOCUMENTS_FILE)
+    if not (os.path.isfile(postings_file) and os.path.isfile(documents_file)):
+        return {}, {}
+    columns = pq.read_table(postings_file).to_pydict()
+    postings = {token: dict(zip(nct_ids, positions))
+                for token, nct_ids, positions in zip(columns['Token'], columns['NCTIds'], columns['Positions'])}
+    return postings, load_text_index_hashes(index_dir)
+
+def load_text_index_hashes(index_dir=TEXT_INDEX_DIR):
+    """
+    Load the content hashes of the studies in the full-text index.
+
+    Args:
+        index_dir (str): Directory of the index
+
+    Returns:
+        dict: Content hash of the indexed text keyed by NCTId, empty if the index does not exist
+    """
+    documents_file = os.path.join(index_dir, TEXT_INDEX_DOCUMENTS_FILE)
+    if not os.path.isfile(documents_file):
+        return {}
+    documents = pq.read_table(documents_file).to_pydict()
+    return dict(zip(documents['NCTId'], documents['ContentHash']))
+
+def build_text_index(csv_file, index_dir=TEXT_INDEX_DIR):
+    """
+    Builds or updates the positional inverted index over the titles, summaries, outcome
+    measures and intervention names of the studies.
+
+    Studies are re-tokenized only when the text of their indexed columns changed since
+    the last build; removed studies are dropped from the postings. The index is stored
+    as one Parquet row per token with its NCTIds and their token positions, and is
+    queried with the study_search module.
+
+    Args:
+        csv_file (str): Path to the main CSV file
+        index_dir (str): Directory of the index
+
+    Returns:
+        None. Writes the postings and documents files of the index.
+    """
+    studies = read_study_csv(csv_file, usecols=['NCTId'] + TEXT_INDEX_COLUMNS).fillna('')
+    studies = studies.drop_duplicates(subset='NCTId', keep='last')
+    texts = dict(zip(studies['NCTId'], zip(*(studies[column] for column in TEXT_INDEX_COLUMNS))))
+    hashes = {nct_id: hashlib.blake2b('\x1f'.join(values).encode('utf-8'), digest_size=8).hexdigest()
+              for nct_id, values in texts.items()}
+
+    stored_hashes = load_text_index_hashes(index_dir)
+    changed_ids = {nct_id for nct_id, content_hash in hashes.items() if stored_hashes.get(nct_id) != content_hash}
+    stale_ids = changed_ids | (set(stored_hashes) - set(hashes))
+    record_rows('rows_in', csv_file, len(studies))
+    if not stale_ids and os.path.isfile(os.path.join(index_dir, TEXT_INDEX_POSTINGS_FILE)):
+        print(f"Step 10: Text index in {index_dir} is up to date.")
+        return
+    postings = load_text_index(index_dir)[0]
+
+    if stale_ids:
+        for token in list(postings):
+            documents = postings[token]
+            for nct_id in stale_ids.intersection(documents):
+                del documents[nct_id]
+            if not documents:
+                del postings[token]
+    for nct_id in changed_ids:
+        for token, positions in tokenize_study(texts[nct_id]).items():
+            postings.setdefault(token, {})[nct_id] = positions
+
+    os.makedirs(index_dir, exist_ok=True)
+    tokens = sorted(postings)
+    nct_ids = [sorted(postings[token]) for token in tokens]
+    pq.write_table(pa.table({
+        'Token': pa.array(tokens, type=pa.string()),
+        'NCTIds': pa.array(nct_ids, type=pa.list_(pa.string())),
+        'Positions': pa.array([[postings[token][nct_id] for nct_id in ids] for token, ids in zip(tokens, nct_ids)],
+                              type=pa.list_(pa.list_(pa.int32()))),
+    }), os.path.join(index_dir, TEXT_INDEX_POSTINGS_FILE))
+    pq.write_table(pa.table({'NCTId': pa.array(list(hashes), type=pa.string()),
+                             'ContentHash': pa.array(list(hashes.values()), type=pa.string())}),
+                   os.path.join(index_dir, TEXT_INDEX_DOCUMENTS_FILE))
+    record_rows('rows_out', index_dir, len(tokens))
+    print(f"Step 10: Text index in {index_dir} updated for {len(changed_ids)} new or changed and "
+          f"{len(stale_ids - changed_ids)} removed studies ({len(tokens)} tokens).")
+
+def build_eligibility_index(csv_file, locations_csv, membership_csv, index_dir=ELIGIBILITY_INDEX_DIR):
+    """
+    Builds the eligibility and location query index of the studies.
+
+    Every study gets a document id (its row in studies.parquet). The age range each study
+    accepts is indexed as two sorted endpoint arrays (document ids ordered by minimum and by
+    maximum age in months; a missing maximum age means no upper limit). Sex, OverallStatus,
+    the countries of the sites and the cohorts are indexed as posting lists of document ids.
+    The index is queried with the eligibility_search module.
+
+    Args:
+        csv_file (str): Path to the main CSV file
+        locations_csv (str): Path to the locations CSV file
+        membership_csv (str): Path to the cohort membership CSV file; skipped if missing
+        index_dir (str): Directory of the index
+
+    Returns:
+        None. Writes the studies, ages and postings files of the index.
+    """
+    studies = read_study_csv(csv_file, usecols=['NCTId', 'Sex', 'OverallStatus', 'MaximumAge',
+                                                'MinimumAgeMonths', 'MaximumAgeMonths'])
+    studies = studies.drop_duplicates(subset='NCTId', keep='last').sort_values('NCTId').reset_index(drop=True)
+    doc_ids = pd.Series(np.arange(len(studies), dtype=np.int32), index=studies['NCTId'])
+
+    minimum_age = pd.to_numeric(studies['MinimumAgeMonths'], errors='coerce').fillna(0.0).to_numpy(dtype=np.float64)
+    # parse_age_to_months maps a missing maximum age to 0; the study has no upper limit
+    maximum_age = pd.to_numeric(studies['MaximumAgeMonths'], errors='coerce').to_numpy(dtype=np.float64, copy=True)
+    maximum_age[studies['MaximumAge'].fillna('').str.strip().eq('').to_numpy() | np.isnan(maximum_age)] = np.inf
+    minimum_order = np.argsort(minimum_age, kind='stable').astype(np.int32)
+    maximum_order = np.argsort(maximum_age, kind='stable').astype(np.int32)
+
+    postings = []
+    for attribute, nct_ids, values in (('Sex', studies['NCTId'], studies['Sex']),
+                                       ('OverallStatus', studies['NCTId'], studies['OverallStatus'])):
+        postings.append(pd.DataFrame({'Attribute': attribute, 'NCTId': nct_ids, 'Value': values}))
+    locations = read_study_csv(locations_csv, usecols=['NCTId', 'country'])
+    postings.append(pd.DataFrame({'Attribute': 'Country', 'NCTId': locations['NCTId'], 'Value': locations['country']}))
+    if os.path.isfile(membership_csv):
+        membership = read_study_csv(membership_csv, usecols=COHORT_MEMBERSHIP_COLUMNS)
+        postings.append(pd.DataFrame({'Attribute': 'Cohort', 'NCTId': membership['NCTId'], 'Value': membership['Cohort']}))
+    postings = pd.concat(postings, ignore_index=True).dropna()
+    postings = postings[postings['Value'].astype(str).str.strip().ne('') & postings['NCTId'].isin(doc_ids.index)]
+    postings = postings.assign(DocId=doc_ids.reindex(postings['NCTId']).to_numpy()).drop_duplicates(
+        subset=['Attribute', 'Value', 'DocId']).sort_values(['Attribute', 'Value', 'DocId'])
+    postings = postings.groupby(['Attribute', 'Value'], sort=False)['DocId'].agg(list).reset_index()
+
+    os.makedirs(index_dir, exist_ok=True)
+    pq.write_table(pa.table({'NCTId': pa.array(studies['NCTId'], type=pa.string())}),
+                   os.path.join(index_dir, ELIGIBILITY_STUDIES_FILE))
+    pq.write_table(pa.table({
+        'MinimumAgeDocIds': minimum_order, 'MinimumAgeMonths': minimum_age[minimum_order],
+        'MaximumAgeDocIds': maximum_order, 'MaximumAgeMonths': maximum_age[maximum_order],
+    }), os.path.join(index_dir, ELIGIBILITY_AGES_FILE))
+    pq.write_table(pa.table({
+        'Attribute': pa.array(postings['Attribute'], type=pa.string()),
+        'Value': pa.array(postings['Value'].astype(str), type=pa.string()),
+        'DocIds': pa.array(postings['DocId'], type=pa.list_(pa.int32())),
+    }), os.path.join(index_dir, ELIGIBILITY_POSTINGS_FILE))
+    record_rows('rows_in', csv_file, len(studies))
+    record_rows('rows_in', locations_csv, len(locations))
+    record_rows('rows_out', index_dir, len(postings))
+    print(f"Step 10: Eligibility index in {index_dir} built for {len(studies)} studies ({len(postings)} posting lists).")
 
 def standardize_date(date_str):
     """
     Standardize date strings to YYYY-MM-DD format.
+
+    The date shapes used by clinicaltrials.gov (YYYY, YYYY-MM and YYYY-MM-DD) are parsed
+    directly; any other string goes through pandas as before. Results are memoized.
     
     Args:
         date_str (str): Date string to standardize
@@ -554,18 +3357,33 @@ def standardize_date(date_str):
         str: Standardized date in YYYY-MM-DD format or empty string if invalid
     """
     if isinstance(date_str, str):
-        try:
-            if len(date_str.split('-')) == 2:  # Year-Month format
-                date_str += '-01'
-            return pd.to_datetime(date_str, errors='coerce').strftime('%Y-%m-%d')
-        except Exception:
-            return ''
+        return _standardize_date_str(date_str)
     return ''
 
+@functools.lru_cache(maxsize=NORMALIZER_CACHE_SIZE)
+def _standardize_date_str(date_str):
+    match = DATE_PATTERN.fullmatch(date_str)
+    if match:
+        year, month, day = (int(part) if part else 1 for part in match.groups())
+        # Stay within the Timestamp range so the result matches the pandas path
+        if PANDAS_MIN_YEAR < year < PANDAS_MAX_YEAR:
+            try:
+                return datetime.date(year, month, day).strftime('%Y-%m-%d')
+            except ValueError:
+                pass
+    try:
+        if len(date_str.split('-')) == 2:  # Year-Month format
+            date_str += '-01'
+        return pd.to_datetime(date_str, errors='coerce').strftime('%Y-%m-%d')
+    except Exception:
+        return ''
+
+@functools.lru_cache(maxsize=NORMALIZER_CACHE_SIZE)
 def format_title_case(text):
     """
     Format text in title case by replacing underscores with spaces.
-    For example, converts 'NOT_YET_RECRUITING' to 'Not Yet Recruiting'
+    For example, converts 'NOT_YET_RECRUITING' to 'Not Yet Recruiting'.
+    Results are memoized, since the same enum values repeat across studies.
     
     Args:
         text (str): Text to format
@@ -580,13 +3398,126 @@ def format_title_case(text):
     return words
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Monthly ETL of the clinical trials data of the configured cohorts.")
+    parser.add_argument('--incremental', action='store_true',
+                        help="download and transform only the studies updated since the last run")
+    parser.add_argument('--cohorts', default=COHORTS_FILE,
+                        help="JSON file of the named cohorts and their condition terms")
+    parser.add_argument('--full-records', action='store_true',
+                        help="download complete study records instead of only the fields the transform reads")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of processes used to transform the studies and to backfill the changes")
+    parser.add_argument('--incremental-changes', action='store_true',
+                        help="diff the new snapshot against the latest-state file and append to changes.csv")
+    parser.add_argument('--normalized', action='store_true',
+                        help="also write the child tables with dictionary-encoded dimension tables to data/normalized")
+    parser.add_argument('--parquet', action='store_true',
+                        help="also write the child tables as Parquet files to data/parquet")
+    parser.add_argument('--backfill-state', action='store_true',
+                        help="rebuild the latest-state file from the full history and exit")
+    parser.add_argument('--backfill-changes', action='store_true',
+                        help="regenerate changes.csv from the full history, sharded across --workers processes, and exit")
+    parser.add_argument('--since', default=None,
+                        help="with --backfill-changes, only report changes in snapshots taken at or after this date")
+    parser.add_argument('--changes-window', type=int, default=CHANGES_WINDOW,
+                        help=f"number of most recent snapshots of each study compared in changes.csv "
+                             f"(default: {CHANGES_WINDOW}; 0 compares the full history)")
+    parser.add_argument('--stages', nargs='+', default=DEFAULT_STAGES, choices=PIPELINE_STAGES, metavar='STAGE',
+                        help=f"stages to run, in pipeline order, among {', '.join(PIPELINE_STAGES)} "
+                             f"(default: {' '.join(DEFAULT_STAGES)})")
+    parser.add_argument('--force', action='store_true',
+                        help="run the selected stages even if their inputs are unchanged since the last run")
+    parser.add_argument('--data-dir', default='data',
+                        help="directory of the raw, transformed, history and change files")
+    parser.add_argument('--metrics-file', default=None,
+                        help="JSON Lines file the per-stage metrics of the run are appended to "
+                             f"(default: {os.path.basename(METRICS_FILE)} in the data directory)")
+    parser.add_argument('--profile', nargs='+', default=[], choices=PIPELINE_STAGES, metavar='STAGE',
+                        help=f"run these stages under cProfile and save the stats to {PROFILE_DIR} "
+                             f"(choices: {', '.join(PIPELINE_STAGES)})")
+    parser.add_argument('--trace-memory', nargs='+', default=[], choices=PIPELINE_STAGES, metavar='STAGE',
+                        help="run these stages under tracemalloc and record their top allocation sites")
+    args = parser.parse_args()
+
     # Define file paths
-    json_file = os.path.join('data', 'studies.json')
-    csv_file = os.path.join('data', 'studies.csv')
-    history_csv = os.path.join('data', 'studies_history.csv')
+    data_dir = args.data_dir
+    json_file = os.path.join(data_dir, 'studies.ndjson')
+    csv_file = os.path.join(data_dir, 'studies.csv')
+    history_csv = os.path.join(data_dir, 'studies_history.csv')
+    changes_csv = os.path.join(data_dir, 'changes.csv')
+    history_dir = os.path.join(data_dir, os.path.basename(HISTORY_DIR))
+    raw_cache_dir = os.path.join(data_dir, os.path.basename(RAW_CACHE_DIR))
+    checkpoint_dir = os.path.join(data_dir, os.path.basename(DOWNLOAD_CHECKPOINT_DIR))
+    state_file = os.path.join(data_dir, os.path.basename(LATEST_STATE_FILE))
+    child_files = [os.path.join(data_dir, f"{table}.csv") for table in CHILD_TABLE_COLUMNS]
+    db_file = os.path.join(data_dir, os.path.basename(SQLITE_DB_FILE))
+    aggregates_dir = os.path.join(data_dir, os.path.basename(AGGREGATES_DIR))
+    normalized_dir = os.path.join(data_dir, os.path.basename(NORMALIZED_DIR)) if args.normalized else None
+    parquet_dir = os.path.join(data_dir, 'parquet') if args.parquet else None
+    text_index_dir = os.path.join(data_dir, os.path.basename(TEXT_INDEX_DIR))
+    eligibility_index_dir = os.path.join(data_dir, os.path.basename(ELIGIBILITY_INDEX_DIR))
+    membership_csv = os.path.join(data_dir, COHORT_MEMBERSHIP_FILE)
+    locations_csv = os.path.join(data_dir, 'locations.csv')
+
+    # One-time migration of the legacy CSV history into the Parquet history dataset
+    if not list_snapshots(history_dir) and os.path.isfile(history_csv):
+        migrate_history_csv(history_csv, history_dir)
+
+    if args.backfill_state:
+        rebuild_change_state(history_dir, state_file)
+        raise SystemExit(0)
+
+    changes_window = args.changes_window or None
+    if args.backfill_changes:
+        backfill_changes(history_dir, changes_csv, changes_window, args.since, args.workers)
+        raise SystemExit(0)
+
+    # Inputs, outputs and output-changing parameters of each stage; download reads the API
+    # and always runs when selected
+    stage_io = {
+        'transform': ([json_file], [csv_file] + child_files + [path for path in (normalized_dir, parquet_dir) if path],
+                      {'normalized': args.normalized, 'parquet': args.parquet}),
+        'aggregate': ([csv_file] + child_files, [aggregates_dir], {}),
+        'index': ([csv_file, locations_csv, membership_csv], [text_index_dir, eligibility_index_dir], {}),
+        'history': ([csv_file], [history_dir], {}),
+        'changes': ([history_dir, csv_file, state_file] if args.incremental_changes else [history_dir],
+                    [changes_csv, state_file] if args.incremental_changes else [changes_csv],
+                    {'incremental': args.incremental_changes, 'window': changes_window}),
+        'load': ([csv_file] + child_files + [changes_csv, membership_csv], [db_file], {}),
+    }
+    stage_cache = StageCache(os.path.join(data_dir, STAGE_CACHE_FILE))
     
     # Execute ETL pipeline
-    download_studies(100000)  # Download latest data
-    data_preparation(json_file, csv_file)  # Transform data
-    append_to_history(csv_file, history_csv)  # Update historical record
-    generate_changes_last_n(history_csv, os.path.join('data', 'changes.csv'), 10)  # Generate change report
+    metrics = PipelineMetrics(args.profile, args.trace_memory)
+    try:
+        for stage in [stage for stage in PIPELINE_STAGES if stage in args.stages]:
+            inputs, outputs, params = stage_io.get(stage, (None, None, None))
+            with metrics.stage(stage) as record:
+                if inputs is not None and not args.force and stage_cache.is_current(stage, inputs, outputs, params):
+                    record['status'] = 'skipped'
+                    print(f"Skipping {stage}: its inputs are unchanged since the last run.")
+                    continue
+                if stage == 'download':
+                    download_studies(MAX_PAGE_SIZE, output_file=json_file, incremental=args.incremental,
+                                     cache_dir=raw_cache_dir, cohorts=load_cohorts(args.cohorts),
+                                     full_records=args.full_records, checkpoint_dir=checkpoint_dir)  # Download latest data
+                elif stage == 'transform':
+                    data_preparation(json_file, csv_file, raw_cache_dir if args.incremental else None,
+                                     args.workers, normalized_dir, parquet_dir)  # Transform data
+                elif stage == 'aggregate':
+                    materialize_aggregates(csv_file, aggregates_dir)  # Precompute dashboard rollups
+                elif stage == 'index':
+                    build_text_index(csv_file, text_index_dir)  # Update the full-text index
+                    build_eligibility_index(csv_file, locations_csv, membership_csv, eligibility_index_dir)
+                elif stage == 'history':
+                    append_to_history(csv_file, history_dir)  # Update historical record
+                elif stage == 'load':
+                    load_sqlite(csv_file, changes_csv, db_file)  # Load the analytical store
+                elif args.incremental_changes:
+                    generate_changes_incremental(csv_file, state_file, changes_csv)  # Append change report
+                else:
+                    generate_changes_last_n(history_dir, changes_csv, changes_window)  # Generate change report
+            if inputs is not None and metrics.stages[stage]['status'] == 'ok':
+                stage_cache.record(stage, inputs, outputs, params)
+    finally:
+        metrics.write(args.metrics_file or os.path.join(data_dir, os.path.basename(METRICS_FILE)))
@@ -0,0 +1,138 @@
+"""
+Point-in-Time Queries over the Study History
+--------------------------------------------
+
+This module answers "what did a study look like at a given run" and "what was the whole
+corpus as of a given run" from the delta-encoded Parquet history written by etl.py,
+without loading the history into pandas.
+
+The version table of the history (_versions.parquet) is the index: for every stored
+version of a study it records the snapshots it was valid for (ValidFrom/ValidTo) and the
+row group and offset of its row in the ValidFrom partition. A lookup reads the index
+once, then only the row groups holding the requested rows.
+
+Usage:
+    from history_query import as_of, history_of
+
+    corpus = as_of('2025-03-15')          # full snapshot of the last run on or before that date
+    versions = history_of('NCT06388226')  # every stored version of one study
+"""
+
+import numpy as np
+import pandas as pd
+
+import etl
+
+
+class HistoryIndex:
+    """
+    In-memory view of the version table of a delta-encoded history, sorted by NCTId,
+    with the partition files opened lazily by etl.read_version_rows and kept open
+    between lookups.
+    """
+
+    def __init__(self, history_dir=etl.HISTORY_DIR):
+        self.history_dir = history_dir
+        versions = etl.load_history_versions(history_dir)
+        if versions is None:
+            raise ValueError(f"{history_dir} is not a delta-encoded history; append or migrate a snapshot first.")
+        if versions['RowGroup'].isna().any():
+            versions = etl.index_history_versions(history_dir)
+        self.versions = versions.sort_values(by=['NCTId', 'ValidFrom'], kind='stable').reset_index(drop=True)
+        self.nct_ids = self.versions['NCTId'].to_numpy(dtype=object)
+        self.snapshots = etl.load_history_snapshots(history_dir)
+        self.snapshot_keys = np.array(list(self.snapshots), dtype=object)
+        self._files = {}
+
+    def snapshot_at(self, timestamp=None):
+        """
+        Find the last snapshot taken at or before a point in time.
+
+        Args:
+            timestamp (str or datetime): Point in time; None selects the latest snapshot
+
+        Returns:
+            str: Snapshot key, or None if no snapshot was taken by then
+        """
+        if not len(self.snapshot_keys):
+            return None
+        if timestamp is None:
+            return self.snapshot_keys[-1]
+        position = np.searchsorted(self.snapshot_keys, etl.snapshot_key(timestamp), side='right')
+        return self.snapshot_keys[position - 1] if position else None
+
+    def as_of(self, timestamp=None, columns=None):
+        """
+        Rebuild the full corpus as of the last snapshot taken at or before a point in time.
+
+        Args:
+            timestamp (str or datetime): Point in time; None selects the latest snapshot
+            columns (list): Columns to return; None returns every column
+
+        Returns:
+            pd.DataFrame: One row per study in that snapshot, sorted by NCTId, with
+            Timestamp set to the snapshot's Timestamp
+        """
+        columns = columns or etl.HISTORY_SCHEMA.names
+        key = self.snapshot_at(timestamp)
+        if key is None:
+            return pd.DataFrame(columns=columns)
+        valid_to = self.versions['ValidTo'].fillna(etl.HISTORY_OPEN_KEY)
+        valid = (self.versions['ValidFrom'] <= key) & (valid_to > key)
+        stored_columns = [column for column in columns if column != 'Timestamp']
+        rows = etl.read_version_rows(self.history_dir, self.versions[valid], stored_columns, self._files).to_pandas()
+        if 'Timestamp' in columns:
+            rows['Timestamp'] = self.snapshots[key]
+        return rows[columns]
+
+    def history_of(self, nct_id, columns=None):
+        """
+        Return every stored version of one study with the period it was valid for.
+
+        Args:
+            nct_id (str): NCTId of the study
+            columns (list): Columns to return; None returns every column
+
+        Returns:
+            pd.DataFrame: One row per version, oldest first, with ValidFrom and ValidTo as
+            snapshot Timestamps (ValidTo is None for the current version)
+        """
+        columns = columns or etl.HISTORY_SCHEMA.names
+        start = np.searchsorted(self.nct_ids, nct_id, side='left')
+        end = np.searchsorted(self.nct_ids, nct_id, side='right')
+        locations = self.versions.iloc[start:end].reset_index(drop=True)
+        stored_columns = [column for column in columns if column != 'Timestamp']
+        rows = etl.read_version_rows(self.history_dir, locations, stored_columns, self._files).to_pandas()
+        if 'Timestamp' in columns:
+            rows['Timestamp'] = [self.snapshots[key] for key in locations['ValidFrom']]
+        rows = rows[columns].copy()
+        rows['ValidFrom'] = [self.snapshots[key] for key in locations['ValidFrom']]
+        rows['ValidTo'] = [self.snapshots[key] if isinstance(key, str) else None for key in locations['ValidTo']]
+        return rows
+
+
+def get_index(history_dir=etl.HISTORY_DIR):
+    """
+    Return a HistoryIndex for a history, reusing it until the history is appended to.
+
+    Args:
+        history_dir (str): Root directory of the delta-encoded history
+
+    Returns:
+        HistoryIndex: Index of the history
+    """
+    return etl.get_cached_index(HistoryIndex, history_dir, etl.HISTORY_VERSIONS_FILE)
+
+
+def as_of(timestamp=None, columns=None, history_dir=etl.HISTORY_DIR):
+    """
+    Full corpus as of the last run on or before a point in time; see HistoryIndex.as_of.
+    """
+    return get_index(history_dir).as_of(timestamp, columns)
+
+
+def history_of(nct_id, columns=None, history_dir=etl.HISTORY_DIR):
+    """
+    Every stored version of one study; see HistoryIndex.history_of.
+    """
+    return get_index(history_dir).history_of(nct_id, columns)
@@ -0,0 +1,174 @@
+"""
+Full-Text Search over the Studies
+---------------------------------
+
+This module answers boolean and phrase queries over the titles, summaries, outcome
+measures and intervention names of the studies, from the positional inverted index
+written by etl.py (build_text_index).
+
+Queries are normalized and tokenized the same way as the indexed text. The syntax is:
+    word                     studies containing the word
+    "six minute walk"        studies containing the words next to each other, in order
+    a b, a AND b             studies matching both
+    a OR b                   studies matching either
+    NOT a, -a                studies not matching
+    ( ... )                  grouping
+AND binds tighter than OR; a term that tokenizes to several words, such as 6-minute,
+is searched as a phrase.
+
+Usage:
+    from study_search import search
+
+    search('"ejection fraction" AND (exercise OR training) NOT pediatric')
+"""
+import re
+
+import etl
+
+QUERY_PATTERN = re.compile(r'"([^"]*)"|(\()|(\))|(-)(?=\S)|([^\s()"]+)')
+OPERATORS = {'AND', 'OR', 'NOT'}
+
+
+class TextIndex:
+    """
+    In-memory view of the full-text index: token -> {NCTId: positions}.
+    """
+
+    def __init__(self, index_dir=etl.TEXT_INDEX_DIR):
+        self.index_dir = index_dir
+        self.postings, documents = etl.load_text_index(index_dir)
+        if not documents:
+            raise ValueError(f"{index_dir} holds no text index; run the index stage of etl.py first.")
+        self.nct_ids = frozenset(documents)
+
+    def _parse_query(self, query):
+        """
+        Split a query into (kind, value) tokens: ('phrase', [words]), ('op', 'AND'|'OR'|'NOT'),
+        ('(', None) and (')', None).
+        """
+        items = []
+        for phrase, opening, closing, minus, word in QUERY_PATTERN.findall(query):
+            if opening:
+                items.append(('(', None))
+            elif closing:
+                items.append((')', None))
+            elif minus:
+                items.append(('op', 'NOT'))
+            elif word in OPERATORS:
+                items.append(('op', word))
+            else:
+                items.append(('phrase', etl.tokenize(phrase or word)))
+        return items
+
+    def phrase(self, tokens):
+        """
+        Find the studies containing tokens next to each other, in order.
+
+        Args:
+            tokens (list): Normalized tokens of the phrase
+
+        Returns:
+            set: NCTIds of the matching studies
+        """
+        if not tokens:
+            return set()
+        postings = [self.postings.get(token, {}) for token in tokens]
+        # Intersect the documents from the rarest token up
+        candidates = set(min(postings, key=len))
+        for documents in sorted(postings, key=len):
+            candidates.intersection_update(documents)
+            if not candidates:
+                return candidates
+        if len(tokens) == 1:
+            return candidates
+        matches = set()
+        for nct_id in candidates:
+            starts = set(postings[0][nct_id])
+            for offset, documents in enumerate(postings[1:], start=1):
+                starts.intersection_update(position - offset for position in documents[nct_id])
+                if not starts:
+                    break
+            if starts:
+                matches.add(nct_id)
+        return matches
+
+    def search(self, query):
+        """
+        Find the studies matching a boolean query; see the module docstring for the syntax.
+
+        Args:
+            query (str): Query
+
+        Returns:
+            list: Sorted NCTIds of the matching studies
+        """
+        items = self._parse_query(query)
+        position = 0
+
+        def peek():
+            return items[position] if position < len(items) else (None, None)
+
+        def parse_or():
+            nonlocal position
+            result = parse_and()
+            while peek() == ('op', 'OR'):
+                position += 1
+                result = result | parse_and()
+            return result
+
+        def parse_and():
+            nonlocal position
+            result = parse_not()
+            while peek()[0] in ('phrase', '(') or peek() in (('op', 'AND'), ('op', 'NOT')):
+                if peek() == ('op', 'AND'):
+                    position += 1
+                result = result & parse_not()
+            return result
+
+        def parse_not():
+            nonlocal position
+            if peek() == ('op', 'NOT'):
+                position += 1
+                return self.nct_ids - parse_not()
+            return parse_term()
+
+        def parse_term():
+            nonlocal position
+            kind, value = peek()
+            position += 1
+            if kind == 'phrase':
+                return self.phrase(value)
+            if kind == '(':
+                result = parse_or()
+                if peek()[0] != ')':
+                    raise ValueError(f"Missing closing parenthesis in query: {query!r}")
+                position += 1
+                return result
+            raise ValueError(f"Unexpected {value or kind or 'end of query'!r} in query: {query!r}")
+
+        if not items:
+            return []
+        result = parse_or()
+        if position < len(items):
+            raise ValueError(f"Unexpected {peek()[1] or peek()[0]!r} in query: {query!r}")
+        return sorted(result)
+
+
+def get_index(index_dir=etl.TEXT_INDEX_DIR):
+    """
+    Return a TextIndex for an index directory, reusing it until the index is rebuilt.
+
+    Args:
+        index_dir (str): Directory of the text index
+
+    Returns:
+        TextIndex: Loaded index
+    """
+    return etl.get_cached_index(TextIndex, index_dir, etl.TEXT_INDEX_POSTINGS_FILE)
+
+
+def search(query, index_dir=etl.TEXT_INDEX_DIR):
+    """
+    NCTIds of the studies matching a boolean or phrase query; see TextIndex.search.
+    """
+    return get_index(index_dir).search(query)